@@ -0,0 +1,213 @@
+"""
+تجميع إحصائيات الإطارات في حاويات زمنية لكل كاميرا (1 ثانية، 1 دقيقة، 1 ساعة)
+
+كل دقة مخزنة في مصفوفات NumPy حلقية مخصصة مسبقًا: مجموع وقيمة قصوى لكل مقياس
+وعدد الإطارات لكل حاوية. الحاوية تُعاد تهيئتها عند إعادة استخدام خانتها، فالذاكرة
+ثابتة مهما طال التشغيل، والاستعلام يقرأ الحاويات مباشرة بدون المرور على الأحداث.
+"""
+import time
+from threading import Lock
+
+import numpy as np
+
+
+
+
+METRICS = ('persons', 'bags', 'weapons', 'mask', 'no_mask')
+
+# الاسم ← (طول الحاوية بالثواني، عدد الخانات)
+RESOLUTIONS = {
+    '1s': (1, 3600),      # ساعة
+    '1m': (60, 1440),     # يوم
+    '1h': (3600, 2160),   # 90 يومًا
+}
+
+
+
+
+def stats_vector(stats):
+    """تحويل قاموس إحصائيات إطار إلى متجه بترتيب METRICS"""
+    return np.array([stats.get(name, 0) for name in METRICS], dtype=np.float64)
+
+
+
+
+class BucketRing:
+    """مصفوفات حلقية لحاويات بطول ثابت"""
+
+    def __init__(self, seconds, slots, width=len(METRICS)):
+        self.seconds = seconds
+        self.slots = slots
+        self.ids = np.full(slots, -1, dtype=np.int64)
+        self.sums = np.zeros((slots, width), dtype=np.float64)
+        self.maxes = np.zeros((slots, width), dtype=np.float64)
+        self.counts = np.zeros(slots, dtype=np.int64)
+
+    def add(self, ts, sums, maxes, count):
+        bucket = int(ts // self.seconds)
+        slot = bucket % self.slots
+        if self.ids[slot] != bucket:
+            self.ids[slot] = bucket
+            self.sums[slot] = 0.0
+            self.maxes[slot] = 0.0
+            self.counts[slot] = 0
+
+        self.sums[slot] += sums
+        np.maximum(self.maxes[slot], maxes, out=self.maxes[slot])
+        self.counts[slot] += count
+
+    def window(self, since, until):
+        """
+        حاويات النطاق [since, until] المتاحة في الحلقة
+
+        الإرجاع:
+            (بدايات الحاويات، المجاميع، القيم القصوى، الأعداد)؛ الحاويات الفارغة أعدادها صفر
+        """
+        last = int(until // self.seconds)
+        first = max(int(since // self.seconds), last - self.slots + 1)
+        buckets = np.arange(first, last + 1, dtype=np.int64)
+        slots = buckets % self.slots
+        valid = self.ids[slots] == buckets
+
+        sums = np.where(valid[:, None], self.sums[slots], 0.0)
+        maxes = np.where(valid[:, None], self.maxes[slots], 0.0)
+        counts = np.where(valid, self.counts[slots], 0)
+        return buckets * self.seconds, sums, maxes, counts
+
+
+
+
+class StatsFolder:
+    """
+    جمع إحصائيات الإطارات محليًا لكل ثانية قبل تسليمها للمجمع
+
+    يقلل عدد الاستدعاءات (والرسائل بين العمليات) إلى رسالة واحدة في الثانية.
+
+    المعلمات:
+        source: اسم المصدر (الكاميرا أو المهمة)
+        sink: دالة (source, ts, sums, maxes, count)
+    """
+
+    def __init__(self, source, sink):
+        self.source = source
+        self.sink = sink
+        self.second = None
+        self.sums = np.zeros(len(METRICS), dtype=np.float64)
+        self.maxes = np.zeros(len(METRICS), dtype=np.float64)
+        self.count = 0
+
+    def add(self, stats, ts=None):
+        ts = time.time() if ts is None else ts
+        second = int(ts)
+        if self.second is not None and second != self.second:
+            self.flush()
+        self.second = second
+
+        values = stats_vector(stats)
+        self.sums += values
+        np.maximum(self.maxes, values, out=self.maxes)
+        self.count += 1
+
+    def flush(self):
+        if self.count:
+            self.sink(self.source, float(self.second), self.sums.copy(), self.maxes.copy(), self.count)
+        self.sums[:] = 0.0
+        self.maxes[:] = 0.0
+        self.count = 0
+
+
+
+
+class AnalyticsAggregator:
+    """حاويات زمنية بعدة دقات لكل مصدر"""
+
+    def __init__(self, resolutions=RESOLUTIONS):
+        self.resolutions = resolutions
+        self.lock = Lock()
+        self.sources = {}  # المصدر ← {الدقة: BucketRing}
+
+    def add(self, source, ts, sums, maxes, count):
+        """إضافة إحصائيات مجمعة (أو إطار واحد بعدد 1) إلى كل الدقات"""
+        with self.lock:
+            rings = self.sources.get(source)
+            if rings is None:
+                rings = {name: BucketRing(seconds, slots)
+                         for name, (seconds, slots) in self.resolutions.items()}
+                self.sources[source] = rings
+            for ring in rings.values():
+                ring.add(ts, sums, maxes, count)
+
+    def record(self, source, stats, ts=None):
+        """إضافة إحصائيات إطار واحد"""
+        values = stats_vector(stats)
+        self.add(source, time.time() if ts is None else ts, values, values, 1)
+
+    def query(self, source=None, resolution='1m', since=None, until=None, percentiles=(50, 95, 99)):
+        """
+        سلسلة زمنية ومئينات لمصدر أو لجميع المصادر
+
+        المعلمات:
+            source: اسم المصدر (None لجميع المصادر)
+            resolution: '1s' أو '1m' أو '1h'
+            since / until: حدود النطاق بالثواني (افتراضيًا آخر 60 حاوية)
+            percentiles: المئينات المحسوبة على متوسطات الحاويات غير الفارغة
+
+        الإرجاع:
+            قاموس timestamps و frames وسلاسل avg و max لكل مقياس والمئينات
+        """
+        if resolution not in self.resolutions:
+            raise ValueError(f"دقة غير مدعومة: {resolution}")
+
+        seconds = self.resolutions[resolution][0]
+        until = time.time() if until is None else until
+        since = until - 60 * seconds if since is None else since
+
+        with self.lock:
+            names = list(self.sources) if source is None else [source]
+            windows = [self.sources[name][resolution].window(since, until)
+                       for name in names if name in self.sources]
+
+        if windows:
+            timestamps = windows[0][0]
+            # متوسط كل مصدر لكل إطار، ثم جمع المصادر (مثل عدد الأشخاص في كل الكاميرات)
+            avg = sum(w[1] / np.maximum(w[3], 1)[:, None] for w in windows)
+            peak = np.max([w[2] for w in windows], axis=0)
+            frames = np.sum([w[3] for w in windows], axis=0)
+        else:
+            last = int(until // seconds)
+            first = max(int(since // seconds), last - self.resolutions[resolution][1] + 1)
+            timestamps = np.arange(first, last + 1, dtype=np.int64) * seconds
+            avg = np.zeros((len(timestamps), len(METRICS)))
+            peak = np.zeros_like(avg)
+            frames = np.zeros(len(timestamps), dtype=np.int64)
+
+        filled = frames > 0
+        series = {}
+        for i, name in enumerate(METRICS):
+            values = avg[filled, i]
+            series[name] = {
+                'avg': np.round(avg[:, i], 3).tolist(),
+                'max': peak[:, i].tolist(),
+                'percentiles': {
+                    f"p{p}": round(float(np.percentile(values, p)), 3) if len(values) else 0.0
+                    for p in percentiles
+                }
+            }
+
+        return {
+            'source': source,
+            'resolution': resolution,
+            'timestamps': timestamps.tolist(),
+            'frames': frames.tolist(),
+            'metrics': series
+        }
+
+    def list_sources(self):
+        with self.lock:
+            return sorted(self.sources)
+
+    def memory_bytes(self):
+        """الذاكرة المخصصة لكل الحلقات"""
+        with self.lock:
+            return sum(ring.ids.nbytes + ring.sums.nbytes + ring.maxes.nbytes + ring.counts.nbytes
+                       for rings in self.sources.values() for ring in rings.values())
@@ -5,17 +5,30 @@ import numpy as np
 import os
 import sys
 from datetime import datetime
-from threading import Thread, Lock
-from ultralytics import YOLO
+from threading import Thread, Lock, Event, Condition, Timer, get_ident
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from PIL import Image
 import flask
-from flask import Flask, request, render_template, jsonify, send_from_directory
+from flask import Flask, Response, request, render_template, jsonify, send_from_directory
 import base64
 import json
+import gc
 import random
 import uuid
 from flask_socketio import SocketIO, emit
 import logging
+import multiprocessing
+from tracker import MultiObjectTracker, iou_matrix
+from store import EventStore
+from analytics import AnalyticsAggregator, StatsFolder, RESOLUTIONS
+import backends
+from quantize import approved_variant, load_variants
+from profiler import (TraceSession, TRACE_MODES, attach_tracer, load_trace,
+                      chrome_trace, folded_stacks, summarize_trace)
+import subprocess
+import shutil
+import bisect
 
 
 
@@ -63,26 +76,11 @@ for folder in required_folders:
 
 
 
-# محاولة استيراد CLIP
-try:
-    from transformers import CLIPProcessor, CLIPModel
-    USE_OPENAI_CLIP = False
-    logger.info("✅ استخدام CLIPProcessor من transformers")
-except ImportError:
-    try:
-        from transformers import CLIPFeatureExtractor as CLIPProcessor, CLIPModel
-        USE_OPENAI_CLIP = False
-        logger.info("✅ استخدام CLIPFeatureExtractor بدلاً من CLIPProcessor")
-    except ImportError:
-        try:
-            import clip
-            USE_OPENAI_CLIP = True
-            logger.info("✅ استخدام مكتبة CLIP الأصلية من OpenAI")
-        except ImportError:
-            logger.error("❌ فشل استيراد أي إصدار من CLIP. يرجى تثبيت إحدى هذه المكتبات:")
-            logger.error("   pip install transformers pillow torch")
-            logger.error("   أو: pip install git+https://github.com/openai/CLIP.git")
-            USE_OPENAI_CLIP = False
+# مكتبة CLIP تُستورد عند أول تحميل لـ CLIP (انظر import_clip_backend)
+CLIPProcessor = None
+CLIPModel = None
+clip = None
+USE_OPENAI_CLIP = False
 
 
 
@@ -116,10 +114,165 @@ YOLO_IOU = 0.35
 
 
 
+# عمق الطوابير بين مراحل البث (الأقدم يُسقط عند الامتلاء)
+STREAM_QUEUE_SIZE = 1
+
+# مستويات معاينة البث: الاسم ← (أقصى عرض، جودة JPEG)، مرتبة من الأصغر للأكبر
+# None يعني العرض الأصلي للإطار
+PREVIEW_TIERS = {
+    'thumbnail': (320, 50),
+    'single': (960, 65),
+    'fullscreen': (None, 70),
+}
+DEFAULT_PREVIEW_TIER = 'fullscreen'  # يطابق الإرسال السابق بالدقة الكاملة
+PREVIEW_MAX_BACKLOG = 3  # تأخر الإرسال أو التأكيد (بعدد فترات الإطار) قبل خفض مستوى العميل
+PREVIEW_RECOVER_SECONDS = 5.0  # مدة بلا ازدحام قبل رفع المستوى خطوة
+
+# طابور الإرسال لكل عميل: إطارات معلقة لكل بث (الأحدث يفوز) فوق إطار واحد قيد الإرسال
+CLIENT_QUEUE_SIZE = 1
+CLIENT_ACK_TIMEOUT = 2.0  # ثوانٍ قبل اعتبار الإطار المرسل مفقودًا
+
+
+
+
+# عدد عمليات معالجة الفيديو المرفوع (0 = مؤشر ترابط داخل عملية الخادم)
+UPLOAD_WORKERS = 0
+
+
+
+
+# خطوة الاستدلال: تشغيل الكشف كل N إطار ونقل المربعات إلى الإطارات المتخطاة
+INFERENCE_STRIDE = 1
+ADAPTIVE_STRIDE = False          # زيادة الخطوة للمشاهد الثابتة والعودة إلى 1 عند الحركة
+ADAPTIVE_STRIDE_MAX = 5
+STRIDE_MOTION_THRESHOLD = 0.02   # متوسط الفرق بين الإطارات (0-1) الذي يعد حركة
+STRIDE_FLOW_WIDTH = 320          # عرض الصورة الرمادية للتدفق البصري
+
+
+
+
+# المتتبع متعدد الأجسام (معرفات ثابتة للعد الفريد وإلغاء تكرار الالتقاطات)
+TRACK_IOU_THRESHOLD = 0.3
+TRACK_MAX_AGE = 30   # عدد الاستدلالات بدون مطابقة قبل حذف المسار
+TRACK_MIN_HITS = 3   # عدد المطابقات لتأكيد المسار
+
+
+
+
+# ذاكرة أحكام القناع لكل شخص (تخطي Haar و CLIP للأشخاص المصنفين حديثًا)
+MASK_CACHE_TTL = 10.0            # ثوانٍ منذ آخر ظهور قبل الحذف
+MASK_CACHE_REFRESH = 5.0         # إعادة التصنيف دوريًا حتى لو لم يتغير شيء
+MASK_CACHE_EMPTY_REFRESH = 0.5   # إعادة Haar للأشخاص بدون وجه ظاهر
+MASK_CACHE_MIN_CONF = 0.7        # الأحكام الأقل ثقة يُعاد تصنيفها
+MASK_CACHE_CHANGE = 0.12         # متوسط فرق بصمة الوجه (0-1) الذي يعد تغيرًا
+MASK_CACHE_IOU = 0.5             # مطابقة الأشخاص غير المتتبعين بالإطار السابق
+
+
+
+
+# بوابة الحركة للبث: تخطي الكشف في الإطارات الخالية من الحركة
+MOTION_GATING = True
+MOTION_GATE_THRESHOLD = 0.002   # نسبة البكسلات المتحركة التي تفتح البوابة
+MOTION_GATE_WIDTH = 160         # عرض الصورة المصغرة لطرح الخلفية
+MOTION_GATE_REFRESH = 2.0       # ثوانٍ: أقصى مدة بدون كشف حتى في غياب الحركة
+MOTION_ROI_MAX_FRACTION = 0.35  # الكشف داخل منطقة الحركة فقط إذا كانت أصغر من هذه النسبة
+
+
+
+
+# تقسيم الفيديو الطويل إلى مقاطع تُعالج بالتوازي (1 = معالجة متسلسلة)
+CHUNK_WORKERS = 1
+CHUNK_MIN_SECONDS = 300  # الحد الأدنى لمدة الفيديو لتفعيل التقسيم
+
+
+
+
+# مجدول الاستدلال المشترك: دفعة YOLO واحدة لكل البثوث والمهام
+YOLO_BATCHING = True
+YOLO_MAX_BATCH = 16
+YOLO_MAX_LATENCY = 0.02  # ثوانٍ انتظار قصوى لاكتمال الدفعة
+
+# كتابة صور الالتقاط في الخلفية
+CAPTURE_WRITERS = 2  # عدد مؤشرات ترابط الكتابة
+CAPTURE_QUEUE_SIZE = 64  # أقصى عدد التقاطات تنتظر الكتابة
+CAPTURE_OVERFLOW = 'drop_oldest'  # عند الامتلاء: drop_oldest أو drop_newest أو block
+
+# مقاطع التنبيهات من ذاكرة حلقية لإطارات كل بث (مرمّزة JPEG)
+CLIP_RECORDING = True
+CLIP_PRE_SECONDS = 5.0  # ثوانٍ قبل التنبيه
+CLIP_POST_SECONDS = 5.0  # ثوانٍ بعد التنبيه
+CLIP_MAX_SECONDS = 30.0  # أقصى طول للمقطع عند تمديده بتنبيهات متتالية
+CLIP_BUFFER_MAX_BYTES = 32 * 1024 * 1024  # حد ذاكرة الإطارات لكل كاميرا
+CLIP_WIDTH = 640  # أقصى عرض لإطارات المقطع
+CLIP_QUALITY = 60  # جودة JPEG للإطارات المخزنة
+CLIP_QUEUE_SIZE = 8  # أقصى عدد مقاطع تنتظر الكتابة
+CLIP_RECORD_QUEUE_SIZE = 4  # إطارات تنتظر الترميز للذاكرة الحلقية (يُسقط الأقدم)
+
+# المخزن الدائم للمهام والبثوث والتنبيهات
+STORE_BATCH_SIZE = 200  # أقصى عدد سجلات في المعاملة الواحدة
+STORE_FLUSH_INTERVAL = 0.5  # ثوانٍ قبل كتابة الدفعة غير المكتملة
+STORE_PAGE_MAX = 500  # أقصى حجم صفحة في واجهات الاستعلام
+
+# مصدر إحصائيات مشترك لكل مهام الفيديو المرفوع (الكاميرات مصادر مستقلة)
+UPLOADS_ANALYTICS_SOURCE = 'uploads'
+
+# تحميل النماذج: بالتوازي في الخلفية عند بدء الخادم، وكل نموذج عند أول حاجة إليه
+PRELOAD_MODELS = True
+MASK_DETECTION = True  # بدون كشف القناع لا يُحمّل CLIP ولا Haar
+MODEL_LOAD_WORKERS = 3
+
+# ملفات النماذج: يختار كل بث أو مهمة ملفًا، ومكونات الملف تُحمّل مرة واحدة
+# وتُشارك بين مستخدميها بعدّ المراجع (CLIP و Haar مشتركان بين كل الملفات)
+MODEL_PROFILES = {
+    'nano': {'yolo': 'yolov8n.pt', 'clip': False, 'imgsz': 480},
+    'small': {'yolo': 'yolov8s.pt', 'clip': True, 'imgsz': 640},
+    'xlarge': {'yolo': 'yolov8x.pt', 'clip': True, 'imgsz': 640}
+}
+DEFAULT_MODEL_PROFILE = 'xlarge'  # يطابق التحميل السابق (YOLOv8x مع CLIP)
+MODEL_IDLE_UNLOAD = 300.0  # ثوانٍ بدون مستخدمين قبل تفريغ المكون (0 = بدون تفريغ)
+
+# خلفية الاستدلال على المعالج: 'torch' أو 'onnx' أو 'torchscript' أو 'openvino'
+# (على GPU تبقى PyTorch دائمًا)
+INFERENCE_BACKEND = 'torch'
+INFERENCE_THREADS = 0  # مؤشرات الترابط داخل العملية للخلفية (0 = نفس عدد مؤشرات torch)
+BACKEND_IMGSZ = 640  # حجم إدخال YOLO للملفات التي لا تحدد 'imgsz'
+BACKEND_PARITY_CHECK = True  # مقارنة النموذج المُصدّر مع PyTorch عند أول تصدير
+PARITY_MAX_IMAGES = 16  # عدد الصور المرجعية للفحص
+
+# نسخ INT8 المعتمدة ببوابة الدقة (تُنشأ بـ quantize.py)؛ None للنموذج الكامل
+# (YOLO_VARIANT للملف الافتراضي، والملفات الأخرى تحدد 'variant' بنفسها)
+YOLO_VARIANT = None
+CLIP_VARIANT = None
+
+# مراحل مدرجات مهام الفيديو في /metrics وعدد المهام المحتفظ بها
+TASK_STAGES = ('decode', 'resize', 'yolo', 'haar', 'clip', 'flow', 'draw', 'encode', 'emit')
+TASK_METRICS_KEEP = 50
+
+# تتبع الأداء عند الطلب لبث أو مهمة
+TRACE_MAX_SECONDS = 120  # أقصى مدة لجلسة التتبع
+TRACE_DEFAULT_SECONDS = 10
+TRACE_SAMPLE_INTERVAL = 0.005  # الفاصل بين عينات المكدس في وضع 'sampling'
+
+
+
+
 # تحديد المجلدات الإضافية
 UPLOADS_FOLDER = os.path.join(parent_dir, "static/uploads")
 PROCESSED_FOLDER = os.path.join(parent_dir, "static/processed")
 CAPTURES_FOLDER = os.path.join(parent_dir, "static/captures")
+CLIPS_FOLDER = os.path.join(parent_dir, "static/clips")
+
+
+
+
+# ذاكرة النماذج والمتجهات المحسوبة مسبقًا
+MODEL_CACHE_DIR = os.path.join(parent_dir, "models_cache")
+CLIP_CACHE_DIR = os.path.join(MODEL_CACHE_DIR, "clip")  # نسخ CLIP محفوظة محليًا (بدون الشبكة عند إعادة التشغيل)
+BACKENDS_CACHE_DIR = os.path.join(MODEL_CACHE_DIR, "backends")  # نماذج ONNX / TorchScript / OpenVINO المُصدّرة
+VARIANTS_PATH = os.path.join(MODEL_CACHE_DIR, "variants.json")  # سجل النسخ المكممة وتقارير بوابة الدقة
+STORE_PATH = os.path.join(parent_dir, "surveillance.db")
+TRACES_FOLDER = os.path.join(parent_dir, "traces")  # نتائج جلسات التتبع (ليست ضمن static)
+TRACE_REQUESTS_FOLDER = os.path.join(TRACES_FOLDER, "requests")  # طلبات تتبع المهام لعمليات العمال
 
 
 
@@ -128,6 +281,10 @@ CAPTURES_FOLDER = os.path.join(parent_dir, "static/captures")
 os.makedirs(UPLOADS_FOLDER, exist_ok=True)
 os.makedirs(PROCESSED_FOLDER, exist_ok=True)
 os.makedirs(CAPTURES_FOLDER, exist_ok=True)
+os.makedirs(CLIPS_FOLDER, exist_ok=True)
+os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+os.makedirs(CLIP_CACHE_DIR, exist_ok=True)
+os.makedirs(TRACE_REQUESTS_FOLDER, exist_ok=True)
 
 
 
@@ -143,6 +300,14 @@ WEAPON_CLASSES = {43: "Knife", 76: "Scissors"}
 # تسميات CLIP - تم تغيير الترتيب
 CLIP_LABELS = ["face with mask", "face without mask"]
 
+# الحد الأقصى لعدد الوجوه في تمرير CLIP واحد
+MASK_BATCH_SIZE = 32
+
+# مجموعات تسميات التصنيف الصفري (تُرمّز مرة واحدة عند التحميل)
+ZERO_SHOT_PROMPTS = {
+    'mask': CLIP_LABELS,
+}
+
 
 
 
@@ -161,6 +326,10 @@ C_BLACK = (0, 0, 0)
 
 # متغيرات عالمية للنماذج
 global_models = None
+model_loader = None
+models_lock = Lock()
+model_backends = {}  # المكون ← معلومات الخلفية المستخدمة وتقرير فحص التطابق
+server_started = time.time()
 
 
 
@@ -171,11 +340,44 @@ tasks = {}
 
 
 
+# مجمع عمليات معالجة الفيديو المرفوع
+upload_pool = None
+upload_pool_lock = Lock()
+worker_events = None  # طابور الأحداث إلى العملية الرئيسية (داخل عمليات العمال فقط)
+segment_pool = None
+segment_progress = {}  # تقدم مقاطع كل مهمة مقسمة
+capture_writer = None
+clip_writer = None
+capture_writer_lock = Lock()
+event_store = None  # يُنشأ في العملية الرئيسية فقط
+event_store_lock = Lock()
+analytics_aggregator = AnalyticsAggregator()  # حاويات الإحصائيات الزمنية (تُملأ في العملية الرئيسية)
+task_metrics = {}  # مدرجات مراحل مهام الفيديو: task_id ← {part: {stage: state}}
+task_metrics_lock = Lock()
+connected_clients = set()  # جلسات Socket.IO المتصلة
+trace_sessions = {}  # جلسات التتبع في هذه العملية: trace_id ← TraceSession
+trace_lock = Lock()
+
+
+
+
 # حالة البث
 stream_active = False
 stream_thread = None
 stream_lock = Lock()
 active_streams = {}  # تتبع عدة بث
+stream_pipelines = {}  # خطوط المعالجة المرحلية لكل بث
+stream_subscribers = {}  # اشتراكات Socket.IO لكل بث: stream_id ← {sid: StreamSubscription}
+subscription_lock = Lock()
+client_senders = {}  # طوابير الإرسال لكل عميل: sid ← ClientSender
+retired_client_stats = {'sent': 0, 'dropped': 0, 'timeouts': 0, 'lag': None}  # عدادات العملاء المنقطعين (لـ /metrics)
+
+
+
+
+# مجدولات الاستدلال المشتركة (واحد لكل نموذج YOLO)
+inference_schedulers = {}
+scheduler_lock = Lock()
 
 
 
@@ -212,6 +414,256 @@ def enhance_face(face_img):
 
 
 
+def extract_face_crops(face_detector, frame, persons):
+    """
+    استخراج جميع وجوه الإطار من مربعات الأشخاص وتجهيزها لـ CLIP
+    
+    المعلمات:
+        face_detector: مصنف Haar للوجوه
+        frame: الإطار الحالي
+        persons: قائمة مربعات الأشخاص (x1, y1, x2, y2)
+    
+    الإرجاع:
+        (مربعات الوجوه بإحداثيات الإطار، صور الوجوه بصيغة PIL، فهرس الشخص لكل وجه)
+    """
+    face_boxes = []
+    face_crops = []
+    face_owners = []
+    
+    for person_idx, (px1, py1, px2, py2) in enumerate(persons):
+        roi = frame[py1:py2, px1:px2]
+        if roi.size == 0:
+            continue
+        
+        gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
+        faces = face_detector.detectMultiScale(gray, 1.15, 3, minSize=(25, 25))
+        
+        for (fx, fy, fw, fh) in faces:
+            if fw < 30:
+                continue
+            
+            face = roi[fy:fy+fh, fx:fx+fw]
+            if face.size < 400:
+                continue
+            
+            # تحسين الصورة
+            face = enhance_face(face)
+            
+            small = cv2.resize(face, (56, 56))
+            rgb = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
+            
+            face_boxes.append((px1+fx, py1+fy, px1+fx+fw, py1+fy+fh))
+            face_crops.append(Image.fromarray(rgb))
+            face_owners.append(person_idx)
+    
+    return face_boxes, face_crops, face_owners
+
+
+
+
+def encode_clip_text(models, labels):
+    """
+    ترميز تسميات CLIP النصية مرة واحدة وإرجاع المتجهات الموحّدة
+    
+    المعلمات:
+        models: قاموس النماذج (clip_model، clip_proc، device، use_openai_clip)
+        labels: قائمة التسميات النصية
+    
+    الإرجاع:
+        موتر بحجم (عدد التسميات، البعد) بطول وحدة لكل صف
+    """
+    clip_model = models['clip_model']
+    device = models['device']
+    
+    with torch.no_grad():
+        if models['use_openai_clip']:
+            text = clip.tokenize(labels).to(device)
+            features = clip_model.encode_text(text)
+        else:
+            inputs = models['clip_proc'](
+                text=labels, return_tensors="pt", padding=True
+            ).to(device)
+            features = clip_model.get_text_features(**inputs)
+    
+    return features / features.norm(dim=-1, keepdim=True)
+
+
+
+
+def encode_clip_images(models, images):
+    """
+    ترميز دفعة من الصور بمُرمّز صور CLIP وإرجاع المتجهات الموحّدة
+    
+    المعلمات:
+        models: قاموس النماذج
+        images: قائمة صور بصيغة PIL
+    
+    الإرجاع:
+        موتر بحجم (عدد الصور، البعد) بطول وحدة لكل صف
+    """
+    clip_model = models['clip_model']
+    clip_proc = models['clip_proc']
+    device = models['device']
+    
+    with torch.no_grad():
+        if models['use_openai_clip']:
+            # استخدام OpenAI CLIP الأصلي
+            batch = torch.stack([clip_proc(pil) for pil in images]).to(device)
+            features = clip_model.encode_image(batch)
+        else:
+            # استخدام HuggingFace transformers CLIP
+            inputs = clip_proc(images=images, return_tensors="pt").to(device)
+            features = clip_model.get_image_features(**inputs)
+    
+    return features / features.norm(dim=-1, keepdim=True)
+
+
+
+
+class ZeroShotLabelRegistry:
+    """
+    سجل متجهات نصوص CLIP لكل مجموعة تسميات (قناع، خوذة، سترة...)
+    
+    تُحسب المتجهات مرة واحدة عند load_models وتُحفظ على القرص لكل اسم نموذج،
+    فلا تدفع عمليات إعادة التشغيل كلفة مُرمّز النصوص مرة أخرى.
+    """
+    
+    def __init__(self, model_name, cache_dir):
+        self.model_name = model_name
+        self.cache_path = os.path.join(
+            cache_dir, f"clip_labels_{model_name.replace('/', '_')}.pt"
+        )
+        self.prompt_sets = {}
+        self.features = {}
+        self.lock = Lock()
+    
+    def _read_cache(self):
+        """قراءة المتجهات المحفوظة لهذا النموذج من القرص"""
+        if not os.path.exists(self.cache_path):
+            return {}
+        try:
+            cached = torch.load(self.cache_path, map_location='cpu')
+            if cached.get('model') != self.model_name:
+                return {}
+            return cached.get('sets', {})
+        except Exception as e:
+            logger.warning(f"⚠️ تعذر قراءة ذاكرة تسميات CLIP: {str(e)}")
+            return {}
+    
+    def _write_cache(self):
+        """حفظ جميع المتجهات الحالية على القرص"""
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            sets = {
+                name: {'labels': self.prompt_sets[name], 'features': features.cpu()}
+                for name, features in self.features.items()
+            }
+            tmp_path = self.cache_path + ".tmp"
+            torch.save({'model': self.model_name, 'sets': sets}, tmp_path)
+            os.replace(tmp_path, self.cache_path)
+        except Exception as e:
+            logger.warning(f"⚠️ تعذر حفظ ذاكرة تسميات CLIP: {str(e)}")
+    
+    def load(self, models, prompt_sets):
+        """
+        تعبئة السجل من القرص وترميز المجموعات الناقصة أو المتغيرة فقط
+        
+        المعلمات:
+            models: قاموس النماذج
+            prompt_sets: قاموس {اسم المجموعة: قائمة التسميات}
+        """
+        cached = self._read_cache()
+        encoded = 0
+        
+        with self.lock:
+            for name, labels in prompt_sets.items():
+                labels = list(labels)
+                entry = cached.get(name)
+                if entry is not None and entry['labels'] == labels:
+                    features = entry['features']
+                else:
+                    features = encode_clip_text(models, labels)
+                    encoded += 1
+                self.prompt_sets[name] = labels
+                self.features[name] = features.to(models['device'])
+            
+            if encoded:
+                self._write_cache()
+        
+        logger.info(f"✅ سجل تسميات CLIP: {len(prompt_sets)} مجموعة ({encoded} مرمّزة، {len(prompt_sets) - encoded} من القرص)")
+    
+    def register(self, models, name, labels):
+        """إضافة مجموعة تسميات جديدة أثناء التشغيل وحفظها"""
+        features = encode_clip_text(models, list(labels))
+        with self.lock:
+            self.prompt_sets[name] = list(labels)
+            self.features[name] = features
+            self._write_cache()
+    
+    def get(self, name):
+        """إرجاع (التسميات، المتجهات) لمجموعة مسجلة"""
+        return self.prompt_sets[name], self.features[name]
+
+
+
+
+def zero_shot_classify(models, set_name, images):
+    """
+    تصنيف دفعة من الصور مقابل مجموعة تسميات مسجلة
+    
+    التصنيف مجرد ترميز للصور ثم ضرب مصفوفات مع المتجهات النصية المخزنة.
+    
+    المعلمات:
+        models: قاموس النماذج
+        set_name: اسم مجموعة التسميات في السجل
+        images: قائمة صور بصيغة PIL
+    
+    الإرجاع:
+        قائمة (فهرس التسمية، الثقة) بنفس ترتيب الصور
+    """
+    if not images:
+        return []
+    
+    clip_model = models['clip_model']
+    _, text_features = models['label_registry'].get(set_name)
+    
+    results = []
+    for start in range(0, len(images), MASK_BATCH_SIZE):
+        image_features = encode_clip_images(models, images[start:start + MASK_BATCH_SIZE])
+        
+        with torch.no_grad():
+            logits = clip_model.logit_scale.exp() * image_features @ text_features.T.to(image_features.dtype)
+            probs = logits.softmax(dim=-1)
+        
+        confs, idxs = probs.max(dim=-1)
+        results.extend(zip(idxs.tolist(), confs.tolist()))
+    
+    return results
+
+
+
+
+def classify_masks(models, face_crops):
+    """
+    تصنيف القناع لدفعة من الوجوه بتمرير أمامي واحد لمُرمّز الصور
+    
+    يمكن أن تأتي الوجوه من إطار واحد أو من عدة إطارات.
+    
+    المعلمات:
+        models: قاموس النماذج
+        face_crops: قائمة صور الوجوه بصيغة PIL
+    
+    الإرجاع:
+        قائمة (has_mask, conf) بنفس ترتيب الوجوه
+    """
+    return [
+        (idx == 0, conf)  # الفهرس 0 هو "face with mask"
+        for idx, conf in zero_shot_classify(models, 'mask', face_crops)
+    ]
+
+
+
+
 def draw_box(frame, x1, y1, x2, y2, color, label, thickness, font_scale, font_thick):
     try:
         cv2.rectangle(frame, (x1, y1), (x2, y2), color, thickness)
@@ -265,178 +717,2603 @@ def draw_alert(frame, alert_type, blink):
 
 
 
-def capture_frame(frame, detection_type, bbox):
+def empty_stats():
+    """إحصائيات إطار فارغة"""
+    return {
+        'persons': 0,
+        'bags': 0,
+        'mask': 0,
+        'no_mask': 0,
+        'weapons': 0,
+        'drones': 0  # مكان، غير منفذ في هذه النسخة
+    }
+
+
+
+
+def parse_detections(results, scale_x=1.0, scale_y=1.0, offset_x=0, offset_y=0):
     """
-    التقاط وحفظ إطار مع الكشف
+    تحويل نتائج YOLO إلى قائمة كشوفات الفئات التي تهمنا
     
     المعلمات:
-        frame: الإطار الحالي
-        detection_type: نوع الكشف (Knife/Person/إلخ)
-        bbox: إحداثيات الكشف (x1, y1, x2, y2)
+        results: نتائج YOLO (كل عنصر يحتوي على r.boxes)
+        scale_x, scale_y: عوامل التحجيم إلى دقة الإطار الأصلي
+        offset_x, offset_y: إزاحة الصورة المكشوفة داخل الإطار (عند الكشف على جزء منه)
     
     الإرجاع:
-        مسار الملف المحفوظ
+        قائمة قواميس {kind, label, cls, conf, box}
     """
-    try:
-        # إنشاء اسم الملف مع الطابع الزمني
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
-        filename = f"{detection_type}_{timestamp}.jpg"
-        filepath = os.path.join(CAPTURES_FOLDER, filename)
-        
-        # حفظ الصورة الكاملة مع صندوق أحمر
-        x1, y1, x2, y2 = bbox
-        frame_copy = frame.copy()
-        
-        # رسم مربع أحمر حول الكشف
-        cv2.rectangle(frame_copy, (x1, y1), (x2, y2), (0, 0, 255), 4)
-        
-        # إضافة نص تحذير
-        cv2.putText(frame_copy, f"DETECTED: {detection_type}", (x1, y1 - 15),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
-        
-        # إضافة الطابع الزمني إلى الصورة
-        time_text = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        cv2.putText(frame_copy, time_text, (10, frame_copy.shape[0] - 20),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
-        
-        # حفظ الصورة
-        cv2.imwrite(filepath, frame_copy)
-        
-        logger.info(f"⚠️  تم التقاط {detection_type}: {filepath}")
+    detections = []
+    
+    for r in results:
+        if r.boxes is None:
+            continue
         
-        # إرسال تنبيه إلى العملاء المتصلين
-        alert_data = {
-            'type': detection_type,
-            'path': f"/static/captures/{filename}",
-            'confidence': 98,  # مكان
-            'timestamp': datetime.now().strftime("%H:%M:%S")
+        for box in r.boxes:
+            cid = int(box.cls[0])
+            
+            if cid in BAG_IDS:
+                kind, label = 'bag', BAG_IDS[cid]
+            elif cid == PERSON_ID:
+                kind, label = 'person', 'Person'
+            elif cid in WEAPON_CLASSES:
+                kind, label = 'weapon', WEAPON_CLASSES[cid]
+            else:
+                continue
+            
+            # تغيير حجم الإحداثيات إلى الدقة الأصلية
+            x1 = int(box.xyxy[0][0] * scale_x) + offset_x
+            y1 = int(box.xyxy[0][1] * scale_y) + offset_y
+            x2 = int(box.xyxy[0][2] * scale_x) + offset_x
+            y2 = int(box.xyxy[0][3] * scale_y) + offset_y
+            
+            detections.append({
+                'kind': kind,
+                'label': label,
+                'cls': cid,
+                'conf': float(box.conf[0]),
+                'box': (x1, y1, x2, y2)
+            })
+    
+    return detections
+
+
+
+
+class StageMetrics:
+    """زمن معالجة مرحلة واحدة: آخر قيمة ومتوسط متحرك ومدرج تكراري (بأسلوب Prometheus)"""
+    
+    # الحدود العليا لخانات المدرج بالثواني (الخانة الأخيرة لما يتجاوزها)
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    
+    def __init__(self):
+        self.count = 0
+        self.last_ms = 0.0
+        self.avg_ms = 0.0
+        self.total = 0.0
+        self.buckets = [0] * (len(self.BUCKETS) + 1)
+        self.tracer = None  # دالة تسجيل جلسة تتبع نشطة (انظر attach_tracer)
+    
+    def record(self, seconds):
+        if self.tracer is not None:
+            self.tracer(seconds)
+        ms = seconds * 1000
+        self.count += 1
+        self.last_ms = ms
+        # متوسط متحرك أسي لتجنب تخزين كل القيم
+        self.avg_ms = ms if self.count == 1 else self.avg_ms * 0.9 + ms * 0.1
+        self.total += seconds
+        self.buckets[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+    
+    def state(self):
+        """حالة المدرج القابلة للنقل بين العمليات والدمج"""
+        return {'buckets': list(self.buckets), 'sum': self.total, 'count': self.count}
+    
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'last_ms': round(self.last_ms, 2),
+            'avg_ms': round(self.avg_ms, 2)
         }
-        socketio.emit('alert', alert_data)
-        
-        return f"/static/captures/{filename}"
-    except Exception as e:
-        logger.error(f"خطأ في التقاط الإطار: {str(e)}")
-        return ""
 
 
 
 
-def load_models():
-    """تحميل جميع نماذج الكشف"""
-    global global_models
+class InferenceScheduler:
+    """
+    مجدول استدلال مشترك يجمع إطارات جميع البثوث والمهام في دفعة YOLO واحدة
     
-    # إذا كانت النماذج محملة بالفعل، أعدها
-    if global_models is not None:
-        return global_models
+    تنتظر الدفعة حتى يرسل كل مستدعٍ نشط إطاره الأحدث، أو حتى YOLO_MAX_BATCH،
+    أو حتى انقضاء YOLO_MAX_LATENCY منذ أقدم طلب، أيها أسبق.
+    لكل نموذج وحجم إدخال (imgsz) مجدول مستقل.
+    """
+    
+    def __init__(self, yolo, max_batch=YOLO_MAX_BATCH, max_latency=YOLO_MAX_LATENCY, imgsz=None):
+        self.yolo = yolo
+        self.imgsz = imgsz
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.pending = []  # (image, future, submitted_at)
+        self.recent = {}   # آخر وقت إرسال لكل مستدعٍ
+        self.cond = Condition()
+        self.closed = False
+        self.batches = 0
+        self.frames = 0
+        self.last_batch_size = 0
+        self.wait = StageMetrics()
+        self.infer = StageMetrics()
         
-    logger.info("=" * 70)
-    logger.info("   🔍 نظام المراقبة الشامل - وحدة تحليل الفيديو")
-    logger.info("=" * 70)
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
     
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    logger.info(f"🖥️  الجهاز: {device.upper()}")
-    logger.info("-" * 70)
+    def submit(self, image, caller=None):
+        """إضافة صورة إلى الدفعة التالية وإرجاع Future بنتائجها"""
+        future = Future()
+        now = time.time()
+        with self.cond:
+            self.pending.append((image, future, now))
+            self.recent[caller if caller is not None else get_ident()] = now
+            self.cond.notify()
+        return future
     
-    # تحميل YOLOv8
-    logger.info("⏳ 1/2: تحميل YOLOv8 (الأشخاص + الحقائب + الأسلحة)...")
-    yolo_path = os.path.join(parent_dir, "yolov8x.pt")
-    try:
-        if os.path.exists(yolo_path):
-            logger.info(f"تم العثور على ملف yolo: {yolo_path}")
-            yolo = YOLO(yolo_path)
-            logger.info("✅ تم تحميل YOLOv8x!")
-        else:
-            logger.warning(f"ملف yolo غير موجود في: {yolo_path}, استخدام نموذج مضمن...")
-            yolo = YOLO("yolov8n.pt")
-            logger.info("✅ تم تحميل YOLOv8n!")
-    except Exception as e:
-        logger.error(f"خطأ في تحميل YOLO: {str(e)}")
-        logger.warning("⚠️ YOLOv8x غير متوفر، استخدام YOLOv8n...")
-        yolo = YOLO("yolov8n.pt")
-        logger.info("✅ تم تحميل YOLOv8n!")
+    def detect(self, image, caller=None):
+        """إرسال صورة وانتظار نتائجها (بنفس شكل استدعاء YOLO المباشر)"""
+        return self.submit(image, caller).result()
     
-    # تحميل CLIP وتسلسل الوجه
-    logger.info("⏳ 2/2: تحميل CLIP + Haar Cascade (الأقنعة)...")
-    face_cascade = cv2.CascadeClassifier(
-        cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
-    )
+    def _active_callers(self, now):
+        # المستدعون الذين أرسلوا خلال الثانية الأخيرة
+        for caller, last_seen in list(self.recent.items()):
+            if now - last_seen > 1.0:
+                del self.recent[caller]
+        return max(1, len(self.recent))
     
-    clip_model = None
-    clip_proc = None
-    use_openai_clip = False
+    def _next_batch(self):
+        with self.cond:
+            while not self.pending and not self.closed:
+                self.cond.wait()
+            if not self.pending:
+                return []
+            
+            deadline = self.pending[0][2] + self.max_latency
+            while len(self.pending) < min(self.max_batch, self._active_callers(time.time())):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            
+            batch = self.pending[:self.max_batch]
+            self.pending = self.pending[self.max_batch:]
+            return batch
     
-    try:
-        if USE_OPENAI_CLIP:
-            # استخدام OpenAI CLIP الأصلي
-            clip_model, clip_proc = clip.load("ViT-L/14", device=device)
-            logger.info("✅ تم تحميل CLIP-Large (OpenAI)!")
-            use_openai_clip = True
-        else:
+    def _run(self):
+        options = {'imgsz': self.imgsz} if self.imgsz else {}
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                break
+            start = time.time()
+            
             try:
-                clip_proc = CLIPProcessor.from_pretrained("openai/clip-vit-large-patch14")
-                clip_model = CLIPModel.from_pretrained("openai/clip-vit-large-patch14")
-                logger.info("✅ تم تحميل CLIP-Large (Transformers)!")
+                results = self.yolo([item[0] for item in batch],
+                                    conf=YOLO_CONF, iou=YOLO_IOU, verbose=False, **options)
             except Exception as e:
-                logger.warning(f"⚠️ CLIP-Large غير متوفر: {str(e)}, استخدام CLIP-Base...")
-                clip_proc = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-                clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-                logger.info("✅ تم تحميل CLIP-Base (Transformers)!")
-    except Exception as e:
-        logger.error(f"❌ فشل تحميل CLIP: {str(e)}")
-        logger.warning("⚠️ المتابعة بدون كشف القناع...")
-    
-    if not use_openai_clip and clip_model is not None:
-        clip_model.to(device).eval()
-    
-    logger.info("-" * 70)
-    logger.info("✅ تم تحميل جميع النماذج!")
-    logger.info("=" * 70)
+                logger.error(f"خطأ في دفعة YOLO المشتركة: {str(e)}")
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            
+            self.infer.record(time.time() - start)
+            self.batches += 1
+            self.frames += len(batch)
+            self.last_batch_size = len(batch)
+            
+            for (_, future, submitted_at), result in zip(batch, results):
+                self.wait.record(start - submitted_at)
+                future.set_result([result])
     
-    global_models = {
-        'yolo': yolo,
-        'face_cascade': face_cascade,
-        'clip_model': clip_model,
-        'clip_proc': clip_proc,
-        'device': device,
-        'use_openai_clip': use_openai_clip
-    }
+    def close(self):
+        """إيقاف المؤشر بعد تنفيذ الطلبات المعلقة (عند تفريغ النموذج)"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
     
-    return global_models
+    def snapshot(self):
+        return {
+            'imgsz': self.imgsz,
+            'batches': self.batches,
+            'frames': self.frames,
+            'avg_batch_size': round(self.frames / self.batches, 2) if self.batches else 0,
+            'last_batch_size': self.last_batch_size,
+            'pending': len(self.pending),
+            'active_callers': len(self.recent),
+            'queue_wait': self.wait.snapshot(),
+            'inference': self.infer.snapshot()
+        }
+
 
 
 
+def get_inference_scheduler(yolo, imgsz=None):
+    """إرجاع المجدول المشترك لنموذج YOLO وحجم إدخال معينين (يُنشأ عند أول استخدام)"""
+    key = (id(yolo), imgsz)
+    with scheduler_lock:
+        scheduler = inference_schedulers.get(key)
+        if scheduler is None:
+            scheduler = InferenceScheduler(yolo, imgsz=imgsz)
+            inference_schedulers[key] = scheduler
+        return scheduler
 
-def process_video_thread(video_path, task_id):
+
+
+
+def close_inference_schedulers(yolo):
+    """إيقاف وحذف مجدولات نموذج YOLO تم تفريغه"""
+    with scheduler_lock:
+        for key, scheduler in list(inference_schedulers.items()):
+            if scheduler.yolo is yolo:
+                scheduler.close()
+                del inference_schedulers[key]
+
+
+
+
+def detect_objects(models, image):
+    """تشغيل YOLO على صورة بحجم إدخال ملف النماذج، عبر المجدول المشترك إذا كان التجميع مفعّلًا"""
+    imgsz = models.get('imgsz')
+    if YOLO_BATCHING:
+        return get_inference_scheduler(models['yolo'], imgsz).detect(image)
+    options = {'imgsz': imgsz} if imgsz else {}
+    return models['yolo'](image, conf=YOLO_CONF, iou=YOLO_IOU, verbose=False, **options)
+
+
+
+
+def analyze_frame(models, frame, infer_image=None, scale_x=1.0, scale_y=1.0,
+                  roi=None, tracker=None, mask_cache=None, metrics=None):
     """
-    معالجة ملف فيديو في مؤشر ترابط خلفي وتحديث حالة المهمة
+    تشغيل YOLO ثم كشف القناع على إطار واحد بدون أي رسم
     
     المعلمات:
-        video_path: مسار ملف الفيديو المدخل
-        task_id: معرف المهمة لتتبع التقدم
-    """
-    # تحديث حالة المهمة إلى معالجة
-    tasks[task_id]['status'] = 'processing'
-    tasks[task_id]['progress'] = 0
+        models: قاموس النماذج
+        frame: الإطار الأصلي (تُقتطع منه الوجوه)
+        infer_image: صورة مصغرة اختيارية لـ YOLO (الافتراضي: الإطار نفسه)
+        scale_x, scale_y: عوامل التحجيم من infer_image إلى الإطار
+        roi: منطقة (x1, y1, x2, y2) اختيارية يقتصر عليها YOLO بدلاً من infer_image
+        tracker: متتبع MultiObjectTracker اختياري يعيّن track_id لكل كشف
+        mask_cache: ذاكرة MaskVerdictCache اختيارية لأحكام القناع لكل شخص
+        metrics: قاموس StageMetrics اختياري لتسجيل أزمنة yolo و haar و clip
+    
+    الإرجاع:
+        قاموس {detections, faces, stats}
+    """
+    t0 = time.time()
+    if roi is not None:
+        x1, y1, x2, y2 = roi
+        results = detect_objects(models, frame[y1:y2, x1:x2])
+        detections = parse_detections(results, offset_x=x1, offset_y=y1)
+    else:
+        image = frame if infer_image is None else infer_image
+        results = detect_objects(models, image)
+        detections = parse_detections(results, scale_x, scale_y)
+    if metrics is not None:
+        metrics['yolo'].record(time.time() - t0)
+    
+    if tracker is not None:
+        tracker.update(detections, roi)
+    
+    # كشف القناع إذا كان CLIP متاحًا: جمع كل وجوه الإطار ثم تمرير CLIP واحد
+    faces = []
+    if models['clip_model'] is not None:
+        now = time.time()
+        
+        # الأشخاص ذوو أحكام حديثة في الذاكرة لا يمرون على Haar ولا CLIP
+        pending = []
+        for person in (det for det in detections if det['kind'] == 'person'):
+            cached = mask_cache.lookup(person, frame, now) if mask_cache is not None else None
+            if cached is None:
+                pending.append(person)
+            else:
+                faces.extend(cached)
+        
+        t0 = time.time()
+        face_boxes, face_crops, face_owners = extract_face_crops(
+            models['face_cascade'], frame, [person['box'] for person in pending]
+        )
+        t1 = time.time()
+        verdicts = classify_masks(models, face_crops)
+        if metrics is not None:
+            metrics['haar'].record(t1 - t0)
+            metrics['clip'].record(time.time() - t1)
+        
+        new_faces = [
+            {
+                'box': box,
+                'has_mask': has_mask,
+                'conf': conf,
+                'track_id': pending[owner].get('track_id')
+            }
+            for box, owner, (has_mask, conf) in zip(face_boxes, face_owners, verdicts)
+        ]
+        faces.extend(new_faces)
+        
+        if mask_cache is not None:
+            for idx, person in enumerate(pending):
+                person_faces = [face for face, owner in zip(new_faces, face_owners) if owner == idx]
+                mask_cache.store(person, frame, person_faces, now)
+            mask_cache.evict(now)
+    
+    return {'detections': detections, 'faces': faces, 'stats': summarize_analysis(detections, faces)}
+
+
+
+
+def face_signature(frame, box):
+    """بصمة مصغرة رمادية (16x16) لمنطقة وجه لاكتشاف تغيرها"""
+    x1, y1, x2, y2 = box
+    face = frame[max(0, y1):y2, max(0, x1):x2]
+    if face.size == 0:
+        return None
+    gray = cv2.cvtColor(cv2.resize(face, (16, 16)), cv2.COLOR_BGR2GRAY)
+    return gray.astype(np.float32) / 255
+
+
+
+
+class MaskVerdictCache:
+    """
+    ذاكرة أحكام القناع لكل شخص، بمفتاح معرف المسار أو بمطابقة IoU مع آخر مربع
+    
+    يُعاد استخدام الحكم (ومكان الوجه داخل مربع الشخص) بدون Haar ولا CLIP ما لم:
+    تنخفض الثقة، أو يتغير شكل الوجه كثيرًا، أو تمر فترة التحديث. تُحذف الإدخالات
+    التي لم تُرَ منذ MASK_CACHE_TTL ثانية.
+    """
+    
+    def __init__(self):
+        self.entries = {}
+        self.next_key = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def _key(self, person):
+        track_id = person.get('track_id')
+        if track_id is not None:
+            return ('track', track_id)
+        
+        # مطابقة IoU مع مربعات الأشخاص غير المتتبعين في الإطارات السابقة
+        keys = [key for key in self.entries if key[0] == 'box']
+        if not keys:
+            return None
+        boxes = np.array([self.entries[key]['box'] for key in keys], dtype=np.float64)
+        scores = iou_matrix(np.array([person['box']], dtype=np.float64), boxes)[0]
+        best = int(scores.argmax())
+        return keys[best] if scores[best] >= MASK_CACHE_IOU else None
+    
+    def lookup(self, person, frame, now):
+        """
+        إرجاع وجوه الشخص من الذاكرة إذا كانت صالحة، أو None لإعادة التصنيف
+        """
+        key = self._key(person)
+        entry = self.entries.get(key) if key is not None else None
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        age = now - entry['classified_at']
+        refresh = MASK_CACHE_REFRESH if entry['faces'] else MASK_CACHE_EMPTY_REFRESH
+        if age >= refresh:
+            self.misses += 1
+            return None
+        
+        px1, py1, px2, py2 = person['box']
+        pw, ph = max(1, px2 - px1), max(1, py2 - py1)
+        faces = []
+        for cached in entry['faces']:
+            rx1, ry1, rx2, ry2 = cached['rel']
+            box = (int(px1 + rx1 * pw), int(py1 + ry1 * ph), int(px1 + rx2 * pw), int(py1 + ry2 * ph))
+            signature = face_signature(frame, box)
+            if (cached['conf'] < MASK_CACHE_MIN_CONF or signature is None
+                    or float(np.abs(signature - cached['signature']).mean()) > MASK_CACHE_CHANGE):
+                self.misses += 1
+                return None
+            faces.append({
+                'box': box,
+                'has_mask': cached['has_mask'],
+                'conf': cached['conf'],
+                'track_id': person.get('track_id')
+            })
+        
+        entry['box'] = person['box']
+        entry['seen_at'] = now
+        self.hits += 1
+        return faces
+    
+    def store(self, person, frame, faces, now):
+        """حفظ أحكام وجوه شخص بعد تصنيفها (قائمة فارغة = لا وجه ظاهر)"""
+        key = self._key(person)
+        if key is None:
+            key = ('box', self.next_key)
+            self.next_key += 1
+        
+        px1, py1, px2, py2 = person['box']
+        pw, ph = max(1, px2 - px1), max(1, py2 - py1)
+        cached_faces = []
+        for face in faces:
+            fx1, fy1, fx2, fy2 = face['box']
+            signature = face_signature(frame, face['box'])
+            if signature is None:
+                continue
+            cached_faces.append({
+                'rel': ((fx1 - px1) / pw, (fy1 - py1) / ph, (fx2 - px1) / pw, (fy2 - py1) / ph),
+                'signature': signature,
+                'has_mask': face['has_mask'],
+                'conf': face['conf']
+            })
+        
+        self.entries[key] = {
+            'box': person['box'],
+            'faces': cached_faces,
+            'classified_at': now,
+            'seen_at': now
+        }
+    
+    def evict(self, now):
+        """حذف الإدخالات التي لم تُرَ منذ MASK_CACHE_TTL"""
+        for key in [key for key, entry in self.entries.items() if now - entry['seen_at'] > MASK_CACHE_TTL]:
+            del self.entries[key]
+    
+    def snapshot(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0
+        }
+
+
+
+
+def summarize_analysis(detections, faces):
+    """حساب إحصائيات الإطار من الكشوفات والوجوه"""
+    stats = empty_stats()
+    for det in detections:
+        if det['kind'] == 'bag':
+            stats['bags'] += 1
+        elif det['kind'] == 'person':
+            stats['persons'] += 1
+        elif det['kind'] == 'weapon':
+            stats['weapons'] += 1
+    for face in faces:
+        if face['has_mask']:
+            stats['mask'] += 1
+        else:
+            stats['no_mask'] += 1
+    return stats
+
+
+
+
+class MotionGate:
+    """
+    بوابة حركة بطرح الخلفية (MOG2) على نسخة مصغرة من الإطار
+    
+    تحسب نسبة البكسلات المتحركة ومربعًا يحيط بمنطقة الحركة بإحداثيات الإطار.
+    """
+    
+    def __init__(self, threshold=MOTION_GATE_THRESHOLD, width=MOTION_GATE_WIDTH):
+        self.threshold = threshold
+        self.width = width
+        self.subtractor = cv2.createBackgroundSubtractorMOG2(
+            history=300, varThreshold=25, detectShadows=False
+        )
+        self.kernel = np.ones((3, 3), np.uint8)
+        self.score = 0.0
+        self.moving = True
+        self.roi = None
+        self.last_pass = 0
+        self.gated = 0
+        self.passed = 0
+    
+    def update(self, frame):
+        """
+        تحديث نموذج الخلفية بإطار جديد
+        
+        الإرجاع:
+            True إذا كان يجب تشغيل الكشف على هذا الإطار
+        """
+        h, w = frame.shape[:2]
+        scale = w / self.width
+        small = cv2.resize(frame, (self.width, max(1, int(h / scale))))
+        
+        mask = self.subtractor.apply(small)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel)
+        self.score = float(np.count_nonzero(mask)) / mask.size
+        self.moving = self.score >= self.threshold
+        
+        # مربع منطقة الحركة بإحداثيات الإطار الكامل مع هامش
+        self.roi = None
+        if self.moving:
+            points = cv2.findNonZero(mask)
+            if points is not None:
+                x, y, bw, bh = cv2.boundingRect(points)
+                pad_x = max(32, int(bw * scale * 0.25))
+                pad_y = max(32, int(bh * scale * 0.25))
+                x1 = max(0, int(x * scale) - pad_x)
+                y1 = max(0, int(y * scale) - pad_y)
+                x2 = min(w, int((x + bw) * scale) + pad_x)
+                y2 = min(h, int((y + bh) * scale) + pad_y)
+                if (x2 - x1) * (y2 - y1) <= MOTION_ROI_MAX_FRACTION * w * h:
+                    self.roi = (x1, y1, x2, y2)
+        
+        # تحديث دوري حتى بدون حركة لتجنب بقاء نتائج قديمة
+        now = time.time()
+        if self.moving or now - self.last_pass >= MOTION_GATE_REFRESH:
+            self.last_pass = now
+            self.passed += 1
+            return True
+        
+        self.gated += 1
+        return False
+    
+    def snapshot(self):
+        return {
+            'score': round(self.score, 4),
+            'moving': self.moving,
+            'roi': self.roi,
+            'gated': self.gated,
+            'passed': self.passed
+        }
+
+
+
+
+class StridedAnalyzer:
+    """
+    تشغيل analyze_frame كل N إطار ونقل مربعات آخر استدلال إلى الإطارات المتخطاة
+    
+    تُنقل المربعات بالتدفق البصري (Lucas-Kanade) لشبكة نقاط داخل كل مربع على
+    صورة رمادية مصغرة. في الوضع التكيفي تزداد الخطوة تدريجيًا عندما يكون
+    المشهد ثابتًا وتعود إلى 1 فور ظهور حركة أو سلاح.
+    """
+    
+    def __init__(self, stride=INFERENCE_STRIDE, adaptive=ADAPTIVE_STRIDE,
+                 max_stride=ADAPTIVE_STRIDE_MAX, metrics=None):
+        self.metrics = metrics  # قاموس StageMetrics اختياري (resize, flow, yolo, haar, clip)
+        self.base_stride = max(1, stride)
+        self.stride = self.base_stride
+        self.adaptive = adaptive
+        self.max_stride = max(self.base_stride, max_stride)
+        self.tracker = MultiObjectTracker(
+            iou_threshold=TRACK_IOU_THRESHOLD,
+            max_age=TRACK_MAX_AGE,
+            min_hits=TRACK_MIN_HITS
+        )
+        self.mask_cache = MaskVerdictCache()
+        self.since_inference = 0
+        self.last = None
+        self.prev_gray = None
+        self.flow_scale = 1.0
+        self.points = None
+        self.owners = None
+        self.boxes = None
+        self.motion = 0.0
+        self.inferred = 0
+        self.propagated = 0
+    
+    def analyze(self, models, frame, infer_size=None, roi=None):
+        """
+        تحليل إطار: استدلال كامل أو نقل مربعات آخر استدلال
+        
+        المعلمات:
+            models: قاموس النماذج
+            frame: الإطار الأصلي
+            infer_size: (العرض، الارتفاع) لتصغير إطار YOLO، أو None للإطار نفسه
+            roi: منطقة حركة اختيارية (x1, y1, x2, y2) يقتصر عليها الكشف
+        
+        الإرجاع:
+            قاموس analyze_frame مع 'inferred' = True/False
+        """
+        t0 = time.time()
+        h, w = frame.shape[:2]
+        self.flow_scale = w / STRIDE_FLOW_WIDTH
+        small_gray = cv2.cvtColor(
+            cv2.resize(frame, (STRIDE_FLOW_WIDTH, max(1, int(h / self.flow_scale)))),
+            cv2.COLOR_BGR2GRAY
+        )
+        self._record('resize', time.time() - t0)
+        
+        if self.prev_gray is not None and self.prev_gray.shape == small_gray.shape:
+            self.motion = float(cv2.absdiff(small_gray, self.prev_gray).mean()) / 255
+        
+        moving = self.motion >= STRIDE_MOTION_THRESHOLD
+        if self.adaptive and moving:
+            self.stride = 1
+        
+        if self.last is None or self.since_inference >= self.stride or (self.adaptive and moving):
+            return self._infer(models, frame, small_gray, infer_size, moving, roi)
+        
+        return self._propagate(small_gray)
+    
+    def _record(self, stage, seconds):
+        if self.metrics is not None:
+            self.metrics[stage].record(seconds)
+    
+    def _infer(self, models, frame, small_gray, infer_size, moving, roi=None):
+        if roi is not None and self.last is not None:
+            # الكشف داخل منطقة الحركة فقط مع إبقاء الكشوفات الحالية خارجها
+            x1, y1, x2, y2 = roi
+            current = self.current()
+            analysis = analyze_frame(models, frame, roi=roi, tracker=self.tracker,
+                                     mask_cache=self.mask_cache, metrics=self.metrics)
+            
+            def outside(entry):
+                cx = (entry['box'][0] + entry['box'][2]) / 2
+                cy = (entry['box'][1] + entry['box'][3]) / 2
+                return not (x1 <= cx < x2 and y1 <= cy < y2)
+            
+            analysis['detections'] += [det for det in current['detections'] if outside(det)]
+            analysis['faces'] += [face for face in current['faces'] if outside(face)]
+            analysis['stats'] = summarize_analysis(analysis['detections'], analysis['faces'])
+        elif infer_size is not None:
+            h, w = frame.shape[:2]
+            t0 = time.time()
+            small = cv2.resize(frame, infer_size)
+            self._record('resize', time.time() - t0)
+            analysis = analyze_frame(models, frame, small, w / infer_size[0], h / infer_size[1],
+                                     tracker=self.tracker, mask_cache=self.mask_cache,
+                                     metrics=self.metrics)
+        else:
+            analysis = analyze_frame(models, frame, tracker=self.tracker,
+                                     mask_cache=self.mask_cache, metrics=self.metrics)
+        analysis['inferred'] = True
+        
+        # تعديل الخطوة: 1 عند الحركة أو السلاح، وزيادة تدريجية للمشهد الثابت
+        if self.adaptive:
+            if moving or analysis['stats']['weapons'] > 0:
+                self.stride = 1
+            else:
+                self.stride = min(self.max_stride, max(self.stride + 1, self.base_stride))
+        
+        # شبكة نقاط 3x3 داخل كل مربع لتتبعها بالتدفق البصري
+        entries = analysis['detections'] + analysis['faces']
+        self.boxes = np.array([entry['box'] for entry in entries], dtype=np.float32).reshape(-1, 4)
+        points = []
+        owners = []
+        for i, (x1, y1, x2, y2) in enumerate(self.boxes / self.flow_scale):
+            for gx in np.linspace(x1, x2, 5)[1:4]:
+                for gy in np.linspace(y1, y2, 5)[1:4]:
+                    points.append((gx, gy))
+                    owners.append(i)
+        self.points = np.array(points, dtype=np.float32).reshape(-1, 1, 2)
+        self.owners = np.array(owners, dtype=np.int32)
+        
+        self.last = analysis
+        self.prev_gray = small_gray
+        self.since_inference = 1
+        self.inferred += 1
+        return analysis
+    
+    def _propagate(self, small_gray):
+        t0 = time.time()
+        if len(self.points):
+            new_points, status, _ = cv2.calcOpticalFlowPyrLK(
+                self.prev_gray, small_gray, self.points, None,
+                winSize=(15, 15), maxLevel=2
+            )
+            ok = status.reshape(-1).astype(bool)
+            shifts = (new_points - self.points).reshape(-1, 2) * self.flow_scale
+            for i in range(len(self.boxes)):
+                selected = ok & (self.owners == i)
+                if selected.any():
+                    dx, dy = np.median(shifts[selected], axis=0)
+                    self.boxes[i] += (dx, dy, dx, dy)
+            self.points = new_points
+        
+        self.prev_gray = small_gray
+        self.since_inference += 1
+        self.propagated += 1
+        self._record('flow', time.time() - t0)
+        
+        return self.current()
+    
+    def current(self):
+        """نسخة من آخر تحليل مع المربعات في مواقعها الحالية"""
+        boxes = [tuple(int(v) for v in box) for box in self.boxes]
+        n_det = len(self.last['detections'])
+        return {
+            'detections': [dict(det, box=box) for det, box in zip(self.last['detections'], boxes[:n_det])],
+            'faces': [dict(face, box=box) for face, box in zip(self.last['faces'], boxes[n_det:])],
+            'stats': dict(self.last['stats']),
+            'inferred': False
+        }
+    
+    def snapshot(self):
+        return {
+            'stride': self.stride,
+            'adaptive': self.adaptive,
+            'motion': round(self.motion, 4),
+            'inferred': self.inferred,
+            'propagated': self.propagated,
+            'tracks': len(self.tracker),
+            'mask_cache': self.mask_cache.snapshot()
+        }
+
+
+
+
+def render_analysis(frame, analysis, box_thick, font_scale, font_thick):
+    """رسم كشوفات analyze_frame على الإطار"""
+    for det in analysis['detections']:
+        x1, y1, x2, y2 = det['box']
+        conf = det['conf']
+        
+        # حقائب
+        if det['kind'] == 'bag':
+            draw_box(frame, x1, y1, x2, y2, C_YELLOW, f"{det['label']}: {conf:.2f}", 
+                    box_thick, font_scale, font_thick)
+        
+        # أشخاص
+        elif det['kind'] == 'person':
+            cv2.rectangle(frame, (x1, y1), (x2, y2), C_BLUE, box_thick)
+            cv2.putText(frame, f"Person: {conf:.2f}", (x1, y2+20), 
+                        cv2.FONT_HERSHEY_SIMPLEX, font_scale, C_BLUE, font_thick)
+        
+        # أسلحة
+        elif det['kind'] == 'weapon':
+            draw_box(frame, x1, y1, x2, y2, C_RED, f"{det['label']}: {conf:.2f}", 
+                    box_thick + 2, font_scale + 0.2, font_thick)
+    
+    for face in analysis['faces']:
+        fx1, fy1, fx2, fy2 = face['box']
+        color = C_GREEN if face['has_mask'] else C_RED
+        label = "NO MASK" if face['has_mask'] else "MASK"
+        draw_box(frame, fx1, fy1, fx2, fy2, color, 
+                f"{label}: {face['conf']:.2f}", box_thick, font_scale, font_thick)
+
+
+
+
+def first_seen_key(det):
+    """
+    مفتاح العد الفريد للأجسام قصيرة الظهور (الحقائب والأسلحة)
+    
+    تُعد من أول ظهور بمعرف المسار حتى قبل تأكيده (السلاح الذي يظهر في إطار أو
+    إطارين لا يصل إلى TRACK_MIN_HITS)، أو بخلية 50 بكسل عند عدم وجود مسار.
+    """
+    if det.get('tentative_id') is not None:
+        return ('track', det['tentative_id'])
+    x1, y1, x2, y2 = det['box']
+    return ('cell', det['label'], int(x1 + x2) // 100, int(y1 + y2) // 100)
+
+
+
+
+def should_capture(captured_tracks, kind, track_id, now, last_capture_time, interval):
+    """
+    هل يجب التقاط هذا الكشف
+    
+    الكشوفات على مسار مؤكد تُلتقط مرة واحدة لكل مسار، والكشوفات بدون مسار
+    تخضع للفاصل الزمني كما كانت.
+    """
+    if track_id is None:
+        return now - last_capture_time >= interval
+    if (kind, track_id) in captured_tracks:
+        return False
+    captured_tracks.add((kind, track_id))
+    return True
+
+
+
+
+def write_capture(job):
+    """
+    رسم الكشف على نسخة الإطار وترميزها وكتابتها إلى القرص
+    
+    المعلمات:
+        job: قاموس يحتوي frame و detection_type و bbox و filepath و captured_at
+    """
+    frame = job['frame']
+    x1, y1, x2, y2 = job['bbox']
+    
+    # رسم مربع أحمر حول الكشف
+    cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 0, 255), 4)
+    
+    # إضافة نص تحذير
+    cv2.putText(frame, f"DETECTED: {job['detection_type']}", (x1, y1 - 15),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 0, 255), 2)
+    
+    # إضافة الطابع الزمني إلى الصورة
+    time_text = job['captured_at'].strftime("%Y-%m-%d %H:%M:%S")
+    cv2.putText(frame, time_text, (10, frame.shape[0] - 20),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+    
+    ok, buffer = cv2.imencode('.jpg', frame)
+    if not ok:
+        raise ValueError("فشل ترميز صورة الالتقاط")
+    with open(job['filepath'], 'wb') as f:
+        f.write(buffer)
+
+
+
+
+class CaptureWriterPool:
+    """
+    مجمع محدود من مؤشرات الترابط لكتابة صور الالتقاط خارج حلقة الاستدلال
+    
+    كل مهمة قاموس يحتوي filepath ودالة الكتابة write التي تستقبل المهمة نفسها،
+    ودالة on_drop اختيارية تُستدعى إذا أُسقطت المهمة من الطابور قبل كتابتها.
+    
+    عند امتلاء الطابور تُطبق سياسة overflow:
+        drop_oldest: إسقاط أقدم التقاط ينتظر الكتابة
+        drop_newest: رفض الالتقاط الجديد
+        block: انتظار توفر مكان (يعيد الضغط إلى حلقة الاستدلال)
+    """
+    
+    POLICIES = ('drop_oldest', 'drop_newest', 'block')
+    
+    def __init__(self, workers=CAPTURE_WRITERS, queue_size=CAPTURE_QUEUE_SIZE, overflow=CAPTURE_OVERFLOW):
+        if overflow not in self.POLICIES:
+            raise ValueError(f"سياسة امتلاء غير معروفة: {overflow}")
+        
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.items = deque()
+        self.cond = Condition()
+        self.write_metrics = StageMetrics()  # زمن الرسم والترميز والكتابة
+        self.wait_metrics = StageMetrics()  # زمن الانتظار في الطابور
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.threads = [Thread(target=self.run, daemon=True) for _ in range(max(1, workers))]
+        for thread in self.threads:
+            thread.start()
+    
+    def submit(self, job):
+        """
+        إضافة التقاط إلى طابور الكتابة
+        
+        الإرجاع:
+            True إذا قُبل الالتقاط، False إذا رُفض بسبب الامتلاء
+        """
+        dropped = None
+        with self.cond:
+            if len(self.items) >= self.queue_size:
+                if self.overflow == 'drop_newest':
+                    self.dropped += 1
+                    logger.warning(f"⚠️  طابور الالتقاط ممتلئ، رُفض: {job['filepath']}")
+                    return False
+                if self.overflow == 'drop_oldest':
+                    dropped = self.items.popleft()
+                    self.dropped += 1
+                    logger.warning(f"⚠️  طابور الالتقاط ممتلئ، أُسقط: {dropped['filepath']}")
+                else:
+                    while len(self.items) >= self.queue_size:
+                        self.cond.wait()
+            
+            job['queued_at'] = time.time()
+            self.items.append(job)
+            self.cond.notify_all()
+        
+        # خارج القفل: الإخطار قد يرسل حدثًا ويكتب في المخزن
+        if dropped is not None and dropped.get('on_drop') is not None:
+            try:
+                dropped['on_drop'](dropped)
+            except Exception as e:
+                logger.error(f"خطأ في إخطار إسقاط الالتقاط {dropped['filepath']}: {str(e)}")
+        return True
+    
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.items:
+                    self.cond.wait()
+                job = self.items.popleft()
+                self.cond.notify_all()
+            
+            start = time.time()
+            self.wait_metrics.record(start - job['queued_at'])
+            try:
+                job['write'](job)
+                self.written += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"خطأ في كتابة الالتقاط {job['filepath']}: {str(e)}")
+            self.write_metrics.record(time.time() - start)
+    
+    def snapshot(self):
+        return {
+            'workers': len(self.threads),
+            'overflow': self.overflow,
+            'depth': len(self.items),
+            'maxsize': self.queue_size,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'write': self.write_metrics.snapshot(),
+            'wait': self.wait_metrics.snapshot()
+        }
+
+
+
+
+def get_capture_writer():
+    """إرجاع مجمع كتابة الالتقاطات (يُنشأ عند أول التقاط)"""
+    global capture_writer
+    with capture_writer_lock:
+        if capture_writer is None:
+            capture_writer = CaptureWriterPool()
+        return capture_writer
+
+
+
+
+def get_clip_writer():
+    """إرجاع مجمع كتابة مقاطع التنبيهات (يُنشأ عند أول مقطع)"""
+    global clip_writer
+    with capture_writer_lock:
+        if clip_writer is None:
+            clip_writer = CaptureWriterPool(workers=1, queue_size=CLIP_QUEUE_SIZE, overflow='drop_newest')
+        return clip_writer
+
+
+
+
+def write_clip(job):
+    """
+    فك ترميز إطارات JPEG لمقطع تنبيه وكتابتها كفيديو MP4
+    
+    المعلمات:
+        job: قاموس يحتوي frames [(t, jpeg)] و filepath و label و stream_id و url
+    """
+    frames = job['frames']
+    first = cv2.imdecode(np.frombuffer(frames[0][1], dtype=np.uint8), cv2.IMREAD_COLOR)
+    height, width = first.shape[:2]
+    
+    # معدل الإطارات الفعلي من الطوابع الزمنية
+    duration = frames[-1][0] - frames[0][0]
+    fps = (len(frames) - 1) / duration if duration > 0 else 25.0
+    
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    out = cv2.VideoWriter(job['filepath'], fourcc, max(1.0, fps), (width, height))
+    try:
+        out.write(first)
+        for _, jpeg in frames[1:]:
+            frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if frame.shape[:2] != (height, width):
+                frame = cv2.resize(frame, (width, height))
+            out.write(frame)
+    finally:
+        out.release()
+    
+    logger.info(f"🎬 تم حفظ مقطع {job['label']}: {job['filepath']} ({len(frames)} إطار)")
+    emit_event('clip_saved', {
+        'stream_id': job['stream_id'],
+        'type': job['label'],
+        'path': job['url'],
+        'frames': len(frames),
+        'duration': round(duration, 1)
+    })
+
+
+
+
+class ClipRecorder:
+    """
+    ذاكرة حلقية لإطارات بث واحد مرمّزة JPEG لتسجيل مقاطع حول التنبيهات
+    
+    تحتفظ بآخر pre_seconds ثانية ضمن حد max_bytes. عند التنبيه تُنسخ الإطارات
+    السابقة، وتُضاف اللاحقة حتى انتهاء post_seconds، ثم يُرسل المقطع لمجمع
+    الكتابة. التنبيهات أثناء مقطع مفتوح تمدده حتى max_seconds.
+    """
+    
+    def __init__(self, stream_id, pre_seconds=CLIP_PRE_SECONDS, post_seconds=CLIP_POST_SECONDS,
+                 max_seconds=CLIP_MAX_SECONDS, max_bytes=CLIP_BUFFER_MAX_BYTES):
+        self.stream_id = stream_id
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.frames = deque()  # (t, jpeg)
+        self.bytes = 0
+        self.events = []  # المقاطع المفتوحة بانتظار post-roll
+        self.evicted = 0  # إطارات أُسقطت بسبب حد الذاكرة قبل انتهاء نافذتها
+        self.clips = 0
+    
+    def add(self, frame, t):
+        """ترميز إطار وإضافته للذاكرة الحلقية وللمقاطع المفتوحة"""
+        image = frame
+        height, width = image.shape[:2]
+        if CLIP_WIDTH and width > CLIP_WIDTH:
+            image = cv2.resize(image, (CLIP_WIDTH, int(height * CLIP_WIDTH / width)),
+                               interpolation=cv2.INTER_AREA)
+        _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, CLIP_QUALITY])
+        jpeg = buffer.tobytes()
+        
+        with self.lock:
+            self.frames.append((t, jpeg))
+            self.bytes += len(jpeg)
+            while self.frames and self.frames[0][0] < t - self.pre_seconds:
+                self.bytes -= len(self.frames.popleft()[1])
+            while self.bytes > self.max_bytes and len(self.frames) > 1:
+                self.bytes -= len(self.frames.popleft()[1])
+                self.evicted += 1
+            
+            finished = []
+            still_open = []
+            for event in self.events:
+                event['frames'].append((t, jpeg))
+                event['bytes'] += len(jpeg)
+                if t >= event['end'] or event['bytes'] > self.max_bytes:
+                    finished.append(event)
+                else:
+                    still_open.append(event)
+            self.events = still_open
+        
+        for event in finished:
+            self._flush(event)
+    
+    def trigger(self, label, t):
+        """
+        بدء مقطع تنبيه أو تمديد المقطع المفتوح
+        
+        الإرجاع:
+            True إذا بدأ مقطع جديد
+        """
+        with self.lock:
+            if self.events:
+                event = self.events[-1]
+                event['end'] = min(t + self.post_seconds, event['start'] + self.max_seconds)
+                return False
+            
+            self.events.append({
+                'label': label,
+                'start': t - self.pre_seconds,
+                'end': t + self.post_seconds,
+                'frames': list(self.frames),
+                'bytes': self.bytes,
+                'created': datetime.now()
+            })
+            return True
+    
+    def _flush(self, event):
+        """إرسال مقطع مكتمل لمجمع الكتابة"""
+        if not event['frames']:
+            return
+        
+        timestamp = event['created'].strftime("%Y%m%d_%H%M%S_%f")[:-3]
+        filename = f"{event['label']}_{timestamp}.mp4"
+        accepted = get_clip_writer().submit({
+            'write': write_clip,
+            'frames': event['frames'],
+            'filepath': os.path.join(CLIPS_FOLDER, filename),
+            'url': f"/static/clips/{filename}",
+            'label': event['label'],
+            'stream_id': self.stream_id
+        })
+        if accepted:
+            self.clips += 1
+        else:
+            logger.warning(f"⚠️  طابور المقاطع ممتلئ، لم يُحفظ مقطع {event['label']}")
+    
+    def close(self):
+        """كتابة المقاطع المفتوحة بما جُمع من post-roll عند توقف البث"""
+        with self.lock:
+            events, self.events = self.events, []
+        for event in events:
+            self._flush(event)
+    
+    def snapshot(self):
+        with self.lock:
+            seconds = self.frames[-1][0] - self.frames[0][0] if self.frames else 0.0
+            return {
+                'buffered_frames': len(self.frames),
+                'buffered_seconds': round(seconds, 1),
+                'buffer_bytes': self.bytes,
+                'open_clip_bytes': sum(event['bytes'] for event in self.events),
+                'max_bytes': self.max_bytes,
+                'evicted': self.evicted,
+                'open_clips': len(self.events),
+                'clips': self.clips
+            }
+
+
+
+
+def capture_frame(frame, detection_type, bbox, stream_id=None, task_id=None):
+    """
+    التقاط وحفظ إطار مع الكشف
+    
+    المعلمات:
+        frame: الإطار الحالي
+        detection_type: نوع الكشف (Knife/Person/إلخ)
+        bbox: إحداثيات الكشف (x1, y1, x2, y2)
+        stream_id: معرف البث مصدر الكشف (إن وجد)
+        task_id: معرف مهمة الفيديو مصدر الكشف (إن وجدت)
+    
+    الإرجاع:
+        مسار الملف المحفوظ (الكتابة الفعلية تتم في الخلفية)، أو "" إذا رُفض الالتقاط
+    
+    التنبيه يُرسل ويُحفظ دائمًا؛ إذا رفض مجمع الكتابة الالتقاط يكون مساره None،
+    وإذا أُسقط لاحقًا من الطابور يُرسل حدث capture_dropped ويُزال مساره من المخزن.
+    """
+    try:
+        # إنشاء اسم الملف مع الطابع الزمني
+        captured_at = datetime.now()
+        timestamp = captured_at.strftime("%Y%m%d_%H%M%S_%f")[:-3]
+        filename = f"{detection_type}_{timestamp}.jpg"
+        filepath = os.path.join(CAPTURES_FOLDER, filename)
+        capture_path = f"/static/captures/{filename}"
+        
+        def on_drop(job):
+            emit_event('capture_dropped', {
+                'type': detection_type,
+                'path': capture_path,
+                'captured_at': captured_at.timestamp(),
+                'stream_id': stream_id,
+                'task_id': task_id
+            })
+        
+        # نسخة الإطار فقط في حلقة الاستدلال؛ الرسم والترميز والكتابة في مجمع الكتابة
+        accepted = get_capture_writer().submit({
+            'frame': frame.copy(),
+            'detection_type': detection_type,
+            'bbox': tuple(int(v) for v in bbox),
+            'filepath': filepath,
+            'captured_at': captured_at,
+            'write': write_capture,
+            'on_drop': on_drop
+        })
+        if accepted:
+            logger.info(f"⚠️  تم التقاط {detection_type}: {filepath}")
+        
+        # إرسال تنبيه إلى العملاء المتصلين (فورًا، حتى لو لم تُحفظ الصورة)
+        alert_data = {
+            'type': detection_type,
+            'path': capture_path if accepted else None,
+            'confidence': 98,  # مكان
+            'timestamp': datetime.now().strftime("%H:%M:%S"),
+            'stream_id': stream_id,
+            'camera_id': active_streams.get(stream_id, {}).get('name') if stream_id else None,
+            'task_id': task_id
+        }
+        emit_event('alert', alert_data)
+        
+        return capture_path if accepted else ""
+    except Exception as e:
+        logger.error(f"خطأ في التقاط الإطار: {str(e)}")
+        return ""
+
+
+
+
+def import_clip_backend():
+    """
+    استيراد مكتبة CLIP عند أول حاجة إليها (استيراد transformers وحده يستغرق ثوانٍ)
+    
+    الإرجاع:
+        True إذا توفرت مكتبة CLIP
+    """
+    global CLIPProcessor, CLIPModel, clip, USE_OPENAI_CLIP
+    
+    try:
+        from transformers import CLIPProcessor, CLIPModel
+        USE_OPENAI_CLIP = False
+        logger.info("✅ استخدام CLIPProcessor من transformers")
+        return True
+    except ImportError:
+        pass
+    
+    try:
+        from transformers import CLIPFeatureExtractor as CLIPProcessor, CLIPModel
+        USE_OPENAI_CLIP = False
+        logger.info("✅ استخدام CLIPFeatureExtractor بدلاً من CLIPProcessor")
+        return True
+    except ImportError:
+        pass
+    
+    try:
+        import clip
+        USE_OPENAI_CLIP = True
+        logger.info("✅ استخدام مكتبة CLIP الأصلية من OpenAI")
+        return True
+    except ImportError:
+        logger.error("❌ فشل استيراد أي إصدار من CLIP. يرجى تثبيت إحدى هذه المكتبات:")
+        logger.error("   pip install transformers pillow torch")
+        logger.error("   أو: pip install git+https://github.com/openai/CLIP.git")
+        USE_OPENAI_CLIP = False
+        return False
+
+
+
+
+def yolo_component(weights, imgsz, variant=None):
+    """مفتاح مكون YOLO في ModelLoader: 'yolo:<الأوزان>:<imgsz>[:<النسخة>]'"""
+    return ':'.join(['yolo', weights, str(imgsz)] + ([variant] if variant else []))
+
+
+
+
+def load_yolo(device, weights='yolov8x.pt', imgsz=BACKEND_IMGSZ, variant=None):
+    """
+    تحميل أوزان YOLO من الدليل الأب أو MODEL_CACHE_DIR، أو YOLOv8n (يُنزّل مرة
+    واحدة إلى MODEL_CACHE_DIR) عند عدم توفرها
+    
+    المعلمات:
+        device: الجهاز ('cpu' أو 'cuda')
+        weights: اسم ملف الأوزان (مثل 'yolov8s.pt')
+        imgsz: حجم الإدخال (للتصدير إلى خلفيات المعالج)
+        variant: اسم نسخة مكممة معتمدة تُفضّل على الأوزان الكاملة
+    """
+    from ultralytics import YOLO
+    
+    imgsz = int(imgsz)
+    component = yolo_component(weights, imgsz, variant)
+    if variant:
+        yolo = load_yolo_variant(variant, component)
+        if yolo is not None:
+            return yolo
+    
+    fallback_path = os.path.join(MODEL_CACHE_DIR, "yolov8n.pt")
+    yolo_path = os.path.join(parent_dir, weights)
+    if not os.path.exists(yolo_path):
+        yolo_path = os.path.join(MODEL_CACHE_DIR, weights)
+    try:
+        if os.path.exists(yolo_path):
+            logger.info(f"تم العثور على ملف yolo: {yolo_path}")
+            yolo = YOLO(yolo_path)
+            logger.info(f"✅ تم تحميل {weights}!")
+            return optimize_yolo(yolo, yolo_path, device, imgsz, component)
+        logger.warning(f"ملف yolo غير موجود: {weights}, استخدام نموذج مضمن...")
+    except Exception as e:
+        logger.error(f"خطأ في تحميل YOLO: {str(e)}")
+        logger.warning(f"⚠️ {weights} غير متوفر، استخدام YOLOv8n...")
+    
+    yolo = YOLO(fallback_path)
+    logger.info("✅ تم تحميل YOLOv8n!")
+    return optimize_yolo(yolo, fallback_path, device, imgsz, component)
+
+
+
+
+def load_yolo_variant(name, component='yolo'):
+    """تحميل نسخة YOLO مكممة معتمدة من السجل، أو None إن لم تكن معتمدة"""
+    from ultralytics import YOLO
+    
+    entry = approved_variant(VARIANTS_PATH, name, 'yolo')
+    if entry is None:
+        logger.warning(f"⚠️ نسخة YOLO {name} غير معتمدة أو غير موجودة، استخدام النموذج الكامل")
+        return None
+    
+    try:
+        yolo = YOLO(entry['artifact'], task='detect')
+        yolo(np.zeros((entry['imgsz'], entry['imgsz'], 3), dtype=np.uint8), verbose=False)
+        tuned = backends.tune_yolo_threads(yolo, 'onnx', entry['artifact'], backend_threads())
+    except Exception as e:
+        logger.error(f"❌ فشل تحميل نسخة YOLO {name}: {str(e)}")
+        return None
+    model_backends[component] = {
+        'backend': 'onnx-int8',
+        'variant': name,
+        'artifact': entry['artifact'],
+        'threads_tuned': tuned,
+        'gate': entry['gate']
+    }
+    logger.info(f"✅ تم تحميل نسخة YOLO المكممة {name}")
+    return yolo
+
+
+
+
+def load_clip_variant(name, clip_model, clip_name):
+    """مُرمّز صور CLIP من نسخة مكممة معتمدة لنفس النموذج الأساسي، أو None"""
+    entry = approved_variant(VARIANTS_PATH, name, 'clip')
+    if entry is None or entry['base'] != clip_name:
+        logger.warning(f"⚠️ نسخة CLIP {name} غير معتمدة لـ {clip_name}، استخدام النموذج الكامل")
+        return None
+    
+    try:
+        runner = backends.clip_runner('onnx', entry['artifact'], backend_threads())
+    except Exception as e:
+        logger.error(f"❌ فشل تحميل نسخة CLIP {name}: {str(e)}")
+        return None
+    
+    model_backends['clip'] = {
+        'backend': 'onnx-int8',
+        'variant': name,
+        'artifact': entry['artifact'],
+        'gate': entry['gate']
+    }
+    logger.info(f"✅ تم تحميل نسخة CLIP المكممة {name}")
+    return backends.ExportedCLIP(clip_model, runner, 'onnx-int8')
+
+
+
+
+def backend_threads():
+    """عدد مؤشرات الترابط لجلسات الخلفيات المُصدّرة"""
+    return INFERENCE_THREADS or torch.get_num_threads()
+
+
+
+
+def parity_images(limit=PARITY_MAX_IMAGES):
+    """
+    صور مرجعية لفحص التطابق: أحدث الالتقاطات المحلية (مشاهد كاميراتنا)،
+    أو صور ultralytics المضمنة إن لم توجد التقاطات
+    """
+    paths = [os.path.join(CAPTURES_FOLDER, name) for name in os.listdir(CAPTURES_FOLDER)
+             if name.lower().endswith(('.jpg', '.jpeg', '.png'))]
+    paths = sorted(paths, key=os.path.getmtime)[-limit:]
+    if not paths:
+        from ultralytics.utils import ASSETS
+        paths = sorted(str(path) for path in ASSETS.glob('*.jpg'))
+    
+    images = [cv2.imread(path) for path in paths]
+    return [image for image in images if image is not None]
+
+
+
+
+def optimize_yolo(yolo, weights_path, device, imgsz=BACKEND_IMGSZ, component='yolo'):
+    """
+    استبدال YOLO بنسخة الخلفية المختارة على المعالج
+    
+    عند فشل التصدير أو فحص التطابق يبقى نموذج PyTorch.
+    """
+    if INFERENCE_BACKEND == 'torch' or device != 'cpu':
+        model_backends[component] = {'backend': 'torch'}
+        return yolo
+    
+    try:
+        images = parity_images() if BACKEND_PARITY_CHECK else None
+        candidate, info = backends.load_yolo_backend(
+            yolo, weights_path, INFERENCE_BACKEND, BACKENDS_CACHE_DIR, imgsz,
+            backend_threads(), images, conf=YOLO_CONF, iou=YOLO_IOU
+        )
+    except Exception as e:
+        logger.error(f"❌ فشل تحميل YOLO بخلفية {INFERENCE_BACKEND}: {str(e)}")
+        model_backends[component] = {'backend': 'torch', 'error': str(e)}
+        return yolo
+    
+    model_backends[component] = info
+    if candidate is None:
+        logger.warning(f"⚠️ YOLO ({INFERENCE_BACKEND}) لم يجتز فحص التطابق: {info['parity']}, استخدام PyTorch")
+        info['backend'] = 'torch'
+        return yolo
+    
+    logger.info(f"✅ YOLO يعمل بخلفية {INFERENCE_BACKEND} ({backend_threads()} مؤشرات)")
+    return candidate
+
+
+
+
+def optimize_clip(clip_model, clip_proc, clip_name, device):
+    """استبدال مُرمّز صور CLIP بنسخة الخلفية المختارة على المعالج (transformers فقط)"""
+    if INFERENCE_BACKEND == 'torch' or device != 'cpu' or USE_OPENAI_CLIP:
+        model_backends['clip'] = {'backend': 'torch'}
+        return clip_model
+    
+    try:
+        parity_inputs = None
+        if BACKEND_PARITY_CHECK:
+            images = [Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)) for image in parity_images()]
+            parity_inputs = clip_proc(images=images, return_tensors="pt")['pixel_values'] if images else None
+        candidate, info = backends.load_clip_backend(
+            clip_model, clip_name, INFERENCE_BACKEND, BACKENDS_CACHE_DIR, backend_threads(), parity_inputs
+        )
+    except Exception as e:
+        logger.error(f"❌ فشل تحميل CLIP بخلفية {INFERENCE_BACKEND}: {str(e)}")
+        model_backends['clip'] = {'backend': 'torch', 'error': str(e)}
+        return clip_model
+    
+    model_backends['clip'] = info
+    if candidate is None:
+        logger.warning(f"⚠️ CLIP ({INFERENCE_BACKEND}) لم يجتز فحص التطابق: {info['parity']}, استخدام PyTorch")
+        info['backend'] = 'torch'
+        return clip_model
+    
+    logger.info(f"✅ مُرمّز صور CLIP يعمل بخلفية {INFERENCE_BACKEND}")
+    return candidate
+
+
+
+
+def load_hf_clip(clip_name):
+    """
+    تحميل CLIP من transformers من نسخة محلية في CLIP_CACHE_DIR إن وُجدت
+    
+    أول تحميل يأتي من Hugging Face ثم يُحفظ محليًا (safetensors)، فلا تحتاج
+    إعادة التشغيل إلى الشبكة ولا إلى فحص التحديثات.
+    
+    الإرجاع:
+        (clip_proc, clip_model)
+    """
+    local_dir = os.path.join(CLIP_CACHE_DIR, clip_name.replace('/', '--'))
+    if os.path.isdir(local_dir):
+        return CLIPProcessor.from_pretrained(local_dir), CLIPModel.from_pretrained(local_dir)
+    
+    clip_proc = CLIPProcessor.from_pretrained(clip_name)
+    clip_model = CLIPModel.from_pretrained(clip_name)
+    
+    try:
+        tmp_dir = f"{local_dir}.tmp-{os.getpid()}"
+        clip_proc.save_pretrained(tmp_dir)
+        clip_model.save_pretrained(tmp_dir)
+        os.replace(tmp_dir, local_dir)
+        logger.info(f"💾 تم حفظ نسخة محلية من {clip_name}: {local_dir}")
+    except Exception as e:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        logger.warning(f"⚠️ تعذر حفظ نسخة محلية من {clip_name}: {str(e)}")
+    
+    return clip_proc, clip_model
+
+
+
+
+def load_clip(device):
+    """
+    تحميل CLIP وترميز مجموعات التسميات (أو قراءتها من القرص)
+    
+    الإرجاع:
+        قاموس clip_model و clip_proc و clip_name و use_openai_clip و label_registry
+    """
+    if not import_clip_backend():
+        raise RuntimeError("مكتبة CLIP غير مثبتة")
+    
+    if USE_OPENAI_CLIP:
+        # استخدام OpenAI CLIP الأصلي
+        clip_name = "ViT-L/14"
+        clip_model, clip_proc = clip.load(clip_name, device=device, download_root=CLIP_CACHE_DIR)
+        logger.info("✅ تم تحميل CLIP-Large (OpenAI)!")
+    else:
+        try:
+            clip_name = "openai/clip-vit-large-patch14"
+            clip_proc, clip_model = load_hf_clip(clip_name)
+            logger.info("✅ تم تحميل CLIP-Large (Transformers)!")
+        except Exception as e:
+            logger.warning(f"⚠️ CLIP-Large غير متوفر: {str(e)}, استخدام CLIP-Base...")
+            clip_name = "openai/clip-vit-base-patch32"
+            clip_proc, clip_model = load_hf_clip(clip_name)
+            logger.info("✅ تم تحميل CLIP-Base (Transformers)!")
+        clip_model.to(device).eval()
+        variant = load_clip_variant(CLIP_VARIANT, clip_model, clip_name) if CLIP_VARIANT and device == 'cpu' else None
+        clip_model = variant or optimize_clip(clip_model, clip_proc, clip_name, device)
+    
+    parts = {
+        'clip_model': clip_model,
+        'clip_proc': clip_proc,
+        'clip_name': clip_name,
+        'use_openai_clip': USE_OPENAI_CLIP,
+        'device': device
+    }
+    
+    # ترميز مجموعات تسميات CLIP مرة واحدة (أو قراءتها من القرص)
+    registry = ZeroShotLabelRegistry(clip_name, MODEL_CACHE_DIR)
+    registry.load(parts, ZERO_SHOT_PROMPTS)
+    parts['label_registry'] = registry
+    del parts['device']
+    return parts
+
+
+
+
+def load_face_cascade(device):
+    """تحميل مصنف Haar لكشف الوجوه (يُستخدم مع CLIP فقط)"""
+    face_cascade = cv2.CascadeClassifier(
+        cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+    )
+    if face_cascade.empty():
+        raise RuntimeError("تعذر تحميل Haar Cascade")
+    return face_cascade
+
+
+
+
+class ModelLoader:
+    """
+    تحميل مكونات النماذج بالتوازي في مؤشرات خلفية، وكل مكون عند أول طلب له
+    
+    المكونات: 'yolo:<الأوزان>:<imgsz>[:<النسخة>]' لكل ملف نماذج، و face_cascade
+    و clip المشتركان بين الملفات. كل بث أو مهمة يحجز مكونات ملفه (acquire) ويحررها
+    عند الانتهاء (release)، والمكونات التي تبقى بدون مستخدمين تُفرّغ (unload_idle).
+    حالة كل مكون وزمن تحميله وعدد مستخدميه متاحة لـ /api/health و /metrics.
+    """
+    
+    LOADERS = {
+        'yolo': load_yolo,
+        'face_cascade': load_face_cascade,
+        'clip': load_clip
+    }
+    
+    def __init__(self, workers=MODEL_LOAD_WORKERS):
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='model-loader')
+        self.futures = {}
+        self.status = {}
+        self.refs = {}       # المكون ← عدد المستخدمين الحاليين
+        self.idle_since = {}  # المكون ← وقت آخر تحرير (أو بدء التحميل) بدون مستخدمين
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+    
+    def start(self, names):
+        """بدء تحميل مكونات في الخلفية بدون انتظار (المكونات المحملة أو الجارية تُتجاهل)"""
+        with self.lock:
+            for name in names:
+                if name not in self.futures:
+                    self.status[name] = {'state': 'loading', 'started': time.time()}
+                    self.futures[name] = self.executor.submit(self._load, name)
+                    self.idle_since[name] = time.time()
+    
+    def _load(self, name):
+        t0 = time.time()
+        kind, *args = name.split(':')
+        logger.info(f"⏳ تحميل {name} على {self.device.upper()}...")
+        try:
+            value = self.LOADERS[kind](self.device, *args)
+        except Exception as e:
+            self.status[name] = {'state': 'failed', 'seconds': round(time.time() - t0, 2), 'error': str(e)}
+            logger.error(f"❌ فشل تحميل {name}: {str(e)}")
+            raise
+        
+        self.status[name] = {'state': 'ready', 'seconds': round(time.time() - t0, 2)}
+        logger.info(f"✅ {name} جاهز خلال {time.time() - t0:.1f} ثانية")
+        return value
+    
+    def get(self, name):
+        """إرجاع مكون بعد تحميله (يبدأ تحميله إن لم يبدأ)؛ يرفع خطأ التحميل إن فشل"""
+        self.start([name])
+        return self.futures[name].result()
+    
+    def peek(self, name):
+        """إرجاع مكون محمل بدون بدء تحميله أو انتظاره، أو None"""
+        future = self.futures.get(name)
+        if future is None or not future.done() or future.exception() is not None:
+            return None
+        return future.result()
+    
+    def loaded(self):
+        """المكونات المحملة حاليًا: الاسم ← القيمة"""
+        with self.lock:
+            names = list(self.futures)
+        loaded = {}
+        for name in names:
+            value = self.peek(name)
+            if value is not None:
+                loaded[name] = value
+        return loaded
+    
+    def acquire(self, names):
+        """حجز مكونات لمستخدم جديد وبدء تحميل ما لم يُحمّل منها"""
+        with self.lock:
+            for name in names:
+                self.refs[name] = self.refs.get(name, 0) + 1
+        self.start(names)
+    
+    def release(self, names):
+        """تحرير مكونات حجزها مستخدم (تصبح قابلة للتفريغ عند عدم وجود مستخدمين)"""
+        with self.lock:
+            for name in names:
+                self.refs[name] = max(0, self.refs.get(name, 0) - 1)
+                if self.refs[name] == 0:
+                    self.idle_since[name] = time.time()
+    
+    def unload_idle(self, idle):
+        """
+        إزالة المكونات المحملة التي بقيت بدون مستخدمين أكثر من idle ثانية
+        
+        الإرجاع:
+            قائمة (اسم المكون، القيمة) المزالة (المكونات الفاشلة تبقى لعرض الخطأ)
+        """
+        now = time.time()
+        unloaded = []
+        with self.lock:
+            for name, future in list(self.futures.items()):
+                if self.refs.get(name, 0) > 0 or now - self.idle_since.get(name, now) < idle:
+                    continue
+                if not future.done() or future.exception() is not None:
+                    continue
+                del self.futures[name]
+                self.status[name] = {'state': 'unloaded', 'unloaded': now}
+                unloaded.append((name, future.result()))
+        return unloaded
+    
+    def snapshot(self):
+        with self.lock:
+            return {name: dict(info, refs=self.refs.get(name, 0)) for name, info in self.status.items()}
+
+
+
+
+def unload_idle_models(loader):
+    """تفريغ مكونات النماذج غير المستخدمة دوريًا وتحرير ذاكرتها (يعمل في مؤشر خلفي)"""
+    while True:
+        time.sleep(max(1.0, MODEL_IDLE_UNLOAD / 4))
+        try:
+            unloaded = loader.unload_idle(MODEL_IDLE_UNLOAD)
+            if not unloaded:
+                continue
+            
+            for name, value in unloaded:
+                close_inference_schedulers(value)
+                model_backends.pop(name, None)
+                logger.info(f"♻️ تم تفريغ {name} (بدون مستخدمين منذ {MODEL_IDLE_UNLOAD:.0f} ثانية)")
+            
+            del unloaded, value
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except Exception as e:
+            logger.error(f"خطأ في تفريغ النماذج غير المستخدمة: {str(e)}")
+
+
+
+
+def get_model_loader():
+    """إرجاع محمّل النماذج لهذه العملية (يُنشأ عند أول استخدام مع مؤشر التفريغ)"""
+    global model_loader
+    with models_lock:
+        if model_loader is None:
+            model_loader = ModelLoader()
+            if MODEL_IDLE_UNLOAD > 0:
+                Thread(target=unload_idle_models, args=(model_loader,),
+                       daemon=True, name='model-unloader').start()
+        return model_loader
+
+
+
+
+def profile_components(profile):
+    """
+    مكونات ModelLoader التي يحتاجها ملف نماذج
+    
+    الإرجاع:
+        قائمة تبدأ بمكون YOLO، ثم face_cascade و clip إذا فعّل الملف CLIP
+        وكان MASK_DETECTION مفعّلًا
+    """
+    spec = MODEL_PROFILES[profile]
+    variant = spec.get('variant') or (YOLO_VARIANT if profile == DEFAULT_MODEL_PROFILE else None)
+    components = [yolo_component(spec['yolo'], spec.get('imgsz', BACKEND_IMGSZ), variant)]
+    if spec['clip'] and MASK_DETECTION:
+        components += ['face_cascade', 'clip']
+    return components
+
+
+
+
+def acquire_models(profile=None):
+    """
+    حجز نماذج ملف وإرجاع قاموسها بعد التحميل
+    
+    المكونات مشتركة بين كل مستخدمي الملف (وبين الملفات التي تحتاجها)، ويجب
+    تحريرها بـ release_models عند الانتهاء. فشل CLIP أو Haar يعني المتابعة
+    بدون كشف القناع.
+    
+    المعلمات:
+        profile: اسم الملف في MODEL_PROFILES (None = DEFAULT_MODEL_PROFILE)
+    
+    الإرجاع:
+        قاموس النماذج مع 'profile' و 'imgsz' و 'components'
+    """
+    profile = profile or DEFAULT_MODEL_PROFILE
+    components = profile_components(profile)
+    loader = get_model_loader()
+    loader.acquire(components)
+    
+    try:
+        yolo = loader.get(components[0])
+    except Exception:
+        loader.release(components)
+        raise
+    
+    models = {
+        'yolo': yolo,
+        'face_cascade': None,
+        'clip_model': None,
+        'clip_proc': None,
+        'clip_name': None,
+        'label_registry': None,
+        'device': loader.device,
+        'use_openai_clip': False,
+        'profile': profile,
+        'imgsz': MODEL_PROFILES[profile].get('imgsz', BACKEND_IMGSZ),
+        'components': components
+    }
+    
+    if 'clip' in components:
+        try:
+            models.update(loader.get('clip'))
+            models['face_cascade'] = loader.get('face_cascade')
+        except Exception:
+            logger.warning(f"⚠️ المتابعة بدون كشف القناع (الملف {profile})...")
+            models['clip_model'] = None
+    
+    return models
+
+
+
+
+def release_models(models):
+    """تحرير مكونات حجزها acquire_models"""
+    get_model_loader().release(models['components'])
+
+
+
+
+def load_models():
+    """
+    إرجاع نماذج الملف الافتراضي محجوزة بشكل دائم في هذه العملية
+    
+    تُستخدم في عمليات العمال والأدوات وعند التحميل المسبق، فيبقى الملف
+    الافتراضي محملًا ولا يُفرّغ.
+    """
+    global global_models
+    
+    # إذا كانت النماذج محملة بالفعل، أعدها
+    if global_models is not None:
+        return global_models
+    
+    models = acquire_models()
+    
+    with models_lock:
+        if global_models is None:
+            global_models = models
+            logger.info("✅ تم تحميل جميع النماذج!")
+            return global_models
+    
+    release_models(models)
+    return global_models
+
+
+
+
+def model_health():
+    """
+    حالة جاهزية النماذج (حسب مكونات الملف الافتراضي)
+    
+    الإرجاع:
+        (الحالة، تفاصيل المكونات) حيث الحالة 'idle' (لم يُطلب التحميل بعد) أو
+        'loading' أو 'ready' أو 'degraded' (مكون فشل تحميله) أو 'failed'
+        (فشل YOLO الملف الافتراضي)
+    """
+    loader = model_loader
+    components = loader.snapshot() if loader is not None else {}
+    if not components:
+        return 'idle', components
+    
+    states = [components.get(name, {}).get('state') for name in profile_components(DEFAULT_MODEL_PROFILE)]
+    if states[0] == 'failed':
+        return 'failed', components
+    if 'loading' in states:
+        return 'loading', components
+    if any(info['state'] == 'failed' for info in components.values()):
+        return 'degraded', components
+    return 'ready', components
+
+
+
+
+def update_task(task_id, **fields):
+    """
+    تحديث حالة المهمة
+    
+    داخل عملية عامل يُحدَّث القاموس المحلي وتُنقل التغييرات إلى العملية الرئيسية.
+    """
+    task = tasks.setdefault(task_id, {'id': task_id})
+    task.update(fields)
+    if worker_events is not None:
+        worker_events.put(('task', task_id, fields))
+    else:
+        get_store().save_task(task)
+
+
+
+
+def get_store():
+    """إرجاع المخزن الدائم (يُنشأ عند أول استخدام في العملية الرئيسية)"""
+    global event_store
+    with event_store_lock:
+        if event_store is None:
+            event_store = EventStore(STORE_PATH, STORE_BATCH_SIZE, STORE_FLUSH_INTERVAL)
+            logger.info(f"✅ تم فتح المخزن الدائم: {STORE_PATH}")
+        return event_store
+
+
+
+
+def publish_event(event, data):
+    """إرسال حدث Socket.IO من العملية الرئيسية مع حفظ التنبيهات في المخزن"""
+    if event == 'alert':
+        get_store().add_alert(data)
+    elif event == 'capture_dropped':
+        get_store().clear_alert_path(data['path'], data['captured_at'])
+    socketio.emit(event, data)
+
+
+
+
+def record_analytics(source, ts, sums, maxes, count):
+    """تسليم إحصائيات ثانية مجمعة إلى المجمع (عبر العملية الرئيسية عند العمل داخل عامل)"""
+    if worker_events is not None:
+        worker_events.put(('analytics', source, (ts, sums, maxes, count)))
+    else:
+        analytics_aggregator.add(source, ts, sums, maxes, count)
+
+
+
+
+def report_task_metrics(task_id, part, metrics):
+    """
+    نشر مدرجات مراحل مهمة فيديو لنقطة /metrics
+    
+    المعلمات:
+        task_id: معرف المهمة
+        part: رقم المقطع (0 للمعالجة غير المقسمة)
+        metrics: قاموس StageMetrics للمراحل
+    """
+    states = {stage: m.state() for stage, m in metrics.items()}
+    if worker_events is not None:
+        worker_events.put(('metrics', task_id, (part, states)))
+    else:
+        store_task_metrics(task_id, part, states)
+
+
+
+
+def store_task_metrics(task_id, part, states):
+    """حفظ آخر حالة مدرجات مقطع مهمة مع الإبقاء على آخر TASK_METRICS_KEEP مهمة"""
+    with task_metrics_lock:
+        task_metrics.setdefault(task_id, {})[part] = states
+        while len(task_metrics) > TASK_METRICS_KEEP:
+            task_metrics.pop(next(iter(task_metrics)))
+
+
+
+
+def trace_request_path(task_id):
+    """مسار ملف طلب تتبع مهمة (تقرؤه عمليات العمال التي تعالجها)"""
+    return os.path.join(TRACE_REQUESTS_FOLDER, f"{os.path.basename(task_id)}.json")
+
+
+
+
+def start_stream_trace(stream_id, duration, mode):
+    """
+    ربط جلسة تتبع بمقاييس مراحل بث يعمل في هذه العملية
+    
+    المعلمات:
+        stream_id: معرف البث (يجب أن يكون له خط معالجة)
+        duration: مدة الجلسة بالثواني
+        mode: 'stages' أو 'sampling'
+    
+    الإرجاع:
+        الجلسة، أو None إذا كان للبث جلسة نشطة
+    """
+    pipeline = stream_pipelines[stream_id]
+    with trace_lock:
+        if pipeline.trace is not None and pipeline.trace.active():
+            return None
+        session = TraceSession(uuid.uuid4().hex, f"stream:{stream_id}", time.time() + duration,
+                               mode, TRACE_SAMPLE_INTERVAL, label='stream')
+        trace_sessions[session.trace_id] = session
+        pipeline.trace = session
+        attach_tracer(pipeline.metrics, session)
+    
+    timer = Timer(duration, finish_stream_trace, args=(pipeline, session))
+    timer.daemon = True
+    timer.start()
+    
+    logger.info(f"🔍 بدأ تتبع البث {stream_id} لمدة {duration:.0f} ثانية ({mode})")
+    return session
+
+
+
+
+def finish_stream_trace(pipeline, session):
+    """فك ربط جلسة تتبع بث وحفظ نتيجتها"""
+    with trace_lock:
+        if pipeline.trace is session:
+            attach_tracer(pipeline.metrics, None)
+            pipeline.trace = None
+        trace_sessions.pop(session.trace_id, None)
+    
+    session.stop()
+    try:
+        path = session.save(TRACES_FOLDER)
+        logger.info(f"✅ تم حفظ تتبع البث {pipeline.stream_id}: {path}")
+    except Exception as e:
+        logger.error(f"خطأ في حفظ التتبع {session.trace_id}: {str(e)}")
+
+
+
+
+def request_task_trace(task_id, duration, mode):
+    """
+    كتابة طلب تتبع مهمة تلتقطه عمليات المعالجة (قد تكون عمليات عمال منفصلة)
+    
+    الإرجاع:
+        قاموس الطلب، أو None إذا كان للمهمة طلب نشط
+    """
+    path = trace_request_path(task_id)
+    with trace_lock:
+        current = read_trace_request(path)
+        if current is not None and current['deadline'] > time.time():
+            return None
+        
+        trace_request = {
+            'trace_id': uuid.uuid4().hex,
+            'target': f"task:{task_id}",
+            'deadline': time.time() + duration,
+            'mode': mode
+        }
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(trace_request, f)
+        os.replace(path + '.tmp', path)
+    
+    logger.info(f"🔍 طلب تتبع المهمة {task_id} لمدة {duration:.0f} ثانية ({mode})")
+    return trace_request
+
+
+
+
+def read_trace_request(path):
+    """قراءة ملف طلب تتبع أو None"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+
+
+def poll_task_trace(task_id, part, metrics, session):
+    """
+    بدء جلسة تتبع مهمة عند وجود طلب، أو إنهاء الجلسة المنتهية
+    
+    يُستدعى دوريًا من حلقة معالجة الفيديو؛ بدون طلب تكلفته فحص وجود ملف واحد.
+    
+    المعلمات:
+        task_id: معرف المهمة
+        part: رقم المقطع (لتسمية جزء الجلسة في هذه العملية)
+        metrics: قاموس StageMetrics لحلقة المعالجة
+        session: الجلسة الحالية أو None
+    
+    الإرجاع:
+        الجلسة النشطة أو None
+    """
+    if session is not None:
+        if session.active():
+            return session
+        finish_task_trace(metrics, session)
+        return None
+    
+    path = trace_request_path(task_id)
+    if not os.path.exists(path):
+        return None
+    
+    trace_request = read_trace_request(path)
+    if trace_request is None or trace_request['deadline'] <= time.time():
+        return None
+    
+    session = TraceSession(trace_request['trace_id'], trace_request['target'], trace_request['deadline'],
+                           trace_request['mode'], TRACE_SAMPLE_INTERVAL, label=f"part-{part}")
+    attach_tracer(metrics, session)
+    return session
+
+
+
+
+def finish_task_trace(metrics, session):
+    """فك ربط جلسة تتبع مهمة وحفظ نتيجتها"""
+    attach_tracer(metrics, None)
+    session.stop()
+    try:
+        session.save(TRACES_FOLDER)
+    except Exception as e:
+        logger.error(f"خطأ في حفظ التتبع {session.trace_id}: {str(e)}")
+
+
+
+
+def emit_event(event, data):
+    """إرسال حدث Socket.IO (عبر العملية الرئيسية عند العمل داخل عامل)"""
+    if worker_events is not None:
+        worker_events.put(('emit', event, data))
+    else:
+        publish_event(event, data)
+
+
+
+
+def init_worker_process(events, num_workers):
+    """
+    تهيئة عملية عامل: توجيه الأحداث إلى العملية الرئيسية وتحميل النماذج مرة واحدة
+    
+    المعلمات:
+        events: طابور الأحداث إلى العملية الرئيسية
+        num_workers: عدد العمال (لتقسيم أنوية المعالج بينهم)
+    """
+    global worker_events
+    worker_events = events
+    
+    # تجنب تنافس العمال على نفس الأنوية
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_workers))
+    
+    load_models()
+    logger.info(f"✅ عملية العامل جاهزة (PID {os.getpid()})")
+
+
+
+
+def relay_worker_events(events):
+    """
+    نقل أحداث عمليات العمال إلى قاموس tasks وإلى Socket.IO
+    
+    أنواع الأحداث:
+        ('task', task_id, fields): تحديث حالة مهمة
+        ('emit', event, data): حدث Socket.IO
+        ('segment', task_id, (segment_idx, frames_done, stats)): تقدم مقطع
+        ('analytics', source, (ts, sums, maxes, count)): إحصائيات ثانية مجمعة
+        ('metrics', task_id, (part, states)): مدرجات مراحل مقطع
+    """
+    while True:
+        try:
+            kind, key, payload = events.get()
+            if kind == 'task':
+                task = tasks.setdefault(key, {'id': key})
+                task.update(payload)
+                get_store().save_task(task)
+            elif kind == 'emit':
+                publish_event(key, payload)
+            elif kind == 'analytics':
+                analytics_aggregator.add(key, *payload)
+            elif kind == 'metrics':
+                store_task_metrics(key, *payload)
+            elif kind == 'segment':
+                info = segment_progress.get(key)
+                if info is None:
+                    continue
+                segment_idx, frames_done, stats = payload
+                info['done'][segment_idx] = frames_done
+                progress = min(99, int(sum(info['done'].values()) / max(1, info['total']) * 100))
+                tasks.setdefault(key, {'id': key})['progress'] = progress
+                socketio.emit('task_progress', {
+                    'task_id': key,
+                    'progress': progress,
+                    'stats': stats
+                })
+        except Exception as e:
+            logger.error(f"خطأ في نقل أحداث العمال: {str(e)}")
+
+
+
+
+def upload_worker_main(jobs, events, num_workers):
+    """
+    نقطة دخول عملية عامل الرفع: تحميل النماذج مرة واحدة ثم استهلاك المهام
+    
+    المعلمات:
+        jobs: طابور المهام (video_path, task_id, profile)، و None للإيقاف
+        events: طابور الأحداث إلى العملية الرئيسية
+        num_workers: عدد العمال (لتقسيم أنوية المعالج بينهم)
+    """
+    init_worker_process(events, num_workers)
+    
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        video_path, task_id, profile = job
+        process_video_thread(video_path, task_id, profile)
+
+
+
+
+class UploadWorkerPool:
+    """
+    مجمع عمليات لمعالجة الفيديو المرفوع خارج عملية خادم الويب
+    
+    تُنقل أحداث التقدم والاكتمال من العمال إلى قاموس tasks وإلى Socket.IO.
+    """
+    
+    def __init__(self, num_workers):
+        ctx = multiprocessing.get_context('spawn')
+        self.num_workers = num_workers
+        self.jobs = ctx.Queue()
+        self.events = ctx.Queue()
+        self.workers = []
+        
+        for i in range(num_workers):
+            worker = ctx.Process(
+                target=upload_worker_main,
+                args=(self.jobs, self.events, num_workers),
+                name=f"upload-worker-{i + 1}"
+            )
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        
+        relay_thread = Thread(target=relay_worker_events, args=(self.events,))
+        relay_thread.daemon = True
+        relay_thread.start()
+        
+        logger.info(f"✅ بدأ مجمع عمال الرفع: {num_workers} عملية")
+    
+    def submit(self, video_path, task_id, profile=None):
+        self.jobs.put((video_path, task_id, profile))
+    
+    def snapshot(self):
+        return {
+            'workers': self.num_workers,
+            'alive': sum(1 for worker in self.workers if worker.is_alive())
+        }
+
+
+
+
+def get_upload_pool():
+    """إرجاع مجمع عمال الرفع (يُنشأ عند أول رفع)"""
+    global upload_pool
+    with upload_pool_lock:
+        if upload_pool is None:
+            upload_pool = UploadWorkerPool(UPLOAD_WORKERS)
+        return upload_pool
+
+
+
+
+def process_segment_job(video_path, task_id, segment_idx, start_frame, end_frame, segment_path,
+                        profile=None):
+    """معالجة مقطع واحد داخل عملية عامل المقاطع بنماذج ملف المهمة"""
+    def on_progress(frames_done, stats):
+        worker_events.put(('segment', task_id, (segment_idx, frames_done, stats)))
+    
+    models = acquire_models(profile)
+    try:
+        return process_video_segment(models, video_path, task_id, segment_path,
+                                     start_frame, end_frame, on_progress, part=segment_idx)
+    finally:
+        release_models(models)
+
+
+
+
+class VideoSegmentPool:
+    """مجمع عمليات لمعالجة مقاطع فيديو طويل واحد بالتوازي"""
+    
+    def __init__(self, num_workers):
+        ctx = multiprocessing.get_context('spawn')
+        self.num_workers = num_workers
+        self.events = ctx.Queue()
+        self.executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=ctx,
+            initializer=init_worker_process,
+            initargs=(self.events, num_workers)
+        )
+        
+        relay_thread = Thread(target=relay_worker_events, args=(self.events,))
+        relay_thread.daemon = True
+        relay_thread.start()
+        
+        logger.info(f"✅ بدأ مجمع عمال المقاطع: {num_workers} عملية")
+    
+    def submit(self, *args):
+        return self.executor.submit(process_segment_job, *args)
+
+
+
+
+def get_segment_pool():
+    """إرجاع مجمع عمال المقاطع (يُنشأ عند أول فيديو طويل)"""
+    global segment_pool
+    with upload_pool_lock:
+        if segment_pool is None:
+            segment_pool = VideoSegmentPool(CHUNK_WORKERS)
+        return segment_pool
+
+
+
+
+def find_keyframes(video_path, fps):
+    """
+    إرجاع أرقام الإطارات المفتاحية باستخدام ffprobe إن كان متاحًا
+    
+    الإرجاع:
+        قائمة مرتبة بأرقام الإطارات، أو قائمة فارغة إذا تعذر ذلك
+    """
+    if shutil.which('ffprobe') is None or not fps:
+        return []
+    
+    try:
+        output = subprocess.run(
+            ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+             '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', video_path],
+            capture_output=True, text=True, timeout=120, check=True
+        ).stdout
+    except Exception as e:
+        logger.warning(f"⚠️ تعذر قراءة الإطارات المفتاحية: {str(e)}")
+        return []
+    
+    times = []
+    for line in output.splitlines():
+        parts = line.split(',')
+        if len(parts) >= 2 and 'K' in parts[1] and parts[0] not in ('', 'N/A'):
+            times.append(float(parts[0]))
+    
+    if not times:
+        return []
+    
+    first = min(times)
+    return sorted({int(round((t - first) * fps)) for t in times})
+
+
+
+
+def plan_segments(frame_count, num_segments, keyframes):
+    """
+    تقسيم [0, frame_count) إلى مقاطع متقاربة الطول تبدأ عند إطارات مفتاحية
+    
+    الإرجاع:
+        قائمة (start_frame, end_frame)
+    """
+    bounds = [0]
+    for i in range(1, num_segments):
+        target = frame_count * i // num_segments
+        if keyframes:
+            # أقرب إطار مفتاحي عند الهدف أو بعده
+            pos = bisect.bisect_left(keyframes, target)
+            if pos < len(keyframes):
+                target = keyframes[pos]
+        if bounds[-1] < target < frame_count:
+            bounds.append(target)
+    bounds.append(frame_count)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+
+
+def merge_segments(segment_paths, output_path, fps, size):
+    """
+    دمج ملفات المقاطع المعالجة بالترتيب في ملف الإخراج
+    
+    يُستخدم ffmpeg بدون إعادة ترميز إن كان متاحًا، وإلا يُعاد الكتابة عبر OpenCV.
+    """
+    if shutil.which('ffmpeg') is not None:
+        list_path = output_path + ".segments.txt"
+        try:
+            with open(list_path, 'w') as f:
+                for path in segment_paths:
+                    f.write(f"file '{path}'\n")
+            subprocess.run(
+                ['ffmpeg', '-y', '-v', 'error', '-f', 'concat', '-safe', '0',
+                 '-i', list_path, '-c', 'copy', output_path],
+                capture_output=True, timeout=3600, check=True
+            )
+            return
+        except Exception as e:
+            logger.warning(f"⚠️ فشل دمج المقاطع عبر ffmpeg: {str(e)}, استخدام OpenCV...")
+        finally:
+            if os.path.exists(list_path):
+                os.remove(list_path)
+    
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    out = cv2.VideoWriter(output_path, fourcc, fps, size)
+    for path in segment_paths:
+        cap = cv2.VideoCapture(path)
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            out.write(frame)
+        cap.release()
+    out.release()
+
+
+
+
+def process_video_segment(models, video_path, task_id, output_path,
+                          start_frame=0, end_frame=None, on_progress=None, part=0):
+    """
+    معالجة نطاق من إطارات فيديو وكتابة الإطارات المشروحة إلى output_path
+    
+    المعلمات:
+        models: قاموس النماذج
+        video_path: مسار ملف الفيديو المدخل
+        task_id: معرف المهمة (لأحداث المعاينة والتنبيهات)
+        output_path: مسار ملف الإخراج لهذا النطاق
+        start_frame: أول إطار في النطاق
+        end_frame: الإطار التالي لآخر إطار (None = حتى النهاية)
+        on_progress: دالة (عدد الإطارات المعالجة، إحصائيات الإطار) تُستدعى كل 10 إطارات
+        part: رقم المقطع (لفصل مقاييس المقاطع المتوازية لنفس المهمة)
+    
+    الإرجاع:
+        قاموس النتائج الجزئية (الإجماليات، مجموعات التتبع الفريد، الالتقاطات)
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise RuntimeError("تعذر فتح ملف الفيديو")
+    
+    if start_frame > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+    
+    # الحصول على معلومات الفيديو
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    
+    # إنشاء كاتب الفيديو
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+    
+    # إعداد المعالجة
+    box_thick, font_scale, font_thick = get_dynamic_sizes(width)
+    metrics = {name: StageMetrics() for name in TASK_STAGES}
+    analyzer = StridedAnalyzer(metrics=metrics)
+    # كل مهام الرفع في مصدر واحد حتى لا تتزايد الحلقات مع كل مهمة (إجماليات المهمة في سجلها)
+    stats_folder = StatsFolder(UPLOADS_ANALYTICS_SOURCE, record_analytics)
+    trace = poll_task_trace(task_id, part, metrics, None)
+    
+    # عدادات الإحصائيات
+    total_persons = 0
+    total_bags = 0
+    total_weapons = 0
+    total_masks = 0
+    total_no_masks = 0
+    
+    # العد الفريد بمعرفات المتتبع
+    seen_persons = set()
+    seen_bags = set()
+    seen_weapons = set()
+    
+    # التقاطات للكشف (مرة واحدة لكل مسار)
+    captures = []
+    captured_tracks = set()
+    
+    # معالجة الإطارات
+    frame_idx = 0
+    process_fps = 0
+    start_time = time.time()
+    
+    # حالة التنبيه
+    alert_active = False
+    alert_type = ""
+    blink = True
+    blink_timer = time.time()
+    
+    # التقاط كل 3 ثوانٍ للكشف الفريد
+    last_capture_time = 0
+    CAPTURE_INTERVAL = 3  # ثوانٍ
+    
+    # إحصائيات لكل إطار
+    stats = empty_stats()
+    
+    # حلقة المعالجة الرئيسية
+    while end_frame is None or start_frame + frame_idx < end_frame:
+        t0 = time.time()
+        ret, frame = cap.read()
+        if not ret:
+            break
+        metrics['decode'].record(time.time() - t0)
+        
+        # تحديث FPS وحالة الوميض
+        frame_idx += 1
+        now = time.time()
+        elapsed = now - start_time
+        if elapsed > 1:
+            process_fps = frame_idx / elapsed
+        
+        if now - blink_timer >= 0.3:
+            blink = not blink
+            blink_timer = now
+        
+        # إرسال تحديث التقدم كل 10 إطارات لتجنب الفيضان
+        if on_progress is not None and frame_idx % 10 == 0:
+            on_progress(frame_idx, stats)
+        
+        # المعالجة باستخدام YOLO (تغيير الحجم للمعالجة الأسرع)
+        analysis = analyzer.analyze(models, frame, (PROCESS_WIDTH, PROCESS_HEIGHT))
+        stats = analysis['stats']
+        stats_folder.add(stats, now)
+        
+        # تحديث الإجماليات والتتبع الفريد
+        for det in analysis['detections']:
+            track_id = det.get('track_id')
+            
+            # حقائب
+            if det['kind'] == 'bag':
+                total_bags += 1
+                seen_bags.add(first_seen_key(det))
+            
+            # أشخاص
+            elif det['kind'] == 'person':
+                total_persons += 1
+                if track_id is not None:
+                    seen_persons.add(track_id)
+            
+            # أسلحة
+            elif det['kind'] == 'weapon':
+                total_weapons += 1
+                weapon_type = det['label']
+                seen_weapons.add(first_seen_key(det))
+                
+                alert_active = True
+                alert_type = weapon_type.upper()
+                
+                # التقاط الكشف مرة لكل مسار (أو حسب الفاصل الزمني قبل تأكيد المسار)
+                if should_capture(captured_tracks, 'weapon', track_id, now, last_capture_time, CAPTURE_INTERVAL):
+                    capture_path = capture_frame(frame, weapon_type, det['box'], task_id=task_id)
+                    captures.append({
+                        'type': weapon_type,
+                        'path': capture_path,
+                        'confidence': round(det['conf'] * 100),
+                        'timestamp': datetime.now().strftime("%H:%M:%S")
+                    })
+                    last_capture_time = now
+        
+        for face in analysis['faces']:
+            if face['has_mask']:
+                total_masks += 1
+            else:
+                total_no_masks += 1
+                
+                # التقاط كشف بدون قناع مرة لكل مسار
+                if should_capture(captured_tracks, 'no_mask', face.get('track_id'), now, last_capture_time, CAPTURE_INTERVAL):
+                    capture_path = capture_frame(frame, "NoMask", face['box'], task_id=task_id)
+                    captures.append({
+                        'type': 'NoMask',
+                        'path': capture_path,
+                        'confidence': round(face['conf'] * 100),
+                        'timestamp': datetime.now().strftime("%H:%M:%S")
+                    })
+                    last_capture_time = now
+        
+        # رسم الكشوفات
+        t0 = time.time()
+        render_analysis(frame, analysis, box_thick, font_scale, font_thick)
+        
+        # رسم لوحة المعلومات
+        draw_dashboard(frame, process_fps, stats, alert_active)
+        
+        # رسم التنبيه إذا كان نشطًا
+        if alert_active:
+            draw_alert(frame, alert_type, blink)
+        t1 = time.time()
+        metrics['draw'].record(t1 - t0)
+        
+        # كتابة الإطار
+        out.write(frame)
+        metrics['encode'].record(time.time() - t1)
+        
+        # كل 30 إطارًا، إرسال إطار عبر Socket.IO
+        if frame_idx % 30 == 0:
+            t0 = time.time()
+            _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
+            frame_base64 = base64.b64encode(buffer).decode('utf-8')
+            emit_event('video_frame', {
+                'task_id': task_id,
+                'frame': frame_base64,
+                'frame_number': start_frame + frame_idx,
+                'stats': stats
+            })
+            metrics['emit'].record(time.time() - t0)
+            report_task_metrics(task_id, part, metrics)
+            trace = poll_task_trace(task_id, part, metrics, trace)
+    
+    # تحرير الموارد
+    stats_folder.flush()
+    report_task_metrics(task_id, part, metrics)
+    if trace is not None:
+        finish_task_trace(metrics, trace)
+    cap.release()
+    out.release()
+    
+    logger.info(f"إطارات مستدل عليها: {analyzer.inferred}, منقولة: {analyzer.propagated}")
+    
+    return {
+        'frames': frame_idx,
+        'elapsed': time.time() - start_time,
+        'fps': process_fps,
+        'totals': {
+            'persons': total_persons,
+            'bags': total_bags,
+            'weapons': total_weapons,
+            'mask': total_masks,
+            'no_mask': total_no_masks
+        },
+        'seen_persons': seen_persons,
+        'seen_bags': seen_bags,
+        'seen_weapons': seen_weapons,
+        'captures': captures
+    }
+
+
+
+
+def process_video_chunked(video_path, task_id, output_path, frame_count, fps, size, profile=None):
+    """
+    معالجة فيديو طويل على مقاطع متوازية ثم دمجها ودمج نتائجها
+    
+    الإرجاع:
+        قاموس النتائج بنفس شكل process_video_segment
+    """
+    keyframes = find_keyframes(video_path, fps)
+    segments = plan_segments(frame_count, CHUNK_WORKERS, keyframes)
+    logger.info(f"تقسيم المهمة {task_id} إلى {len(segments)} مقاطع (إطارات مفتاحية: {len(keyframes)})")
+    
+    pool = get_segment_pool()
+    segment_progress[task_id] = {'total': frame_count, 'done': {}}
+    segment_paths = [f"{output_path}.part{idx}.mp4" for idx in range(len(segments))]
+    
+    try:
+        futures = [
+            pool.submit(video_path, task_id, idx, start, end, segment_paths[idx], profile)
+            for idx, (start, end) in enumerate(segments)
+        ]
+        start_time = time.time()
+        parts = [future.result() for future in futures]
+        elapsed = time.time() - start_time
+        
+        merge_segments(segment_paths, output_path, fps, size)
+    finally:
+        segment_progress.pop(task_id, None)
+        for path in segment_paths:
+            if os.path.exists(path):
+                os.remove(path)
+    
+    # دمج النتائج الجزئية
+    result = {
+        'frames': 0,
+        'elapsed': elapsed,
+        'totals': {key: 0 for key in parts[0]['totals']},
+        'seen_persons': set(),
+        'seen_bags': set(),
+        'seen_weapons': set(),
+        'captures': []
+    }
+    for idx, part in enumerate(parts):
+        result['frames'] += part['frames']
+        for key, value in part['totals'].items():
+            result['totals'][key] += value
+        # معرفات المسارات محلية لكل مقطع
+        result['seen_persons'] |= {(idx, key) for key in part['seen_persons']}
+        result['seen_bags'] |= {(idx, key) for key in part['seen_bags']}
+        result['seen_weapons'] |= {(idx, key) for key in part['seen_weapons']}
+        result['captures'].extend(part['captures'])
+    result['fps'] = result['frames'] / elapsed if elapsed > 0 else 0
+    
+    return result
+
+
+
+
+def process_video_thread(video_path, task_id, profile=None):
+    """
+    معالجة ملف فيديو في مؤشر ترابط خلفي وتحديث حالة المهمة
+    
+    المعلمات:
+        video_path: مسار ملف الفيديو المدخل
+        task_id: معرف المهمة لتتبع التقدم
+        profile: ملف النماذج في MODEL_PROFILES (None = DEFAULT_MODEL_PROFILE)
+    """
+    # تحديث حالة المهمة إلى معالجة
+    update_task(task_id, status='processing', progress=0)
     
     try:
         # التحقق من وجود ملف الفيديو
         if not os.path.exists(video_path):
             logger.error(f"خطأ: ملف الفيديو غير موجود: {video_path}")
-            tasks[task_id]['status'] = 'error'
-            tasks[task_id]['error'] = "ملف الفيديو غير موجود"
+            update_task(task_id, status='error', error="ملف الفيديو غير موجود")
             return
         
         logger.info(f"بدء معالجة الفيديو: {video_path} للمهمة: {task_id}")
         
-        # الحصول على النماذج
-        models = load_models()
-        
         # فتح الفيديو
         cap = cv2.VideoCapture(video_path)
         if not cap.isOpened():
             logger.error(f"تعذر فتح ملف الفيديو: {video_path}")
-            tasks[task_id]['status'] = 'error'
-            tasks[task_id]['error'] = "تعذر فتح ملف الفيديو"
+            update_task(task_id, status='error', error="تعذر فتح ملف الفيديو")
             return
         
         # الحصول على معلومات الفيديو
@@ -444,6 +3321,7 @@ def process_video_thread(video_path, task_id):
         width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
         frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
         
         logger.info(f"معلومات الفيديو: {width}x{height}, FPS: {fps}, الإطارات: {frame_count}")
         
@@ -451,276 +3329,38 @@ def process_video_thread(video_path, task_id):
         output_filename = f"processed_{os.path.basename(video_path)}"
         output_path = os.path.join(PROCESSED_FOLDER, output_filename)
         
-        # إنشاء كاتب الفيديو
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
-        
-        # إعداد المعالجة
-        box_thick, font_scale, font_thick = get_dynamic_sizes(width)
-        
-        # عوامل التحجيم لكشف YOLO
-        scale_x = width / PROCESS_WIDTH
-        scale_y = height / PROCESS_HEIGHT
-        
-        # عدادات الإحصائيات
-        total_persons = 0
-        total_bags = 0
-        total_weapons = 0
-        total_masks = 0
-        total_no_masks = 0
-        
-        # تتبع العدد الفريد (تتبع بسيط)
-        seen_persons = set()
-        seen_bags = set()
-        seen_weapons = set()
-        
-        # التقاطات للكشف
-        captures = []
-        
-        # كشف الوجه - تحضير المتغيرات إذا كان CLIP متاحًا
-        if models['clip_model'] is not None:
-            face_detector = models['face_cascade']
-            clip_model = models['clip_model']
-            clip_proc = models['clip_proc']
-            use_openai_clip = models['use_openai_clip']
-            device = models['device']
-        
-        # معالجة الإطارات
-        frame_idx = 0
-        process_fps = 0
-        start_time = time.time()
-        
-        # حالة التنبيه
-        alert_active = False
-        alert_type = ""
-        blink = True
-        blink_timer = time.time()
-        
-        # التقاط كل 3 ثوانٍ للكشف الفريد
-        last_capture_time = 0
-        CAPTURE_INTERVAL = 3  # ثوانٍ
-        
-        # إحصائيات لكل إطار
-        stats = {
-            'persons': 0,
-            'bags': 0,
-            'mask': 0,
-            'no_mask': 0,
-            'weapons': 0,
-            'drones': 0  # مكان، غير منفذ في هذه النسخة
-        }
+        # التقسيم المتوازي للفيديوهات الطويلة فقط، وليس داخل عمليات العمال
+        duration = frame_count / fps if fps > 0 else 0
+        use_chunks = (CHUNK_WORKERS > 1 and worker_events is None
+                      and duration >= CHUNK_MIN_SECONDS)
         
-        # حلقة المعالجة الرئيسية
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-            
-            # تحديث FPS وحالة الوميض
-            frame_idx += 1
-            now = time.time()
-            elapsed = now - start_time
-            if elapsed > 1:
-                process_fps = frame_idx / elapsed
-            
-            if now - blink_timer >= 0.3:
-                blink = not blink
-                blink_timer = now
-            
-            # تحديث التقدم
-            progress = min(99, int((frame_idx / frame_count) * 100))
-            tasks[task_id]['progress'] = progress
-            
-            # إرسال تحديث التقدم عبر Socket.IO
-            if frame_idx % 10 == 0:  # إرسال التقدم كل 10 إطارات لتجنب الفيضان
-                socketio.emit('task_progress', {
+        if use_chunks:
+            result = process_video_chunked(video_path, task_id, output_path,
+                                           frame_count, fps, (width, height), profile)
+        else:
+            def on_progress(frames_done, stats):
+                progress = min(99, int(frames_done / max(1, frame_count) * 100))
+                update_task(task_id, progress=progress)
+                emit_event('task_progress', {
                     'task_id': task_id,
                     'progress': progress,
                     'stats': stats
                 })
             
-            # المعالجة باستخدام YOLO (تغيير الحجم للمعالجة الأسرع)
-            small = cv2.resize(frame, (PROCESS_WIDTH, PROCESS_HEIGHT))
-            results = models['yolo'](small, conf=YOLO_CONF, iou=YOLO_IOU, verbose=False)
-            
-            # إعادة تعيين إحصائيات الإطار
-            stats = {
-                'persons': 0,
-                'bags': 0,
-                'mask': 0,
-                'no_mask': 0,
-                'weapons': 0,
-                'drones': 0
-            }
-            
-            persons = []
-            
-            # معالجة نتائج YOLO
-            for r in results:
-                if r.boxes is None:
-                    continue
-                
-                for box in r.boxes:
-                    cid = int(box.cls[0])
-                    # تغيير حجم الإحداثيات إلى الدقة الأصلية
-                    x1 = int(box.xyxy[0][0] * scale_x)
-                    y1 = int(box.xyxy[0][1] * scale_y)
-                    x2 = int(box.xyxy[0][2] * scale_x)
-                    y2 = int(box.xyxy[0][3] * scale_y)
-                    conf = float(box.conf[0])
-                    
-                    # حساب المركز للتتبع
-                    center_x = (x1 + x2) // 2
-                    center_y = (y1 + y2) // 2
-                    
-                    # حقائب
-                    if cid in BAG_IDS:
-                        stats['bags'] += 1
-                        total_bags += 1
-                        seen_bags.add((center_x // 50, center_y // 50))  # إلغاء التكرار البسيط
-                        
-                        draw_box(frame, x1, y1, x2, y2, C_YELLOW, f"{BAG_IDS[cid]}: {conf:.2f}", 
-                                box_thick, font_scale, font_thick)
-                    
-                    # أشخاص
-                    elif cid == PERSON_ID:
-                        stats['persons'] += 1
-                        total_persons += 1
-                        seen_persons.add((center_x // 50, center_y // 50))  # إلغاء التكرار البسيط
-                        
-                        cv2.rectangle(frame, (x1, y1), (x2, y2), C_BLUE, box_thick)
-                        cv2.putText(frame, f"Person: {conf:.2f}", (x1, y2+20), 
-                                    cv2.FONT_HERSHEY_SIMPLEX, font_scale, C_BLUE, font_thick)
-                        
-                        # إضافة إلى قائمة الأشخاص للكشف عن القناع
-                        persons.append((x1, y1, x2, y2))
-                    
-                    # أسلحة
-                    elif cid in WEAPON_CLASSES:
-                        stats['weapons'] += 1
-                        total_weapons += 1
-                        weapon_type = WEAPON_CLASSES[cid]
-                        seen_weapons.add((weapon_type, center_x // 50, center_y // 50))
-                        
-                        draw_box(frame, x1, y1, x2, y2, C_RED, f"{weapon_type}: {conf:.2f}", 
-                                box_thick + 2, font_scale + 0.2, font_thick)
-                        
-                        alert_active = True
-                        alert_type = weapon_type.upper()
-                        
-                        # التقاط الكشف إذا مر الفاصل الزمني
-                        if now - last_capture_time >= CAPTURE_INTERVAL:
-                            capture_path = capture_frame(frame, weapon_type, (x1, y1, x2, y2))
-                            captures.append({
-                                'type': weapon_type,
-                                'path': capture_path,
-                                'confidence': round(conf * 100),
-                                'timestamp': datetime.now().strftime("%H:%M:%S")
-                            })
-                            last_capture_time = now
-            
-            # معالجة الوجوه للكشف عن القناع إذا كان CLIP متاحًا
-            if models['clip_model'] is not None:
-                for (px1, py1, px2, py2) in persons:
-                    roi = frame[py1:py2, px1:px2]
-                    if roi.size == 0:
-                        continue
-                    
-                    gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
-                    faces = face_detector.detectMultiScale(gray, 1.15, 3, minSize=(25, 25))
-                    
-                    for (fx, fy, fw, fh) in faces:
-                        if fw < 30:
-                            continue
-                        
-                        face = roi[fy:fy+fh, fx:fx+fw]
-                        if face.size < 400:
-                            continue
-                        
-                        # تحسين الصورة
-                        face = enhance_face(face)
-                        
-                        small = cv2.resize(face, (56, 56))
-                        rgb = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
-                        pil = Image.fromarray(rgb)
-                        
-                        if use_openai_clip:
-                            # استخدام OpenAI CLIP الأصلي
-                            image = clip_proc(pil).unsqueeze(0).to(device)
-                            text = clip.tokenize(CLIP_LABELS).to(device)
-                            
-                            with torch.no_grad():
-                                logits_per_image, _ = clip_model(image, text)
-                                probs = logits_per_image.softmax(dim=-1)
-                        else:
-                            # استخدام HuggingFace transformers CLIP
-                            inputs = clip_proc(
-                                text=CLIP_LABELS, images=pil,
-                                return_tensors="pt", padding=True
-                            ).to(device)
-                            
-                            with torch.no_grad():
-                                out = clip_model(**inputs)
-                                probs = out.logits_per_image.softmax(dim=1)
-                        
-                        idx = probs.argmax().item()
-                        conf = probs[0][idx].item()
-                        has_mask = (idx == 0)  # تم تغييره من 1 إلى 0 لأننا عكسنا ترتيب التسميات
-                        
-                        color = C_GREEN if has_mask else C_RED
-                        label = "NO MASK" if has_mask else "MASK"
-                        
-                        # تحديث الإحصائيات
-                        if has_mask:
-                            stats['mask'] += 1
-                            total_masks += 1
-                        else:
-                            stats['no_mask'] += 1
-                            total_no_masks += 1
-                            
-                            # التقاط كشف بدون قناع إذا مر الفاصل الزمني
-                            if now - last_capture_time >= CAPTURE_INTERVAL:
-                                capture_path = capture_frame(frame, "NoMask", (px1+fx, py1+fy, px1+fx+fw, py1+fy+fh))
-                                captures.append({
-                                    'type': 'NoMask',
-                                    'path': capture_path,
-                                    'confidence': round(conf * 100),
-                                    'timestamp': datetime.now().strftime("%H:%M:%S")
-                                })
-                                last_capture_time = now
-                        
-                        draw_box(frame, px1+fx, py1+fy, px1+fx+fw, py1+fy+fh, color, 
-                                f"{label}: {conf:.2f}", box_thick, font_scale, font_thick)
-            
-            # رسم لوحة المعلومات
-            draw_dashboard(frame, process_fps, stats, alert_active)
-            
-            # رسم التنبيه إذا كان نشطًا
-            if alert_active:
-                draw_alert(frame, alert_type, blink)
-            
-            # كتابة الإطار
-            out.write(frame)
-            
-            # كل 30 إطارًا، إرسال إطار عبر Socket.IO
-            if frame_idx % 30 == 0:
-                _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
-                frame_base64 = base64.b64encode(buffer).decode('utf-8')
-                socketio.emit('video_frame', {
-                    'task_id': task_id,
-                    'frame': frame_base64,
-                    'frame_number': frame_idx,
-                    'stats': stats
-                })
+            models = acquire_models(profile)
+            try:
+                result = process_video_segment(models, video_path, task_id, output_path,
+                                               on_progress=on_progress)
+            finally:
+                release_models(models)
         
-        # تحرير الموارد
-        cap.release()
-        out.release()
+        frame_idx = result['frames']
+        totals = result['totals']
         
         # إعداد إحصائيات الملخص
-        unique_persons = len(seen_persons)
-        unique_bags = len(seen_bags)
-        unique_weapons = len(seen_weapons)
+        unique_persons = len(result['seen_persons'])
+        unique_bags = len(result['seen_bags'])
+        unique_weapons = len(result['seen_weapons'])
         
         # إنشاء صورة مصغرة
         thumbnail_path = os.path.join(PROCESSED_FOLDER, f"thumb_{os.path.basename(video_path)}.jpg")
@@ -731,37 +3371,37 @@ def process_video_thread(video_path, task_id):
         cap.release()
         
         # تحديث المهمة بالنتائج
-        tasks[task_id].update({
+        update_task(task_id, **{
             'status': 'completed',
             'progress': 100,
             'output_path': f"/static/processed/{output_filename}",
             'thumbnail': f"/static/processed/thumb_{os.path.basename(video_path)}.jpg",
-            'captures': captures,
+            'captures': result['captures'],
             'stats': {
                 'duration': frame_idx/fps if fps > 0 else 0,
                 'frames': frame_idx,
                 'persons': {
                     'unique': unique_persons,
-                    'total': total_persons
+                    'total': totals['persons']
                 },
                 'bags': {
                     'unique': unique_bags,
-                    'total': total_bags
+                    'total': totals['bags']
                 },
                 'weapons': {
                     'unique': unique_weapons, 
-                    'total': total_weapons
+                    'total': totals['weapons']
                 },
-                'mask': total_masks,
-                'no_mask': total_no_masks,
-                'fps': process_fps
+                'mask': totals['mask'],
+                'no_mask': totals['no_mask'],
+                'fps': result['fps']
             }
         })
         
         logger.info(f"اكتملت معالجة الفيديو للمهمة: {task_id}")
         
         # إرسال إشعار الاكتمال عبر Socket.IO
-        socketio.emit('task_completed', {
+        emit_event('task_completed', {
             'task_id': task_id,
             'output_path': f"/static/processed/{output_filename}",
             'thumbnail': f"/static/processed/thumb_{os.path.basename(video_path)}.jpg",
@@ -772,9 +3412,8 @@ def process_video_thread(video_path, task_id):
         logger.error(f"خطأ في معالجة الفيديو للمهمة {task_id}: {str(e)}")
         import traceback
         logger.error(traceback.format_exc())
-        tasks[task_id]['status'] = 'error'
-        tasks[task_id]['error'] = str(e)
-        socketio.emit('task_error', {
+        update_task(task_id, status='error', error=str(e))
+        emit_event('task_error', {
             'task_id': task_id,
             'error': str(e)
         })
@@ -782,19 +3421,652 @@ def process_video_thread(video_path, task_id):
 
 
 
-def process_stream(stream_id, source_type, source_path=None, rtsp_url=None):
+class DropOldestQueue:
+    """
+    طابور محدود يُسقط أقدم عنصر عند الامتلاء
+    
+    يضمن أن المرحلة التالية تعالج دائمًا أحدث إطار بدلاً من تراكم التأخير.
+    """
+    
+    def __init__(self, maxsize=1):
+        self.maxsize = maxsize
+        self.items = deque(maxlen=maxsize)
+        self.dropped = 0
+        self.cond = Condition()
+    
+    def put(self, item):
+        with self.cond:
+            if len(self.items) == self.maxsize:
+                self.dropped += 1
+            self.items.append(item)
+            self.cond.notify()
+    
+    def get(self, timeout=None):
+        """إرجاع أقدم عنصر متاح أو None عند انتهاء المهلة"""
+        with self.cond:
+            if not self.items:
+                self.cond.wait(timeout)
+            return self.items.popleft() if self.items else None
+    
+    def snapshot(self):
+        return {
+            'depth': len(self.items),
+            'maxsize': self.maxsize,
+            'dropped': self.dropped
+        }
+
+
+
+
+class PreviewFrame:
+    """
+    إطار مرسوم جاهز للمعاينة بعدة مستويات
+    
+    كل مستوى يُرمّز عند أول طلب ويُخزّن، فيحصل كل مشاهدي المستوى نفسه
+    على نفس كائن البايتات.
+    """
+    
+    def __init__(self, frame):
+        self.frame = frame
+        self.lock = Lock()
+        self.encoded = {}
+    
+    def encode(self, tier):
+        """
+        ترميز الإطار بمستوى معاينة
+        
+        المعلمات:
+            tier: اسم المستوى من PREVIEW_TIERS
+            
+        الإرجاع:
+            بايتات JPEG
+        """
+        with self.lock:
+            jpeg = self.encoded.get(tier)
+            if jpeg is None:
+                max_width, quality = PREVIEW_TIERS[tier]
+                image = self.frame
+                height, width = image.shape[:2]
+                if max_width and width > max_width:
+                    image = cv2.resize(image, (max_width, int(height * max_width / width)),
+                                       interpolation=cv2.INTER_AREA)
+                _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+                jpeg = buffer.tobytes()
+                self.encoded[tier] = jpeg
+            return jpeg
+
+
+
+
+class StreamSubscription:
+    """اشتراك عميل Socket.IO في بث: المستوى المطلوب والمستوى الحالي وتأكيدات الاستلام"""
+    
+    def __init__(self, sid, tier):
+        self.sid = sid
+        self.requested = tier
+        self.tier = tier
+        self.acked = None  # None حتى أول تأكيد؛ العملاء بلا تأكيدات لا يُخفّضون
+        self.ack_latency = None  # زمن آخر إرسال حتى تأكيده
+        self.dropped = 0  # إطارات أُسقطت من طابور العميل لهذا الاشتراك
+        self.drops_seen = 0
+        self.congested_at = 0.0
+        self.changed_at = 0.0
+
+
+
+
+def move_subscription(stream_id, subscription, tier):
+    """نقل اشتراك إلى مستوى معاينة آخر وإخطار العميل"""
+    subscription.tier = tier
+    socketio.emit('preview_tier', {'stream_id': stream_id, 'tier': tier}, to=subscription.sid)
+
+
+
+
+class ClientSender:
+    """
+    طابور إرسال إطارات البث لعميل Socket.IO واحد
+    
+    لكل بث إطار واحد على الأكثر قيد الإرسال حتى يؤكد العميل استلامه، وطابور
+    صغير من الإطارات المعلقة يُسقط الأقدم عند الامتلاء، فلا يتراكم شيء في
+    خادم Socket.IO مهما كان اتصال العميل بطيئًا. التنبيهات وأحداث المهام لا
+    تمر من هنا وتبقى مضمونة التسليم.
+    """
+    
+    def __init__(self, sid, queue_size=CLIENT_QUEUE_SIZE, ack_timeout=CLIENT_ACK_TIMEOUT):
+        self.sid = sid
+        self.queue_size = queue_size
+        self.ack_timeout = ack_timeout
+        self.cond = Condition()
+        self.pending = {}  # stream_id ← deque من (payload, subscription, queued_at)
+        self.inflight = {}  # stream_id ← وقت الإرسال
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.timeouts = 0
+        self.lag = StageMetrics()  # مدة انتظار الإطار في الطابور
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+    
+    def offer(self, stream_id, payload, subscription):
+        """إضافة إطار لبث؛ يُسقط أقدم إطار معلق لنفس البث عند الامتلاء"""
+        with self.cond:
+            queue = self.pending.setdefault(stream_id, deque())
+            if len(queue) >= self.queue_size:
+                queue.popleft()[1].dropped += 1
+                self.dropped += 1
+            queue.append((payload, subscription, time.time()))
+            self.cond.notify()
+    
+    def _acked(self, stream_id, subscription, seq):
+        with self.cond:
+            sent_at = self.inflight.pop(stream_id, None)
+            if sent_at is not None:
+                subscription.ack_latency = time.time() - sent_at
+            subscription.acked = max(subscription.acked or 0, seq)
+            self.cond.notify()
+    
+    def _next(self):
+        """اختيار الإطار المعلق الأقدم لبث ليس له إطار قيد الإرسال"""
+        now = time.time()
+        for stream_id, sent_at in list(self.inflight.items()):
+            if now - sent_at > self.ack_timeout:
+                del self.inflight[stream_id]
+                self.timeouts += 1
+        
+        ready = [sid for sid, queue in self.pending.items()
+                 if queue and sid not in self.inflight]
+        if not ready:
+            return None
+        stream_id = min(ready, key=lambda sid: self.pending[sid][0][2])
+        return (stream_id,) + self.pending[stream_id].popleft()
+    
+    def run(self):
+        while True:
+            with self.cond:
+                item = self._next()
+                while item is None and not self.closed:
+                    self.cond.wait(0.5)
+                    item = self._next()
+                if self.closed:
+                    return
+                stream_id, payload, subscription, queued_at = item
+                self.inflight[stream_id] = time.time()
+            
+            self.lag.record(time.time() - queued_at)
+            socketio.emit('stream_frame', payload, to=self.sid,
+                          callback=lambda *args, stream_id=stream_id, subscription=subscription,
+                          seq=payload['seq']: self._acked(stream_id, subscription, seq))
+            self.sent += 1
+    
+    def backlog(self, stream_id, now):
+        """تأخر بث لدى هذا العميل: عمر أقدم إطار معلق أو الإطار قيد الإرسال"""
+        with self.cond:
+            queue = self.pending.get(stream_id)
+            waiting = now - queue[0][2] if queue else 0.0
+            sent_at = self.inflight.get(stream_id)
+            unacked = now - sent_at if sent_at is not None else 0.0
+        return max(waiting, unacked)
+    
+    def discard(self, stream_id):
+        """إسقاط إطارات بث لم يعد العميل مشتركًا فيه"""
+        with self.cond:
+            self.pending.pop(stream_id, None)
+            self.inflight.pop(stream_id, None)
+    
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+    
+    def snapshot(self):
+        with self.cond:
+            queued = sum(len(queue) for queue in self.pending.values())
+            inflight = len(self.inflight)
+        return {
+            'sid': self.sid,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'ack_timeouts': self.timeouts,
+            'queued': queued,
+            'inflight': inflight,
+            'lag': self.lag.snapshot()
+        }
+
+
+
+
+def retire_client_sender(sender):
+    """إضافة عدادات عميل منقطع إلى الإجماليات (يُستدعى مع subscription_lock)"""
+    retired_client_stats['sent'] += sender.sent
+    retired_client_stats['dropped'] += sender.dropped
+    retired_client_stats['timeouts'] += sender.timeouts
+    states = [sender.lag.state()]
+    if retired_client_stats['lag'] is not None:
+        states.append(retired_client_stats['lag'])
+    retired_client_stats['lag'] = merge_metric_states(states)
+
+
+
+
+def adapt_preview_tiers(stream_id, frame_interval, now):
+    """
+    خفض مستوى المشتركين البطيئين ورفعه بعد زوال الازدحام
+    
+    الازدحام يُقاس من طابور إرسال العميل نفسه: إطارات أُسقطت منه منذ آخر فحص،
+    أو انتظار إطار في الطابور أو تأكيد استلامه أطول من PREVIEW_MAX_BACKLOG
+    فترة إطار. الرفع خطوة واحدة بعد PREVIEW_RECOVER_SECONDS بلا ازدحام ولا
+    تغيير مستوى.
+    
+    المعلمات:
+        stream_id: معرف البث
+        frame_interval: الفترة بين إطارات البث (ثوانٍ)
+        now: الوقت الحالي
+        
+    الإرجاع:
+        عدد الاشتراكات التي خُفّض مستواها
+    """
+    tiers = list(PREVIEW_TIERS)
+    max_delay = PREVIEW_MAX_BACKLOG * frame_interval
+    downgraded = 0
+    
+    with subscription_lock:
+        subscriptions = list(stream_subscribers.get(stream_id, {}).values())
+    
+    for sub in subscriptions:
+        sender = client_senders.get(sub.sid)
+        if sender is None or sub.acked is None:
+            continue
+        
+        dropped = sub.dropped - sub.drops_seen
+        sub.drops_seen = sub.dropped
+        delay = max(sender.backlog(stream_id, now), sub.ack_latency or 0.0)
+        
+        level = tiers.index(sub.tier)
+        if dropped > 0 or delay > max_delay:
+            sub.congested_at = now
+            if level > 0:
+                move_subscription(stream_id, sub, tiers[level - 1])
+                sub.ack_latency = None  # قياس جديد للمستوى الجديد
+                sub.changed_at = now
+                downgraded += 1
+        elif (sub.tier != sub.requested
+              and now - max(sub.congested_at, sub.changed_at) >= PREVIEW_RECOVER_SECONDS):
+            move_subscription(stream_id, sub, tiers[level + 1])
+            sub.changed_at = now
+    
+    return downgraded
+
+
+
+
+class FrameBroadcaster:
+    """
+    آخر إطار معاينة (PreviewFrame) لبث واحد
+    
+    يُرسم الإطار مرة واحدة ويُرمّز مرة لكل مستوى، ويحصل كل مشترك على نفس
+    كائن البايتات بدون نسخ.
+    """
+    
+    def __init__(self):
+        self.cond = Condition()
+        self.frame = None
+        self.seq = 0
+        self.closed = False
+        self.viewers = 0  # عدد عملاء MJPEG المتصلين
+    
+    def publish(self, preview):
+        with self.cond:
+            self.frame = preview
+            self.seq += 1
+            self.cond.notify_all()
+    
+    def wait(self, last_seq, timeout=1.0):
+        """انتظار إطار أحدث من last_seq وإرجاع (seq, frame)"""
+        with self.cond:
+            if self.seq == last_seq and not self.closed:
+                self.cond.wait(timeout)
+            return self.seq, self.frame
+    
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+
+
+class StreamPipeline:
+    """
+    خط معالجة مرحلي لبث واحد: التقاط ← استدلال ← رسم/ترميز/إرسال
+    
+    كل مرحلة في مؤشر ترابط مستقل وتتصل بالتالية عبر طابور يُسقط الأقدم،
+    فلا يعطل انتظار الإدخال/الإخراج الاستدلال ولا العكس.
+    """
+    
+    STAGES = ('decode', 'resize', 'yolo', 'haar', 'clip', 'flow', 'infer',
+              'draw', 'encode', 'emit', 'record', 'end_to_end')
+    
+    def __init__(self, stream_id, queue_size=STREAM_QUEUE_SIZE):
+        self.stream_id = stream_id
+        self.infer_queue = DropOldestQueue(queue_size)
+        self.output_queue = DropOldestQueue(queue_size)
+        self.record_queue = DropOldestQueue(CLIP_RECORD_QUEUE_SIZE)
+        self.metrics = {name: StageMetrics() for name in self.STAGES}
+        self.analyzer = StridedAnalyzer(metrics=self.metrics)
+        self.motion_gate = MotionGate()
+        self.broadcaster = FrameBroadcaster()
+        self.recorder = ClipRecorder(stream_id)
+        self.stop_event = Event()
+        self.error = None
+        self.skipped = 0  # إطارات لم تُرمّز لعدم وجود مشاهدين
+        self.frame_seq = 0  # رقم آخر إطار مُرسل للمشتركين
+        self.downgrades = 0
+        self.trace = None  # جلسة التتبع المربوطة بمقاييس المراحل
+    
+    def running(self):
+        """هل يجب أن تستمر المراحل في العمل"""
+        info = active_streams.get(self.stream_id)
+        return (not self.stop_event.is_set()
+                and info is not None
+                and info['status'] == 'streaming')
+    
+    def fail(self, stage, error):
+        """تسجيل خطأ مرحلة وإيقاف باقي المراحل"""
+        logger.error(f"خطأ في مرحلة {stage} للبث {self.stream_id}: {str(error)}")
+        if self.error is None:
+            self.error = error
+        self.stop_event.set()
+    
+    def subscribers(self):
+        """عدد مشتركي Socket.IO في غرفة البث"""
+        with subscription_lock:
+            return len(stream_subscribers.get(self.stream_id, ()))
+    
+    def subscriptions(self):
+        """اشتراكات Socket.IO الحالية في البث"""
+        with subscription_lock:
+            return list(stream_subscribers.get(self.stream_id, {}).values())
+    
+    def active_tiers(self):
+        """مستويات المعاينة التي لها مشترك واحد على الأقل"""
+        return {sub.tier for sub in self.subscriptions()}
+    
+    def has_viewers(self):
+        """هل يوجد من يشاهد البث عبر Socket.IO أو MJPEG"""
+        return self.broadcaster.viewers > 0 or self.subscribers() > 0
+    
+    def snapshot(self):
+        return {
+            'stages': {name: m.snapshot() for name, m in self.metrics.items()},
+            'viewers': {
+                'socketio': self.subscribers(),
+                'mjpeg': self.broadcaster.viewers,
+                'tiers': sorted(self.active_tiers()),
+                'downgrades': self.downgrades,
+                'skipped_frames': self.skipped
+            },
+            'inference': self.analyzer.snapshot(),
+            'motion': self.motion_gate.snapshot(),
+            'clips': self.recorder.snapshot(),
+            'trace': self.trace.snapshot() if self.trace is not None else None,
+            'queues': {
+                'infer': self.infer_queue.snapshot(),
+                'output': self.output_queue.snapshot(),
+                'record': self.record_queue.snapshot()
+            }
+        }
+
+
+
+
+def stream_capture_stage(pipeline, cap, source_type):
+    """
+    مرحلة الالتقاط: قراءة الإطارات ودفعها إلى طابور الاستدلال
+    
+    هذه المرحلة تملك كائن الالتقاط وتحرره عند الخروج.
+    """
+    # الملفات تُقرأ بمعدل إطاراتها الأصلي، أما الكاميرات فتحدد سرعتها بنفسها
+    frame_interval = 0
+    if source_type == "file":
+        file_fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_interval = 1.0 / file_fps if file_fps and file_fps > 0 else 1.0 / 25
+    
+    try:
+        while pipeline.running():
+            t0 = time.time()
+            ret, frame = cap.read()
+            
+            if not ret:
+                # للملفات، ارجع إلى البداية
+                if source_type == "file":
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    continue
+                # لكاميرا الويب/RTSP، انتهي إذا لم نتمكن من الحصول على إطار
+                break
+            
+            pipeline.metrics['decode'].record(time.time() - t0)
+            
+            # نسخة غير مرسومة لمرحلة التسجيل (مرحلة الإخراج ترسم على الإطار نفسه)؛
+            # التحجيم وترميز JPEG في مؤشر التسجيل حتى لا يتأخر الالتقاط
+            if CLIP_RECORDING:
+                pipeline.record_queue.put((t0, frame.copy()))
+            pipeline.infer_queue.put((t0, frame))
+            
+            if frame_interval:
+                remaining = frame_interval - (time.time() - t0)
+                if remaining > 0:
+                    time.sleep(remaining)
+    except Exception as e:
+        pipeline.fail('capture', e)
+    finally:
+        pipeline.stop_event.set()
+        cap.release()
+
+
+
+
+def stream_record_stage(pipeline):
+    """مرحلة التسجيل: ترميز الإطارات للذاكرة الحلقية لمقاطع التنبيهات"""
+    try:
+        while pipeline.running():
+            packet = pipeline.record_queue.get(timeout=0.5)
+            if packet is None:
+                continue
+            
+            t0 = time.time()
+            captured_at, frame = packet
+            pipeline.recorder.add(frame, captured_at)
+            pipeline.metrics['record'].record(time.time() - t0)
+    except Exception as e:
+        pipeline.fail('record', e)
+
+
+
+
+def stream_inference_stage(pipeline, models):
+    """مرحلة الاستدلال: YOLO + Haar + CLIP على أحدث إطار والتقاط التنبيهات"""
+    frame_count = 0
+    process_fps = 0
+    start_time = time.time()
+    alert_active = False
+    alert_type = ""
+    last_capture_time = 0
+    captured_tracks = set()
+    camera = active_streams.get(pipeline.stream_id, {}).get('name') or pipeline.stream_id
+    stats_folder = StatsFolder(camera, record_analytics)
+    
+    while pipeline.running():
+        item = pipeline.infer_queue.get(timeout=0.5)
+        if item is None:
+            continue
+        captured_at, frame = item
+        
+        # تحديث FPS
+        frame_count += 1
+        now = time.time()
+        elapsed = now - start_time
+        if elapsed >= 1:
+            process_fps = frame_count / elapsed
+            frame_count = 0
+            start_time = now
+        
+        # بوابة الحركة: إعادة استخدام آخر نتائج للإطارات الخالية من الحركة
+        if MOTION_GATING and not pipeline.motion_gate.update(frame) and pipeline.analyzer.last is not None:
+            analysis = pipeline.analyzer.current()
+        else:
+            roi = pipeline.motion_gate.roi if MOTION_GATING else None
+            analysis = pipeline.analyzer.analyze(models, frame, roi=roi)
+        
+        # أسلحة
+        for det in analysis['detections']:
+            if det['kind'] != 'weapon':
+                continue
+            alert_active = True
+            alert_type = det['label'].upper()
+            
+            # التقاط الكشف مرة لكل مسار
+            if should_capture(captured_tracks, 'weapon', det.get('track_id'), now, last_capture_time, 3):
+                capture_frame(frame, det['label'], det['box'], stream_id=pipeline.stream_id)
+                if CLIP_RECORDING:
+                    pipeline.recorder.trigger(det['label'], captured_at)
+                last_capture_time = now
+        
+        # التقاط كشف بدون قناع مرة لكل مسار
+        for face in analysis['faces']:
+            if not face['has_mask'] and should_capture(captured_tracks, 'no_mask', face.get('track_id'), now, last_capture_time, 3):
+                capture_frame(frame, "NoMask", face['box'], stream_id=pipeline.stream_id)
+                if CLIP_RECORDING:
+                    pipeline.recorder.trigger("NoMask", captured_at)
+                last_capture_time = now
+        
+        stats_folder.add(analysis['stats'], captured_at)
+        
+        pipeline.metrics['infer'].record(time.time() - now)
+        pipeline.output_queue.put({
+            'frame': frame,
+            'analysis': analysis,
+            'fps': process_fps,
+            'alert_active': alert_active,
+            'alert_type': alert_type,
+            'captured_at': captured_at
+        })
+    
+    stats_folder.flush()
+
+
+
+
+def stream_output_stage(pipeline, width):
+    """مرحلة الإخراج: رسم الكشوفات ثم ترميز JPEG والإرسال عبر Socket.IO"""
+    stream_id = pipeline.stream_id
+    box_thick, font_scale, font_thick = get_dynamic_sizes(width)
+    blink = True
+    blink_timer = time.time()
+    
+    try:
+        while pipeline.running():
+            packet = pipeline.output_queue.get(timeout=0.5)
+            if packet is None:
+                continue
+            
+            # لا رسم ولا ترميز لبث بدون مشاهدين؛ الاستدلال والتنبيهات مستمرة
+            if not pipeline.has_viewers():
+                pipeline.skipped += 1
+                continue
+            
+            frame = packet['frame']
+            stats = packet['analysis']['stats']
+            t0 = time.time()
+            
+            # تحديث مؤقت الوميض
+            if t0 - blink_timer >= 0.3:
+                blink = not blink
+                blink_timer = t0
+            
+            render_analysis(frame, packet['analysis'], box_thick, font_scale, font_thick)
+            
+            # رسم لوحة المعلومات
+            draw_dashboard(frame, packet['fps'], stats, packet['alert_active'])
+            
+            # رسم التنبيه إذا كان نشطًا
+            if packet['alert_active']:
+                draw_alert(frame, packet['alert_type'], blink)
+            
+            t1 = time.time()
+            pipeline.metrics['draw'].record(t1 - t0)
+            
+            # نشر الإطار المرسوم؛ كل مستوى معاينة يُرمّز مرة واحدة لجميع مشاهديه
+            preview = PreviewFrame(frame)
+            pipeline.broadcaster.publish(preview)
+            pipeline.frame_seq += 1
+            
+            subscriptions = pipeline.subscriptions()
+            for tier in {sub.tier for sub in subscriptions}:
+                preview.encode(tier)
+            t2 = time.time()
+            pipeline.metrics['encode'].record(t2 - t1)
+            
+            # الحصول على camera_id من معلومات البث
+            camera_id = active_streams.get(stream_id, {}).get('name', f"Stream {stream_id}")
+            
+            payload = {
+                'stream_id': stream_id,
+                'camera_id': camera_id,  # مهم لتحديد الواجهة الأمامية
+                'seq': pipeline.frame_seq,
+                'stats': stats,
+                'fps': round(packet['fps'], 1),
+                'motion': round(pipeline.motion_gate.score, 4),
+                'detections': {
+                    'person_count': stats['persons'],
+                    'bag_count': stats['bags'],
+                    'weapon_count': stats['weapons'],
+                    'distance': random.randint(70, 120),  # مسافة محاكاة
+                    'signal': random.randint(70, 95),     # قوة إشارة محاكاة
+                    'confidence': {
+                        'person': random.randint(88, 96), # ثقة محاكاة
+                        'bag': random.randint(76, 89)     # ثقة محاكاة
+                    }
+                }
+            }
+            
+            # تسليم الإطار لطابور كل مشترك بمستواه (مرفق ثنائي بدون base64)
+            for sub in subscriptions:
+                sender = client_senders.get(sub.sid)
+                if sender is not None:
+                    sender.offer(stream_id, dict(payload, frame=preview.encode(sub.tier), tier=sub.tier), sub)
+            
+            done = time.time()
+            frame_interval = 1.0 / packet['fps'] if packet['fps'] > 0 else 1.0 / 25
+            pipeline.downgrades += adapt_preview_tiers(stream_id, frame_interval, done)
+            pipeline.metrics['emit'].record(done - t2)
+            pipeline.metrics['end_to_end'].record(done - packet['captured_at'])
+    except Exception as e:
+        pipeline.fail('emit', e)
+    finally:
+        pipeline.stop_event.set()
+
+
+
+
+def process_stream(stream_id, source_type, source_path=None, rtsp_url=None, profile=None):
     """
     معالجة بث فيديو (كاميرا ويب، ملف، أو RTSP)
     
+    يعمل الاستدلال على هذا المؤشر بينما يعمل الالتقاط والإخراج في مؤشرين
+    مستقلين (انظر StreamPipeline).
+    
     المعلمات:
         stream_id: معرف فريد لهذا البث
         source_type: نوع المصدر ("webcam"، "file"، "rtsp")
         source_path: مسار ملف الفيديو (إذا كان source_type هو "file")
         rtsp_url: عنوان URL لـ RTSP (إذا كان source_type هو "rtsp")
+        profile: ملف النماذج في MODEL_PROFILES (None = DEFAULT_MODEL_PROFILE)
     """
+    models = None
     try:
-        # الحصول على النماذج
-        models = load_models()
+        # حجز نماذج ملف البث (مشتركة مع البثوث الأخرى بنفس الملف)
+        models = acquire_models(profile)
         
         # إعداد التقاط الفيديو بناءً على نوع المصدر
         if source_type == "webcam":
@@ -823,240 +4095,40 @@ def process_stream(stream_id, source_type, source_path=None, rtsp_url=None):
             cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
             cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 360)
         
+        # إبقاء إطار واحد فقط في مخزن الكاميرا لتجنب تأخير RTSP
+        if source_type in ("webcam", "rtsp"):
+            cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        
         # الحصول على أبعاد الفيديو
         width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        box_thick, font_scale, font_thick = get_dynamic_sizes(width)
         
-        # إعداد متغيرات المعالجة
-        frame_count = 0
-        process_fps = 0
-        start_time = time.time()
-        alert_active = False
-        alert_type = ""
-        blink = True
-        blink_timer = time.time()
-        last_capture_time = 0
-        
-        # إحصائيات للتتبع
-        stats = {
-            'persons': 0,
-            'bags': 0,
-            'mask': 0,
-            'no_mask': 0,
-            'weapons': 0,
-            'drones': 0
-        }
+        pipeline = StreamPipeline(stream_id)
+        stream_pipelines[stream_id] = pipeline
         
         # تحديث حالة البث
         active_streams[stream_id]['status'] = 'streaming'
+        get_store().save_stream(active_streams[stream_id])
         logger.info(f"✅ بدأ البث {stream_id} ({source_type})")
         
-        # حلقة البث الرئيسية
-        while stream_id in active_streams and active_streams[stream_id]['status'] == 'streaming':
-            ret, frame = cap.read()
-            
-            if not ret:
-                # للملفات، ارجع إلى البداية
-                if source_type == "file":
-                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-                    continue
-                else:
-                    # لكاميرا الويب/RTSP، انتهي إذا لم نتمكن من الحصول على إطار
-                    break
-            
-            # تحديث FPS
-            frame_count += 1
-            now = time.time()
-            elapsed = now - start_time
-            if elapsed >= 1:
-                process_fps = frame_count / elapsed
-                frame_count = 0
-                start_time = now
-            
-            # تحديث مؤقت الوميض
-            if now - blink_timer >= 0.3:
-                blink = not blink
-                blink_timer = now
-            
-            # معالجة باستخدام YOLO
-            results = models['yolo'](frame, conf=YOLO_CONF, iou=YOLO_IOU, verbose=False)
-            
-            # إعادة تعيين الإحصائيات لهذا الإطار
-            stats = {
-                'persons': 0,
-                'bags': 0,
-                'mask': 0,
-                'no_mask': 0,
-                'weapons': 0,
-                'drones': 0
-            }
-            
-            persons = []
-            
-            # معالجة نتائج YOLO
-            for r in results:
-                if r.boxes is None:
-                    continue
-                
-                for box in r.boxes:
-                    cid = int(box.cls[0])
-                    # الحصول على الإحداثيات
-                    x1 = int(box.xyxy[0][0])
-                    y1 = int(box.xyxy[0][1])
-                    x2 = int(box.xyxy[0][2])
-                    y2 = int(box.xyxy[0][3])
-                    conf = float(box.conf[0])
-                    
-                    # حقائب
-                    if cid in BAG_IDS:
-                        stats['bags'] += 1
-                        draw_box(frame, x1, y1, x2, y2, C_YELLOW, f"{BAG_IDS[cid]}: {conf:.2f}", 
-                                box_thick, font_scale, font_thick)
-                    
-                    # أشخاص
-                    elif cid == PERSON_ID:
-                        stats['persons'] += 1
-                        cv2.rectangle(frame, (x1, y1), (x2, y2), C_BLUE, box_thick)
-                        cv2.putText(frame, f"Person: {conf:.2f}", (x1, y2+20), 
-                                    cv2.FONT_HERSHEY_SIMPLEX, font_scale, C_BLUE, font_thick)
-                        
-                        # إضافة إلى قائمة الأشخاص للكشف عن القناع
-                        persons.append((x1, y1, x2, y2))
-                    
-                    # أسلحة
-                    elif cid in WEAPON_CLASSES:
-                        stats['weapons'] += 1
-                        weapon_type = WEAPON_CLASSES[cid]
-                        
-                        draw_box(frame, x1, y1, x2, y2, C_RED, f"{weapon_type}: {conf:.2f}", 
-                                box_thick + 2, font_scale + 0.2, font_thick)
-                        
-                        alert_active = True
-                        alert_type = weapon_type.upper()
-                        
-                        # التقاط الكشف إذا مر الفاصل الزمني
-                        if now - last_capture_time >= 3:
-                            capture_path = capture_frame(frame, weapon_type, (x1, y1, x2, y2))
-                            last_capture_time = now
-            
-            # معالجة الوجوه للكشف عن القناع إذا كان CLIP متاحًا
-            if models['clip_model'] is not None:
-                face_detector = models['face_cascade']
-                clip_model = models['clip_model']
-                clip_proc = models['clip_proc']
-                use_openai_clip = models['use_openai_clip']
-                device = models['device']
-                
-                for (px1, py1, px2, py2) in persons:
-                    roi = frame[py1:py2, px1:px2]
-                    if roi.size == 0:
-                        continue
-                    
-                    gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
-                    faces = face_detector.detectMultiScale(gray, 1.15, 3, minSize=(25, 25))
-                    
-                    for (fx, fy, fw, fh) in faces:
-                        if fw < 30:
-                            continue
-                        
-                        face = roi[fy:fy+fh, fx:fx+fw]
-                        if face.size < 400:
-                            continue
-                        
-                        # تحسين الصورة
-                        face = enhance_face(face)
-                        
-                        small = cv2.resize(face, (56, 56))
-                        rgb = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
-                        pil = Image.fromarray(rgb)
-                        
-                        if use_openai_clip:
-                            # استخدام CLIP الأصلي من OpenAI
-                            image = clip_proc(pil).unsqueeze(0).to(device)
-                            text = clip.tokenize(CLIP_LABELS).to(device)
-                            
-                            with torch.no_grad():
-                                logits_per_image, _ = clip_model(image, text)
-                                probs = logits_per_image.softmax(dim=-1)
-                        else:
-                            # استخدام HuggingFace transformers CLIP
-                            inputs = clip_proc(
-                                text=CLIP_LABELS, images=pil,
-                                return_tensors="pt", padding=True
-                            ).to(device)
-                            
-                            with torch.no_grad():
-                                out = clip_model(**inputs)
-                                probs = out.logits_per_image.softmax(dim=1)
-                        
-                        idx = probs.argmax().item()
-                        conf = probs[0][idx].item()
-                        has_mask = (idx == 0)  # تم تغييره من 1 إلى 0 لأننا عكسنا ترتيب التسميات
-                        
-                        color = C_GREEN if has_mask else C_RED
-                        label = "NO MASK" if has_mask else "MASK"
-                        
-                        # تحديث الإحصائيات
-                        if has_mask:
-                            stats['mask'] += 1
-                        else:
-                            stats['no_mask'] += 1
-                            
-                            # التقاط كشف بدون قناع إذا مر الفاصل الزمني
-                            if now - last_capture_time >= 3:
-                                capture_path = capture_frame(frame, "NoMask", (px1+fx, py1+fy, px1+fx+fw, py1+fy+fh))
-                                last_capture_time = now
-                        
-                        draw_box(frame, px1+fx, py1+fy, px1+fx+fw, py1+fy+fh, color, 
-                                f"{label}: {conf:.2f}", box_thick, font_scale, font_thick)
-            
-            # رسم لوحة المعلومات
-            draw_dashboard(frame, process_fps, stats, alert_active)
-            
-            # رسم التنبيه إذا كان نشطًا
-            if alert_active:
-                draw_alert(frame, alert_type, blink)
-            
-            # إرسال إطار عبر Socket.IO
-            _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 70])
-            frame_base64 = base64.b64encode(buffer).decode('utf-8')
-            
-            # الحصول على camera_id من معلومات البث
-            camera_id = active_streams[stream_id].get('name', f"Stream {stream_id}")
-            
-            # بث الإطار مع camera_id لمطابقة توقعات الواجهة الأمامية
-            socketio.emit('stream_frame', {
-                'stream_id': stream_id,
-                'camera_id': camera_id,  # مهم لتحديد الواجهة الأمامية
-                'frame': frame_base64,
-                'stats': stats,
-                'fps': round(process_fps, 1),
-                'detections': {
-                    'person_count': stats['persons'],
-                    'bag_count': stats['bags'],
-                    'weapon_count': stats['weapons'],
-                    'distance': random.randint(70, 120),  # مسافة محاكاة
-                    'signal': random.randint(70, 95),     # قوة إشارة محاكاة
-                    'confidence': {
-                        'person': random.randint(88, 96), # ثقة محاكاة
-                        'bag': random.randint(76, 89)     # ثقة محاكاة
-                    }
-                }
-            })
-            
-            # بث أيضًا على قناة محددة
-            socketio.emit(f'stream_frame_{stream_id}', {
-                'frame': frame_base64,
-                'stats': stats,
-                'fps': round(process_fps, 1)
-            })
-            
-            # تقليل سرعة البث لتجنب التحميل الزائد على Socket.IO
-            time.sleep(0.05)
+        stage_threads = [
+            Thread(target=stream_capture_stage, args=(pipeline, cap, source_type)),
+            Thread(target=stream_output_stage, args=(pipeline, width))
+        ]
+        if CLIP_RECORDING:
+            stage_threads.append(Thread(target=stream_record_stage, args=(pipeline,)))
+        for stage_thread in stage_threads:
+            stage_thread.daemon = True
+            stage_thread.start()
         
-        # تحرير الموارد
-        cap.release()
+        try:
+            stream_inference_stage(pipeline, models)
+        finally:
+            pipeline.stop_event.set()
+            for stage_thread in stage_threads:
+                stage_thread.join(timeout=5)
+        
+        if pipeline.error is not None:
+            raise pipeline.error
         
         # تحديث حالة البث
         if stream_id in active_streams:
@@ -1072,11 +4144,37 @@ def process_stream(stream_id, source_type, source_path=None, rtsp_url=None):
         
         socketio.emit(f'stream_error_{stream_id}', {'error': str(e)})
         socketio.emit('stream_error', {'stream_id': stream_id, 'camera_id': active_streams[stream_id].get('name', ''), 'message': str(e)})
+    
+    finally:
+        pipeline = stream_pipelines.pop(stream_id, None)
+        if pipeline is not None:
+            pipeline.broadcaster.close()
+            pipeline.recorder.close()
+        if models is not None:
+            release_models(models)
+        if stream_id in active_streams:
+            get_store().save_stream(dict(active_streams[stream_id], stopped=datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        with subscription_lock:
+            stream_subscribers.pop(stream_id, None)
+            senders = list(client_senders.values())
+        for sender in senders:
+            sender.discard(stream_id)
+
+
+
 
+def stream_snapshot(stream_id):
+    """معلومات البث مع مقاييس مراحل خط المعالجة إن وُجد"""
+    info = dict(active_streams[stream_id])
+    pipeline = stream_pipelines.get(stream_id)
+    if pipeline is not None:
+        info['pipeline'] = pipeline.snapshot()
+    return info
 
 
 
-def start_stream(source_type, source_path=None, rtsp_url=None, name=None):
+
+def start_stream(source_type, source_path=None, rtsp_url=None, name=None, profile=None):
     """
     بدء بث جديد وإرجاع معرفه
     
@@ -1085,10 +4183,15 @@ def start_stream(source_type, source_path=None, rtsp_url=None, name=None):
         source_path: مسار ملف الفيديو (إذا كان source_type هو "file")
         rtsp_url: عنوان URL لـ RTSP (إذا كان source_type هو "rtsp")
         name: اسم ودي اختياري للبث
+        profile: ملف النماذج في MODEL_PROFILES (None = DEFAULT_MODEL_PROFILE)
     
     الإرجاع:
         معرف البث
     """
+    profile = profile or DEFAULT_MODEL_PROFILE
+    if profile not in MODEL_PROFILES:
+        raise ValueError(f"ملف نماذج غير معروف: {profile}")
+    
     stream_id = str(uuid.uuid4())
     
     # إنشاء إدخال البث
@@ -1097,6 +4200,7 @@ def start_stream(source_type, source_path=None, rtsp_url=None, name=None):
         'name': name or f"Stream {len(active_streams) + 1}",
         'type': source_type,
         'status': 'starting',
+        'profile': profile,
         'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
     }
     
@@ -1106,6 +4210,7 @@ def start_stream(source_type, source_path=None, rtsp_url=None, name=None):
         stream_info['rtsp_url'] = rtsp_url
     
     active_streams[stream_id] = stream_info
+    get_store().save_stream(stream_info)
     
     # إخطار العملاء بأن البث بدأ
     socketio.emit('stream_started', {
@@ -1117,7 +4222,7 @@ def start_stream(source_type, source_path=None, rtsp_url=None, name=None):
     # بدء مؤشر ترابط البث
     stream_thread = Thread(
         target=process_stream, 
-        args=(stream_id, source_type, source_path, rtsp_url)
+        args=(stream_id, source_type, source_path, rtsp_url, profile)
     )
     stream_thread.daemon = True
     stream_thread.start()
@@ -1311,7 +4416,7 @@ def test_upload():
 def get_streams():
     """الحصول على جميع البث النشطة"""
     return jsonify({
-        'streams': list(active_streams.values())
+        'streams': [stream_snapshot(sid) for sid in list(active_streams)]
     })
 
 
@@ -1330,18 +4435,26 @@ def api_start_stream():
         source_path = data.get('source_path')
         rtsp_url = data.get('rtsp_url')
         name = data.get('name')
+        profile = data.get('profile') or DEFAULT_MODEL_PROFILE
+        
+        if profile not in MODEL_PROFILES:
+            return jsonify({
+                'error': f'Unknown model profile: {profile}',
+                'profiles': list(MODEL_PROFILES)
+            }), 400
         
         # إذا تم توفير camera_id وبدون اسم، استخدمه كاسم
         if camera_id and not name:
             name = camera_id
         
-        stream_id = start_stream(source_type, source_path, rtsp_url, name)
+        stream_id = start_stream(source_type, source_path, rtsp_url, name, profile)
         
-        logger.info(f"بدأ البث: {stream_id} للكاميرا: {name or camera_id}")
+        logger.info(f"بدأ البث: {stream_id} للكاميرا: {name or camera_id} (ملف النماذج: {profile})")
         
         return jsonify({
             'stream_id': stream_id,
             'status': 'starting',
+            'profile': profile,
             'message': f'Stream {source_type} started',
             'camera_id': camera_id  # إرجاع camera_id للرجوع إليه في الواجهة الأمامية
         })
@@ -1409,7 +4522,411 @@ def get_stream(stream_id):
     if stream_id not in active_streams:
         return jsonify({'error': 'Stream not found'}), 404
     
-    return jsonify(active_streams[stream_id])
+    return jsonify(stream_snapshot(stream_id))
+
+
+
+
+@app.route('/api/stream/<stream_id>/mjpeg')
+def stream_mjpeg(stream_id):
+    """بث إطارات البث كـ MJPEG (multipart) لعرضه مباشرة في وسم img"""
+    pipeline = stream_pipelines.get(stream_id)
+    if pipeline is None:
+        return jsonify({'error': 'Stream not found'}), 404
+    
+    tier = request.args.get('tier', DEFAULT_PREVIEW_TIER)
+    if tier not in PREVIEW_TIERS:
+        return jsonify({'error': f'Unknown preview tier: {tier}'}), 400
+    
+    broadcaster = pipeline.broadcaster
+    
+    def generate():
+        seq = 0
+        with broadcaster.cond:
+            broadcaster.viewers += 1
+        try:
+            while not broadcaster.closed:
+                new_seq, preview = broadcaster.wait(seq)
+                if new_seq == seq or preview is None:
+                    continue
+                seq = new_seq
+                frame = preview.encode(tier)
+                yield (b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: '
+                       + str(len(frame)).encode() + b'\r\n\r\n')
+                yield frame
+                yield b'\r\n'
+        finally:
+            with broadcaster.cond:
+                broadcaster.viewers -= 1
+    
+    return Response(generate(), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+
+
+
+@app.route('/api/admin/traces', methods=['POST'])
+def api_start_trace():
+    """
+    بدء تتبع أداء بث أو مهمة لمدة محدودة
+    
+    الجسم: stream_id أو task_id، duration (ثوانٍ)، mode ('stages' لفترات
+    المراحل لكل إطار، أو 'sampling' لإضافة عينات المكدس)
+    """
+    data = request.json or {}
+    stream_id = data.get('stream_id')
+    task_id = data.get('task_id')
+    mode = data.get('mode', 'stages')
+    
+    if bool(stream_id) == bool(task_id):
+        return jsonify({'error': 'Specify exactly one of stream_id or task_id'}), 400
+    if mode not in TRACE_MODES:
+        return jsonify({'error': f'Unsupported mode: {mode}'}), 400
+    try:
+        duration = float(data.get('duration', TRACE_DEFAULT_SECONDS))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid duration'}), 400
+    duration = min(TRACE_MAX_SECONDS, max(1.0, duration))
+    
+    if stream_id:
+        if stream_id not in stream_pipelines:
+            return jsonify({'error': 'Stream not running'}), 404
+        session = start_stream_trace(stream_id, duration, mode)
+        if session is None:
+            return jsonify({'error': 'A trace is already active for this stream'}), 409
+        return jsonify(session.snapshot()), 202
+    
+    if task_id not in tasks and get_store().get_task(task_id) is None:
+        return jsonify({'error': 'Task not found'}), 404
+    trace_request = request_task_trace(task_id, duration, mode)
+    if trace_request is None:
+        return jsonify({'error': 'A trace is already active for this task'}), 409
+    return jsonify(trace_request), 202
+
+
+
+
+@app.route('/api/admin/traces', methods=['GET'])
+def list_traces():
+    """جلسات التتبع النشطة وطلبات المهام المعلقة والجلسات المحفوظة"""
+    now = time.time()
+    pending = []
+    for filename in sorted(os.listdir(TRACE_REQUESTS_FOLDER)):
+        if not filename.endswith('.json'):
+            continue
+        trace_request = read_trace_request(os.path.join(TRACE_REQUESTS_FOLDER, filename))
+        if trace_request is not None and trace_request['deadline'] > now:
+            pending.append(trace_request)
+    
+    with trace_lock:
+        active = [session.snapshot() for session in trace_sessions.values()]
+    
+    saved = sorted(
+        (name for name in os.listdir(TRACES_FOLDER)
+         if os.path.isdir(os.path.join(TRACES_FOLDER, name)) and name != os.path.basename(TRACE_REQUESTS_FOLDER)),
+        key=lambda name: os.path.getmtime(os.path.join(TRACES_FOLDER, name)),
+        reverse=True
+    )
+    
+    return jsonify({'active': active, 'pending': pending, 'saved': saved})
+
+
+
+
+@app.route('/api/admin/traces/<trace_id>', methods=['GET'])
+def get_trace(trace_id):
+    """ملخص جلسة تتبع: إحصائيات المراحل وأكثر المكدسات تكرارًا وأجزاء كل عملية"""
+    parts = load_trace(TRACES_FOLDER, trace_id)
+    with trace_lock:
+        session = trace_sessions.get(trace_id)
+    if not parts and session is None:
+        return jsonify({'error': 'Trace not found'}), 404
+    
+    return jsonify(dict(
+        summarize_trace(parts),
+        trace_id=trace_id,
+        active=session.snapshot() if session is not None else None
+    ))
+
+
+
+
+@app.route('/api/admin/traces/<trace_id>/chrome', methods=['GET'])
+def get_trace_chrome(trace_id):
+    """الجدول الزمني لكل إطار بصيغة Chrome trace (يُفتح في chrome://tracing أو Perfetto)"""
+    parts = load_trace(TRACES_FOLDER, trace_id)
+    if not parts:
+        return jsonify({'error': 'Trace not found or still running'}), 404
+    
+    return Response(
+        json.dumps(chrome_trace(parts)),
+        mimetype='application/json',
+        headers={'Content-Disposition': f'attachment; filename=trace-{os.path.basename(trace_id)}.json'}
+    )
+
+
+
+
+@app.route('/api/admin/traces/<trace_id>/folded', methods=['GET'])
+def get_trace_folded(trace_id):
+    """عينات المكدس بصيغة flamegraph المطوية (flamegraph.pl أو speedscope)"""
+    parts = load_trace(TRACES_FOLDER, trace_id)
+    if not parts:
+        return jsonify({'error': 'Trace not found or still running'}), 404
+    
+    return Response(folded_stacks(parts), mimetype='text/plain')
+
+
+
+
+@app.route('/api/scheduler', methods=['GET'])
+def get_scheduler():
+    """الحصول على إحصائيات مجدول الاستدلال المشترك"""
+    return jsonify({
+        'enabled': YOLO_BATCHING,
+        'max_batch': YOLO_MAX_BATCH,
+        'max_latency_ms': YOLO_MAX_LATENCY * 1000,
+        'schedulers': [scheduler.snapshot() for scheduler in list(inference_schedulers.values())]
+    })
+
+
+
+
+def prometheus_labels(labels):
+    """تنسيق تسميات Prometheus مع تهريب القيم"""
+    if not labels:
+        return ''
+    
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels.items()) + '}'
+
+
+
+
+def merge_metric_states(states):
+    """دمج حالات مدرجات (من مقاطع متوازية لنفس المهمة) في حالة واحدة"""
+    merged = {'buckets': [0] * (len(StageMetrics.BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+    for state in states:
+        merged['buckets'] = [a + b for a, b in zip(merged['buckets'], state['buckets'])]
+        merged['sum'] += state['sum']
+        merged['count'] += state['count']
+    return merged
+
+
+
+
+class PrometheusWriter:
+    """تجميع عائلات مقاييس Prometheus بصيغة النص (كل عائلة مع ترويستي HELP و TYPE مرة واحدة)"""
+    
+    def __init__(self):
+        self.families = {}
+    
+    def _family(self, name, kind, help_text):
+        if name not in self.families:
+            self.families[name] = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        return self.families[name]
+    
+    def sample(self, name, kind, help_text, labels, value):
+        self._family(name, kind, help_text).append(f"{name}{prometheus_labels(labels)} {value}")
+    
+    def histogram(self, name, help_text, labels, state):
+        lines = self._family(name, 'histogram', help_text)
+        cumulative = 0
+        for bound, count in zip(StageMetrics.BUCKETS, state['buckets']):
+            cumulative += count
+            lines.append(f"{name}_bucket{prometheus_labels(dict(labels, le=bound))} {cumulative}")
+        lines.append(f"{name}_bucket{prometheus_labels(dict(labels, le='+Inf'))} {state['count']}")
+        lines.append(f"{name}_sum{prometheus_labels(labels)} {state['sum']}")
+        lines.append(f"{name}_count{prometheus_labels(labels)} {state['count']}")
+    
+    def render(self):
+        return '\n'.join(line for lines in self.families.values() for line in lines) + '\n'
+
+
+
+
+def collect_metrics():
+    """جمع مقاييس البثوث والمهام والعملاء ومجمعات الكتابة والنماذج"""
+    writer = PrometheusWriter()
+    
+    # البثوث: مدرجات المراحل والطوابير والمشاهدون
+    for stream_id, pipeline in list(stream_pipelines.items()):
+        labels = {'stream': stream_id, 'camera': active_streams.get(stream_id, {}).get('name', '')}
+        for stage, metric in pipeline.metrics.items():
+            writer.histogram('surveillance_stream_stage_seconds', 'Per-stage latency of live streams',
+                             dict(labels, stage=stage), metric.state())
+        for queue_name, queue in (('infer', pipeline.infer_queue), ('output', pipeline.output_queue),
+                                  ('record', pipeline.record_queue)):
+            writer.sample('surveillance_stream_queue_depth', 'gauge', 'Frames waiting between stream stages',
+                          dict(labels, queue=queue_name), len(queue.items))
+            writer.sample('surveillance_stream_queue_dropped_total', 'counter', 'Frames dropped between stream stages',
+                          dict(labels, queue=queue_name), queue.dropped)
+        writer.sample('surveillance_stream_skipped_frames_total', 'counter', 'Frames not encoded because nobody was watching',
+                      labels, pipeline.skipped)
+        writer.sample('surveillance_stream_viewers', 'gauge', 'Viewers per stream and transport',
+                      dict(labels, transport='socketio'), pipeline.subscribers())
+        writer.sample('surveillance_stream_viewers', 'gauge', 'Viewers per stream and transport',
+                      dict(labels, transport='mjpeg'), pipeline.broadcaster.viewers)
+        writer.sample('surveillance_stream_inferred_frames_total', 'counter', 'Frames that ran full inference',
+                      labels, pipeline.analyzer.inferred)
+        writer.sample('surveillance_stream_propagated_frames_total', 'counter', 'Frames served by optical-flow propagation',
+                      labels, pipeline.analyzer.propagated)
+    
+    # مهام الفيديو: دمج مقاطع كل مهمة
+    with task_metrics_lock:
+        snapshot = {task_id: dict(parts) for task_id, parts in task_metrics.items()}
+    for task_id, parts in snapshot.items():
+        for stage in TASK_STAGES:
+            states = [part[stage] for part in parts.values() if stage in part]
+            if states:
+                writer.histogram('surveillance_task_stage_seconds', 'Per-stage latency of uploaded video tasks',
+                                 {'task': task_id, 'stage': stage}, merge_metric_states(states))
+    
+    # عملاء Socket.IO وطوابير الإرسال
+    writer.sample('surveillance_socketio_clients', 'gauge', 'Connected Socket.IO clients', None, len(connected_clients))
+    # العدادات تشمل العملاء المنقطعين حتى لا تتناقص (Prometheus يعد النقص إعادة تعيين)
+    with subscription_lock:
+        senders = list(client_senders.values())
+        retired = dict(retired_client_stats)
+    writer.sample('surveillance_client_frames_sent_total', 'counter', 'Stream frames sent to clients',
+                  None, retired['sent'] + sum(sender.sent for sender in senders))
+    writer.sample('surveillance_client_frames_dropped_total', 'counter', 'Stream frames dropped from client queues',
+                  None, retired['dropped'] + sum(sender.dropped for sender in senders))
+    writer.sample('surveillance_client_ack_timeouts_total', 'counter', 'Stream frames never acknowledged by clients',
+                  None, retired['timeouts'] + sum(sender.timeouts for sender in senders))
+    lag_states = [sender.lag.state() for sender in senders]
+    if retired['lag'] is not None:
+        lag_states.append(retired['lag'])
+    lag = merge_metric_states(lag_states)
+    writer.histogram('surveillance_client_queue_lag_seconds', 'Time frames wait in client send queues', {}, lag)
+    
+    # مجمعات كتابة الالتقاطات والمقاطع
+    for name, pool in (('captures', capture_writer), ('clips', clip_writer)):
+        if pool is None:
+            continue
+        labels = {'writer': name}
+        writer.sample('surveillance_writer_queue_depth', 'gauge', 'Items waiting in background writers',
+                      labels, len(pool.items))
+        writer.sample('surveillance_writer_dropped_total', 'counter', 'Items dropped by background writers',
+                      labels, pool.dropped)
+        writer.sample('surveillance_writer_failed_total', 'counter', 'Items background writers failed to write',
+                      labels, pool.failed)
+        writer.histogram('surveillance_writer_seconds', 'Background write latency', labels, pool.write_metrics.state())
+    
+    # مجدولات YOLO المشتركة: واحد لكل نموذج وحجم إدخال
+    model_names = {id(value): name for name, value in model_loader.loaded().items()} if model_loader is not None else {}
+    for scheduler in list(inference_schedulers.values()):
+        labels = {
+            'model': model_names.get(id(scheduler.yolo), type(scheduler.yolo).__name__),
+            'imgsz': scheduler.imgsz or 'default'
+        }
+        writer.sample('surveillance_yolo_batches_total', 'counter', 'Batched YOLO calls', labels, scheduler.batches)
+        writer.sample('surveillance_yolo_frames_total', 'counter', 'Frames run through batched YOLO', labels, scheduler.frames)
+        writer.histogram('surveillance_yolo_batch_seconds', 'Batched YOLO inference latency', labels, scheduler.infer.state())
+    
+    # النماذج والمخزن
+    _, components = model_health()
+    for name, info in components.items():
+        if 'seconds' in info:
+            writer.sample('surveillance_model_load_seconds', 'gauge', 'Time taken to load each model',
+                          {'model': name, 'state': info['state']}, info['seconds'])
+        writer.sample('surveillance_model_users', 'gauge', 'Streams and tasks holding each model',
+                      {'model': name}, info['refs'])
+    if model_loader is not None:
+        clip_parts = model_loader.peek('clip')
+        writer.sample('surveillance_model_info', 'gauge', 'Loaded models and device', {
+            'device': model_loader.device,
+            'clip': clip_parts['clip_name'] if clip_parts else 'none'
+        }, 1)
+    if event_store is not None:
+        writer.sample('surveillance_store_pending', 'gauge', 'Records waiting to be written to SQLite',
+                      None, event_store.snapshot()['pending'])
+    
+    return writer.render()
+
+
+
+
+@app.route('/api/models/variants', methods=['GET'])
+def get_model_variants():
+    """النسخ المكممة المسجلة مع تقارير بوابة الدقة والنسخ المستخدمة حاليًا"""
+    return jsonify({
+        'variants': load_variants(VARIANTS_PATH),
+        'selected': {'yolo': YOLO_VARIANT, 'clip': CLIP_VARIANT}
+    })
+
+
+
+
+@app.route('/api/models/profiles', methods=['GET'])
+def get_model_profiles():
+    """ملفات النماذج ومكوناتها وحالتها وعدد البثوث والمهام التي تستخدم كلًا منها"""
+    _, components = model_health()
+    profiles = {}
+    for name, spec in MODEL_PROFILES.items():
+        names = profile_components(name)
+        profiles[name] = dict(spec, components={
+            component: components.get(component, {'state': 'not_loaded', 'refs': 0})
+            for component in names
+        })
+    
+    return jsonify({
+        'default': DEFAULT_MODEL_PROFILE,
+        'idle_unload_s': MODEL_IDLE_UNLOAD,
+        'profiles': profiles,
+        'streams': {stream_id: info.get('profile') for stream_id, info in list(active_streams.items())}
+    })
+
+
+
+
+@app.route('/api/health', methods=['GET'])
+def health():
+    """جاهزية الخادم والنماذج (503 أثناء التحميل أو عند فشل YOLO)"""
+    status, components = model_health()
+    return jsonify({
+        'status': status,
+        'uptime_s': round(time.time() - server_started, 1),
+        'device': model_loader.device if model_loader is not None else None,
+        'mask_detection': MASK_DETECTION and components.get('clip', {}).get('state') == 'ready',
+        'default_profile': DEFAULT_MODEL_PROFILE,
+        'models': components,
+        'backends': model_backends
+    }), (200 if status in ('idle', 'ready', 'degraded') else 503)
+
+
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """مقاييس بصيغة Prometheus النصية"""
+    return Response(collect_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+
+
+@app.route('/api/captures/writer', methods=['GET'])
+def get_capture_writer_stats():
+    """الحصول على إحصائيات مجمعي كتابة الالتقاطات والمقاطع (عمق الطابور وزمن الكتابة)"""
+    return jsonify({
+        'captures': get_capture_writer().snapshot(),
+        'clips': get_clip_writer().snapshot()
+    })
+
+
+
+
+@app.route('/api/clients', methods=['GET'])
+def get_clients():
+    """الحصول على إحصائيات طوابير الإرسال لكل عميل (الإطارات المسقطة وتأخر الطابور)"""
+    with subscription_lock:
+        senders = list(client_senders.values())
+    
+    return jsonify({
+        'queue_size': CLIENT_QUEUE_SIZE,
+        'ack_timeout': CLIENT_ACK_TIMEOUT,
+        'clients': [sender.snapshot() for sender in senders]
+    })
 
 
 
@@ -1430,6 +4947,11 @@ def upload_video():
             logger.warning("اسم ملف فارغ")
             return jsonify({'error': 'Empty filename'}), 400
         
+        profile = request.form.get('profile') or DEFAULT_MODEL_PROFILE
+        if profile not in MODEL_PROFILES:
+            logger.warning(f"ملف نماذج غير معروف: {profile}")
+            return jsonify({'error': f'Unknown model profile: {profile}', 'profiles': list(MODEL_PROFILES)}), 400
+        
         # طباعة معلومات الملف
         logger.info(f"استلام الملف: {video_file.filename}, النوع: {video_file.content_type}")
         
@@ -1451,13 +4973,22 @@ def upload_video():
             'filename': video_file.filename,
             'upload_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             'status': 'uploaded',
+            'profile': profile,
             'progress': 0
         }
         
-        # بدء مؤشر ترابط المعالجة
-        processing_thread = Thread(target=process_video_thread, args=(video_path, task_id))
-        processing_thread.daemon = True
-        processing_thread.start()
+        if UPLOAD_WORKERS > 0:
+            # إرسال المهمة إلى مجمع العمليات
+            tasks[task_id]['status'] = 'queued'
+            get_store().save_task(tasks[task_id])
+            get_upload_pool().submit(video_path, task_id, profile)
+        else:
+            get_store().save_task(tasks[task_id])
+            
+            # بدء مؤشر ترابط المعالجة
+            processing_thread = Thread(target=process_video_thread, args=(video_path, task_id, profile))
+            processing_thread.daemon = True
+            processing_thread.start()
         
         logger.info(f"بدأت معالجة المهمة: {task_id}")
         
@@ -1477,11 +5008,102 @@ def upload_video():
 
 @app.route('/task/<task_id>')
 def get_task(task_id):
-    """الحصول على حالة المهمة والنتائج"""
-    if task_id not in tasks:
+    """الحصول على حالة المهمة والنتائج (من المخزن الدائم للمهام السابقة)"""
+    task = tasks.get(task_id) or get_store().get_task(task_id)
+    if task is None:
         return jsonify({'error': 'Task not found'}), 404
     
-    return jsonify(tasks[task_id])
+    return jsonify(task)
+
+
+
+
+def page_args():
+    """قراءة معلمات الترقيم page و per_page من الطلب"""
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(STORE_PAGE_MAX, max(1, request.args.get('per_page', 50, type=int)))
+    return page, per_page
+
+
+
+
+@app.route('/api/alerts', methods=['GET'])
+def get_alerts():
+    """
+    سجل التنبيهات مع التصفية والترقيم
+    
+    معلمات الاستعلام: page, per_page, camera, type, task_id, stream_id,
+    since, until (طوابع زمنية بالثواني)
+    """
+    page, per_page = page_args()
+    return jsonify(get_store().query_alerts(
+        page, per_page,
+        camera=request.args.get('camera'),
+        alert_type=request.args.get('type'),
+        task_id=request.args.get('task_id'),
+        stream_id=request.args.get('stream_id'),
+        since=request.args.get('since', type=float),
+        until=request.args.get('until', type=float)
+    ))
+
+
+
+
+@app.route('/api/alerts/summary', methods=['GET'])
+def get_alerts_summary():
+    """عدد التنبيهات حسب النوع أو الكاميرا (group_by=type|camera) لصفحات التحليلات والتقارير"""
+    group_by = request.args.get('group_by', 'type')
+    if group_by not in ('type', 'camera'):
+        return jsonify({'error': f'Unsupported group_by: {group_by}'}), 400
+    
+    return jsonify(get_store().alert_counts(
+        since=request.args.get('since', type=float),
+        until=request.args.get('until', type=float),
+        group_by=group_by
+    ))
+
+
+
+
+@app.route('/api/analytics', methods=['GET'])
+def get_analytics():
+    """
+    سلاسل زمنية ومئينات الإحصائيات من الحاويات المجمعة
+    
+    معلمات الاستعلام: source (اسم الكاميرا أو UPLOADS_ANALYTICS_SOURCE، الكل افتراضيًا)،
+    resolution (1s أو 1m أو 1h)، since و until (طوابع زمنية بالثواني)
+    """
+    resolution = request.args.get('resolution', '1m')
+    if resolution not in RESOLUTIONS:
+        return jsonify({'error': f'Unsupported resolution: {resolution}'}), 400
+    
+    result = analytics_aggregator.query(
+        source=request.args.get('source'),
+        resolution=resolution,
+        since=request.args.get('since', type=float),
+        until=request.args.get('until', type=float)
+    )
+    result['sources'] = analytics_aggregator.list_sources()
+    result['memory_bytes'] = analytics_aggregator.memory_bytes()
+    return jsonify(result)
+
+
+
+
+@app.route('/api/history/tasks', methods=['GET'])
+def get_task_history():
+    """سجل مهام تحليل الفيديو مع الترقيم والتصفية حسب status"""
+    page, per_page = page_args()
+    return jsonify(get_store().query_tasks(page, per_page, status=request.args.get('status')))
+
+
+
+
+@app.route('/api/history/streams', methods=['GET'])
+def get_stream_history():
+    """سجل البثوث مع الترقيم والتصفية حسب status"""
+    page, per_page = page_args()
+    return jsonify(get_store().query_streams(page, per_page, status=request.args.get('status')))
 
 
 
@@ -1490,6 +5112,7 @@ def get_task(task_id):
 @socketio.on('connect')
 def handle_connect():
     logger.info(f"✅ اتصل العميل: {request.sid}")
+    connected_clients.add(request.sid)
 
 
 
@@ -1497,6 +5120,18 @@ def handle_connect():
 @socketio.on('disconnect')
 def handle_disconnect():
     logger.info(f"❌ انقطع اتصال العميل: {request.sid}")
+    connected_clients.discard(request.sid)
+    
+    # إزالة اشتراكات الجلسة وإيقاف طابور إرسالها
+    with subscription_lock:
+        for subscribers in stream_subscribers.values():
+            subscribers.pop(request.sid, None)
+        sender = client_senders.pop(request.sid, None)
+        if sender is not None:
+            retire_client_sender(sender)
+    
+    if sender is not None:
+        sender.close()
 
 
 
@@ -1508,18 +5143,23 @@ def handle_start_stream(data):
     rtsp_url = data.get('rtsp_url')
     name = data.get('name')
     camera_id = data.get('camera_id')  # الحصول على camera_id إذا تم توفيره
+    profile = data.get('profile') or DEFAULT_MODEL_PROFILE
+    
+    if profile not in MODEL_PROFILES:
+        return {'error': f'Unknown model profile: {profile}', 'profiles': list(MODEL_PROFILES)}
     
     # إذا تم توفير camera_id ولكن ليس هناك اسم، استخدمه كاسم
     if camera_id and not name:
         name = camera_id
     
-    logger.info(f"Socket.IO start_stream: {name} ({source_type})")
+    logger.info(f"Socket.IO start_stream: {name} ({source_type}, {profile})")
     
-    stream_id = start_stream(source_type, source_path, rtsp_url, name)
+    stream_id = start_stream(source_type, source_path, rtsp_url, name, profile)
     
     return {
         'stream_id': stream_id,
         'status': 'starting',
+        'profile': profile,
         'message': f'Stream {source_type} started',
         'camera_id': camera_id  # إرجاع camera_id للرجوع إليه في الواجهة الأمامية
     }
@@ -1544,24 +5184,111 @@ def handle_stop_stream(data):
 
 
 
+@socketio.on('subscribe_stream')
+def handle_subscribe_stream(data):
+    stream_id = data.get('stream_id')
+    
+    if not stream_id or stream_id not in active_streams:
+        return {'status': 'error', 'message': 'Invalid stream ID'}
+    
+    tier = data.get('tier', DEFAULT_PREVIEW_TIER)
+    if tier not in PREVIEW_TIERS:
+        return {'status': 'error', 'message': f'Unknown preview tier: {tier}'}
+    
+    with subscription_lock:
+        subscribers = stream_subscribers.setdefault(stream_id, {})
+        subscription = subscribers.get(request.sid)
+        if subscription is None:
+            subscribers[request.sid] = StreamSubscription(request.sid, tier)
+        if request.sid not in client_senders:
+            client_senders[request.sid] = ClientSender(request.sid)
+    
+    # إعادة الاشتراك بمستوى آخر تغيّر مستوى الاشتراك الحالي
+    if subscription is not None:
+        subscription.requested = tier
+        if subscription.tier != tier:
+            move_subscription(stream_id, subscription, tier)
+    
+    return {'status': 'success', 'stream_id': stream_id, 'tier': tier}
+
+
+
+
+@socketio.on('unsubscribe_stream')
+def handle_unsubscribe_stream(data):
+    stream_id = data.get('stream_id')
+    
+    if not stream_id:
+        return {'status': 'error', 'message': 'Invalid stream ID'}
+    
+    with subscription_lock:
+        stream_subscribers.get(stream_id, {}).pop(request.sid, None)
+        sender = client_senders.get(request.sid)
+    
+    if sender is not None:
+        sender.discard(stream_id)
+    
+    return {'status': 'success', 'stream_id': stream_id}
+
+
+
+
 @socketio.on('get_streams')
 def handle_get_streams():
-    return {'streams': list(active_streams.values())}
+    return {'streams': [stream_snapshot(sid) for sid in list(active_streams)]}
 
 
 
 
 @socketio.on('get_tasks')
-def handle_get_tasks():
-    return {'tasks': list(tasks.values())}
+def handle_get_tasks(data=None):
+    """
+    المهام بنفس ترقيم /api/history/tasks (page, per_page, status)
+    
+    النسخة في الذاكرة أحدث من المحفوظة فتحل محلها، والمهام التي لم تُكتب في
+    المخزن بعد تُضاف إلى الصفحة الأولى. عند تعذر القراءة من المخزن تُرجع
+    المهام في الذاكرة وحدها.
+    """
+    data = data or {}
+    page = max(1, int(data.get('page') or 1))
+    per_page = min(STORE_PAGE_MAX, max(1, int(data.get('per_page') or 50)))
+    status = data.get('status')
+    live = [task for task in reversed(list(tasks.values()))
+            if status is None or task.get('status') == status]
+    
+    try:
+        store = get_store()
+        result = store.query_tasks(page, per_page, status=status)
+        items = [tasks.get(task['id'], task) for task in result['items']]
+        items = [task for task in items if status is None or task.get('status') == status]
+        if page == 1:
+            listed = {task['id'] for task in items}
+            unsaved = [task for task in live
+                       if task['id'] not in listed and store.get_task(task['id']) is None]
+            items = unsaved + items
+            result['total'] += len(unsaved)
+    except Exception as e:
+        logger.error(f"خطأ في قراءة المهام من المخزن: {str(e)}")
+        start = (page - 1) * per_page
+        items = live[start:start + per_page]
+        result = {'page': page, 'per_page': per_page, 'total': len(live)}
+    
+    return {
+        'tasks': items,
+        'page': result['page'],
+        'per_page': result['per_page'],
+        'total': result['total']
+    }
 
 
 
 
 # بدء التطبيق
 if __name__ == '__main__':
-    # تحميل النماذج عند بدء التشغيل
-    load_models()
+    # تحميل نماذج الملف الافتراضي في الخلفية بالتوازي (تبقى محملة)؛ الواجهة تعمل فورًا
+    # و /api/health يعرض الجاهزية، والملفات الأخرى تُحمّل عند أول بث أو مهمة تطلبها
+    if PRELOAD_MODELS:
+        Thread(target=load_models, daemon=True, name='model-preload').start()
     
     # تشغيل تطبيق Flask مع Socket.IO
     logger.info("🚀 بدء الخادم على المنفذ 5600...")
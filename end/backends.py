@@ -0,0 +1,391 @@
+"""
+خلفيات الاستدلال على المعالج لـ YOLO ومُرمّز صور CLIP
+
+يُصدَّر النموذج مرة واحدة إلى ONNX أو TorchScript أو OpenVINO داخل مجلد الذاكرة،
+ثم يُحمّل في كل تشغيل بعدد مؤشرات ترابط محدد. YOLO المُصدّر يُحمّل عبر ultralytics
+نفسها، فتبقى النتائج بنفس الواجهة (r.boxes) التي تقرؤها parse_detections.
+
+عند أول تصدير يُقارن النموذج الجديد مع PyTorch على صور مرجعية (تطابق الكشوفات
+لـ YOLO، وتشابه المتجهات لـ CLIP)، ويُحفظ التقرير بجوار الملف المُصدّر. الخلفية
+التي تفشل في الفحص لا تُستخدم.
+"""
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import torch
+
+from tracker import iou_matrix, greedy_match
+
+
+
+
+BACKENDS = ('torch', 'onnx', 'torchscript', 'openvino')
+
+# حدود فحص التطابق
+PARITY_MIN_MATCH = 0.95      # أدنى نسبة كشوفات متطابقة في الاتجاهين
+PARITY_IOU = 0.5             # IoU المطابقة بين كشفين من نفس الفئة
+PARITY_MIN_COSINE = 0.999    # أدنى تشابه جيب تمام بين متجهات CLIP
+
+
+
+
+def _read_report(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+
+
+def _write_report(path, report):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+
+
+
+def time_callable(fn, repeats=5):
+    """متوسط زمن استدعاء fn بالمللي ثانية بعد استدعاء إحماء"""
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+
+
+def _boxes(result):
+    """(المربعات، الفئات، الثقة) كمصفوفات NumPy من نتيجة ultralytics واحدة"""
+    if result.boxes is None or len(result.boxes) == 0:
+        return np.zeros((0, 4)), np.zeros(0, dtype=np.int64), np.zeros(0)
+    boxes = result.boxes
+    return (boxes.xyxy.cpu().numpy().astype(np.float64),
+            boxes.cls.cpu().numpy().astype(np.int64),
+            boxes.conf.cpu().numpy().astype(np.float64))
+
+
+
+
+def yolo_parity(reference, candidate, images, conf=0.25, iou=0.45, min_match=PARITY_MIN_MATCH):
+    """
+    مقارنة كشوفات نموذج YOLO مُصدّر مع نموذج PyTorch على نفس الصور
+
+    الكشفان متطابقان إذا كانا من نفس الفئة و IoU بينهما >= PARITY_IOU.
+
+    المعلمات:
+        reference: نموذج YOLO الأصلي
+        candidate: النموذج المُصدّر
+        images: قائمة صور BGR
+        min_match: أدنى نسبة استرجاع ودقة لاجتياز الفحص
+
+    الإرجاع:
+        تقرير {images, reference_boxes, candidate_boxes, matched, recall,
+               precision, mean_iou, max_conf_diff, passed}
+    """
+    ref_total = cand_total = matched = 0
+    ious = []
+    conf_diffs = [0.0]
+
+    for image in images:
+        ref = _boxes(reference(image, conf=conf, iou=iou, verbose=False)[0])
+        cand = _boxes(candidate(image, conf=conf, iou=iou, verbose=False)[0])
+        ref_total += len(ref[0])
+        cand_total += len(cand[0])
+
+        scores = iou_matrix(ref[0], cand[0])
+        if scores.size:
+            scores[ref[1][:, None] != cand[1][None, :]] = 0.0
+        for r, c in greedy_match(scores, PARITY_IOU):
+            matched += 1
+            ious.append(scores[r, c])
+            conf_diffs.append(abs(ref[2][r] - cand[2][c]))
+
+    recall = matched / ref_total if ref_total else 1.0
+    precision = matched / cand_total if cand_total else 1.0
+    return {
+        'images': len(images),
+        'reference_boxes': ref_total,
+        'candidate_boxes': cand_total,
+        'matched': matched,
+        'recall': round(recall, 4),
+        'precision': round(precision, 4),
+        'mean_iou': round(float(np.mean(ious)), 4) if ious else None,
+        'max_conf_diff': round(float(max(conf_diffs)), 4),
+        'passed': bool(images) and recall >= min_match and precision >= min_match
+    }
+
+
+
+
+def clip_parity(reference, candidate, pixel_values):
+    """
+    مقارنة متجهات صور CLIP بين النموذج الأصلي والمُصدّر
+
+    الإرجاع:
+        تقرير {images, min_cosine, mean_cosine, passed}
+    """
+    with torch.no_grad():
+        ref = reference.get_image_features(pixel_values=pixel_values).float()
+        cand = candidate.get_image_features(pixel_values=pixel_values).float()
+    cosine = torch.nn.functional.cosine_similarity(ref, cand, dim=-1)
+    return {
+        'images': int(pixel_values.shape[0]),
+        'min_cosine': round(float(cosine.min()), 6),
+        'mean_cosine': round(float(cosine.mean()), 6),
+        'passed': bool(cosine.min() >= PARITY_MIN_COSINE)
+    }
+
+
+
+
+def export_yolo(weights_path, backend, cache_dir, imgsz=640):
+    """
+    تصدير YOLO مرة واحدة إلى cache_dir وإرجاع مسار الملف (أو مجلد OpenVINO)
+
+    ultralytics تكتب الملف بجوار الأوزان، فيُنقل إلى مجلد الذاكرة باسم يتضمن
+    حجم الإدخال والخلفية.
+    """
+    from ultralytics import YOLO
+
+    stem = os.path.splitext(os.path.basename(weights_path))[0]
+    suffix = {'onnx': '.onnx', 'torchscript': '.torchscript', 'openvino': '_openvino_model'}[backend]
+    target = os.path.join(cache_dir, f"{stem}-{imgsz}{suffix}")
+    if os.path.exists(target):
+        return target, False
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # الأبعاد الديناميكية تسمح بدفعات المجدول المشترك
+    exported = YOLO(weights_path).export(
+        format=backend, imgsz=imgsz, dynamic=backend != 'torchscript', simplify=backend == 'onnx'
+    )
+    shutil.move(str(exported), target)
+    return target, True
+
+
+
+
+def tune_yolo_threads(yolo, backend, artifact, threads):
+    """
+    إعادة إنشاء جلسة ONNX Runtime أو نموذج OpenVINO داخل مُتنبئ ultralytics
+    بعدد مؤشرات محدد (ultralytics تستخدم الإعدادات الافتراضية)
+
+    الإرجاع:
+        True إذا طُبق عدد المؤشرات
+    """
+    backend_model = getattr(getattr(yolo, 'predictor', None), 'model', None)
+    if backend_model is None:
+        return False
+
+    if backend == 'onnx' and hasattr(backend_model, 'session'):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        backend_model.session = ort.InferenceSession(artifact, options, providers=['CPUExecutionProvider'])
+        return True
+
+    if backend == 'openvino' and hasattr(backend_model, 'ov_compiled_model'):
+        import openvino as ov
+        core = ov.Core()
+        xml = next(name for name in os.listdir(artifact) if name.endswith('.xml'))
+        backend_model.ov_compiled_model = core.compile_model(
+            core.read_model(os.path.join(artifact, xml)), 'CPU',
+            {'INFERENCE_NUM_THREADS': threads, 'PERFORMANCE_HINT': 'LATENCY'}
+        )
+        return True
+
+    # TorchScript يتبع torch.set_num_threads
+    return backend == 'torchscript'
+
+
+
+
+def load_yolo_backend(reference, weights_path, backend, cache_dir, imgsz, threads,
+                      parity_images=None, conf=0.25, iou=0.45):
+    """
+    تحميل YOLO بخلفية محددة مع فحص التطابق عند أول تصدير
+
+    المعلمات:
+        reference: نموذج YOLO الأصلي (للفحص)
+        weights_path: مسار أوزان .pt
+        backend: 'onnx' أو 'torchscript' أو 'openvino'
+        cache_dir: مجلد الملفات المُصدّرة
+        imgsz: حجم الإدخال المُصدّر
+        threads: عدد مؤشرات الترابط داخل العملية
+        parity_images: صور BGR مرجعية (None لتخطي الفحص)
+
+    الإرجاع:
+        (النموذج، المعلومات) حيث المعلومات {backend, artifact, threads_tuned, parity}؛
+        النموذج None إذا فشل فحص التطابق
+    """
+    from ultralytics import YOLO
+
+    artifact, fresh = export_yolo(weights_path, backend, cache_dir, imgsz)
+    candidate = YOLO(artifact, task='detect')
+
+    # استدلال أول لإنشاء المُتنبئ ثم ضبط مؤشرات الترابط
+    warmup = parity_images[0] if parity_images else np.zeros((imgsz, imgsz, 3), dtype=np.uint8)
+    candidate(warmup, conf=conf, iou=iou, verbose=False)
+    tuned = tune_yolo_threads(candidate, backend, artifact, threads)
+
+    report_path = f"{artifact.rstrip(os.sep)}.parity.json"
+    report = None if fresh else _read_report(report_path)
+    if report is None and parity_images:
+        report = yolo_parity(reference, candidate, parity_images, conf, iou)
+        image = parity_images[0]
+        report['reference_ms'] = round(time_callable(lambda: reference(image, conf=conf, iou=iou, verbose=False)), 2)
+        report['candidate_ms'] = round(time_callable(lambda: candidate(image, conf=conf, iou=iou, verbose=False)), 2)
+        _write_report(report_path, report)
+
+    info = {'backend': backend, 'artifact': artifact, 'threads_tuned': tuned, 'parity': report}
+    if report is not None and not report['passed']:
+        return None, info
+    return candidate, info
+
+
+
+
+class _VisionEncoder(torch.nn.Module):
+    """مُرمّز صور CLIP وحده لتصديره"""
+
+    def __init__(self, clip_model):
+        super().__init__()
+        self.clip_model = clip_model
+
+    def forward(self, pixel_values):
+        return self.clip_model.get_image_features(pixel_values=pixel_values)
+
+
+
+
+class ExportedCLIP:
+    """
+    نموذج CLIP بمُرمّز صور مُصدّر وبقية الواجهة من نموذج PyTorch
+
+    get_image_features تمر عبر الخلفية؛ get_text_features و logit_scale من
+    النموذج الأصلي (النصوص تُرمّز مرة واحدة وتُحفظ على القرص).
+    """
+
+    def __init__(self, clip_model, runner, backend):
+        self.clip_model = clip_model
+        self.runner = runner
+        self.backend = backend
+        self.logit_scale = clip_model.logit_scale
+
+    def get_image_features(self, pixel_values, **kwargs):
+        return self.runner(pixel_values)
+
+    def get_text_features(self, **inputs):
+        return self.clip_model.get_text_features(**inputs)
+
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+
+
+
+def export_clip(clip_model, backend, path, image_size):
+    """تصدير مُرمّز الصور إلى ONNX (لـ onnx و openvino) أو TorchScript"""
+    encoder = _VisionEncoder(clip_model).eval()
+    dummy = torch.zeros(1, 3, image_size, image_size)
+    tmp_path = f"{path}.tmp"
+
+    with torch.no_grad():
+        if backend == 'torchscript':
+            torch.jit.trace(encoder, dummy).save(tmp_path)
+        else:
+            torch.onnx.export(
+                encoder, (dummy,), tmp_path,
+                input_names=['pixel_values'], output_names=['image_embeds'],
+                dynamic_axes={'pixel_values': {0: 'batch'}, 'image_embeds': {0: 'batch'}},
+                opset_version=17
+            )
+    os.replace(tmp_path, path)
+
+
+
+
+def clip_runner(backend, path, threads):
+    """دالة pixel_values ← متجهات (موتر torch) للخلفية المحددة"""
+    if backend == 'torchscript':
+        module = torch.jit.load(path).eval()
+
+        def run(pixel_values):
+            with torch.no_grad():
+                return module(pixel_values)
+        return run
+
+    if backend == 'onnx':
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+        def run(pixel_values):
+            outputs = session.run(None, {'pixel_values': pixel_values.cpu().numpy().astype(np.float32)})
+            return torch.from_numpy(outputs[0])
+        return run
+
+    import openvino as ov
+    core = ov.Core()
+    compiled = core.compile_model(core.read_model(path), 'CPU',
+                                  {'INFERENCE_NUM_THREADS': threads, 'PERFORMANCE_HINT': 'LATENCY'})
+
+    def run(pixel_values):
+        outputs = compiled(pixel_values.cpu().numpy().astype(np.float32))
+        return torch.from_numpy(outputs[compiled.output(0)])
+    return run
+
+
+
+
+def load_clip_backend(clip_model, clip_name, backend, cache_dir, threads, parity_inputs=None):
+    """
+    تحميل مُرمّز صور CLIP بخلفية محددة مع فحص التطابق عند أول تصدير
+
+    المعلمات:
+        clip_model: نموذج CLIPModel من transformers
+        clip_name: اسم النموذج (لتسمية الملف المُصدّر)
+        backend: 'onnx' أو 'torchscript' أو 'openvino'
+        cache_dir: مجلد الملفات المُصدّرة
+        threads: عدد مؤشرات الترابط داخل العملية
+        parity_inputs: موتر pixel_values مرجعي (None لتخطي الفحص)
+
+    الإرجاع:
+        (النموذج، المعلومات)؛ النموذج None إذا فشل فحص التطابق
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    suffix = '.torchscript' if backend == 'torchscript' else '.onnx'
+    path = os.path.join(cache_dir, f"{clip_name.replace('/', '--')}-vision{suffix}")
+
+    fresh = not os.path.exists(path)
+    if fresh:
+        export_clip(clip_model, backend, path, clip_model.config.vision_config.image_size)
+
+    candidate = ExportedCLIP(clip_model, clip_runner(backend, path, threads), backend)
+
+    report_path = f"{path}.{backend}.parity.json"
+    report = None if fresh else _read_report(report_path)
+    if report is None and parity_inputs is not None:
+        report = clip_parity(clip_model, candidate, parity_inputs)
+        with torch.no_grad():
+            report['reference_ms'] = round(time_callable(lambda: clip_model.get_image_features(pixel_values=parity_inputs)), 2)
+        report['candidate_ms'] = round(time_callable(lambda: candidate.get_image_features(pixel_values=parity_inputs)), 2)
+        _write_report(report_path, report)
+
+    info = {'backend': backend, 'artifact': path, 'threads_tuned': True, 'parity': report}
+    if report is not None and not report['passed']:
+        return None, info
+    return candidate, info
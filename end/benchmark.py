@@ -0,0 +1,476 @@
+"""
+قياس أداء خط الكشف (فك الترميز ← التحجيم ← YOLO ← Haar ← CLIP ← الرسم ← ترميز JPEG)
+
+يشغّل مراحل خط البث نفسها من app.py على مقاطع اصطناعية أو مسجلة، بنماذج
+بديلة خفيفة (افتراضيًا، بدون شبكة ولا GPU) أو بالنماذج الحقيقية، عبر شبكة من
+الإعدادات: الدقة، خطوة الاستدلال، حجم دفعة YOLO، وتشغيل CLIP أو إيقافه.
+
+كل إعداد يعمل في عملية مستقلة لتكون ذروة الذاكرة (RSS) خاصة به. النتيجة JSON
+مرتب المفاتيح لمقارنته بين الإصدارات.
+
+أمثلة:
+    python benchmark.py --frames 200 --output bench.json
+    python benchmark.py --resolutions 640x360,1920x1080 --strides 1,3 --batch-sizes 1,8 --streams 4
+    python benchmark.py --video ../static/uploads/sample.mp4 --models real --clip on
+    python benchmark.py --models real --backends torch,onnx,openvino --clip on
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from threading import Thread
+
+import numpy as np
+
+
+
+
+# فئات COCO التي يعيدها YOLO البديل
+STUB_PERSON = 0
+STUB_BAG = 24
+
+BENCH_STAGES = ('decode', 'resize', 'yolo', 'haar', 'clip', 'flow', 'infer', 'draw', 'encode')
+CONFIG_KEYS = ('resolution', 'stride', 'batch_size', 'clip', 'streams', 'models', 'backend', 'video', 'motion_gate')
+
+
+
+
+class RecordingMetrics:
+    """بديل StageMetrics يحتفظ بكل القيم لحساب المئينات"""
+
+    def __init__(self):
+        self.samples = []
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+
+
+
+
+class StubBoxes:
+    """كشوفات بنفس واجهة ultralytics التي تقرأها parse_detections"""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __iter__(self):
+        for x1, y1, x2, y2, conf, cls in self.rows:
+            yield StubBox((x1, y1, x2, y2), conf, cls)
+
+
+
+
+class StubBox:
+    def __init__(self, xyxy, conf, cls):
+        self.xyxy = [xyxy]
+        self.conf = [conf]
+        self.cls = [cls]
+
+
+
+
+class StubResult:
+    def __init__(self, rows):
+        self.boxes = StubBoxes(rows)
+
+
+
+
+class StubYOLO:
+    """
+    YOLO بديل: يعيد أشخاصًا وحقيبة في مواقع المستطيلات المرسومة في الإطار
+    الاصطناعي، مع زمن استدلال اختياري لكل دفعة ولكل صورة
+    """
+
+    def __init__(self, people=3, batch_latency=0.0, image_latency=0.0):
+        self.people = people
+        self.batch_latency = batch_latency
+        self.image_latency = image_latency
+        self.calls = 0
+
+    def __call__(self, images, conf=0.25, iou=0.45, verbose=False):
+        batch = images if isinstance(images, list) else [images]
+        time.sleep(self.batch_latency + self.image_latency * len(batch))
+        self.calls += 1
+        return [self._detect(image) for image in batch]
+
+    def _detect(self, image):
+        h, w = image.shape[:2]
+        rows = []
+        for i in range(self.people):
+            x1 = (i + 1) * w / (self.people + 2)
+            rows.append((x1, h * 0.3, x1 + w * 0.08, h * 0.9, 0.85, STUB_PERSON))
+        rows.append((w * 0.05, h * 0.7, w * 0.15, h * 0.85, 0.6, STUB_BAG))
+        return StubResult(rows)
+
+
+
+
+class StubInputs(dict):
+    def to(self, device):
+        return self
+
+
+
+
+class StubCLIPProcessor:
+    """معالج بديل: تحجيم الوجوه إلى 224x224 وتكديسها كما يفعل معالج HF"""
+
+    def __call__(self, images=None, return_tensors="pt", **kwargs):
+        import torch
+        arrays = [np.asarray(image.resize((224, 224)), dtype=np.float32) / 255 for image in images]
+        return StubInputs(pixel_values=torch.from_numpy(np.stack(arrays)).permute(0, 3, 1, 2))
+
+
+
+
+class StubCLIPModel:
+    """CLIP بديل: إسقاط خطي ثابت للبكسلات المصغرة بدلاً من مُرمّز ViT"""
+
+    def __init__(self, dim=512):
+        import torch
+        generator = torch.Generator().manual_seed(0)
+        self.projection = torch.randn(3 * 16 * 16, dim, generator=generator)
+        self.logit_scale = torch.tensor(4.6052)
+
+    def get_image_features(self, pixel_values):
+        import torch
+        pooled = torch.nn.functional.adaptive_avg_pool2d(pixel_values, 16).flatten(1)
+        return pooled @ self.projection
+
+
+
+
+class StubLabelRegistry:
+    def __init__(self, labels, dim=512):
+        import torch
+        generator = torch.Generator().manual_seed(1)
+        features = torch.randn(len(labels), dim, generator=generator)
+        self.entry = (labels, features / features.norm(dim=-1, keepdim=True))
+
+    def get(self, name):
+        return self.entry
+
+
+
+
+def stub_models(app, clip_on, yolo_latency):
+    """قاموس نماذج بنفس مفاتيح load_models مع بدائل خفيفة"""
+    import cv2
+    return {
+        'yolo': StubYOLO(batch_latency=yolo_latency),
+        'face_cascade': cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'),
+        'clip_model': StubCLIPModel() if clip_on else None,
+        'clip_proc': StubCLIPProcessor() if clip_on else None,
+        'clip_name': 'stub' if clip_on else None,
+        'label_registry': StubLabelRegistry(app.CLIP_LABELS) if clip_on else None,
+        'device': 'cpu',
+        'use_openai_clip': False
+    }
+
+
+
+
+def synthetic_frames(width, height, count, seed=0):
+    """
+    مقطع اصطناعي: خلفية بضوضاء ثابتة ومستطيلات تتحرك (لتفعيل بوابة الحركة
+    والتدفق البصري كما في مشهد حقيقي)
+    """
+    import cv2
+    rng = np.random.default_rng(seed)
+    background = rng.integers(40, 90, size=(height, width, 3), dtype=np.uint8)
+    frames = []
+    for i in range(count):
+        frame = background.copy()
+        for j in range(3):
+            x = int((i * (3 + j) + j * width / 4) % max(1, width - 80))
+            y = int(height * (0.3 + 0.15 * j))
+            cv2.rectangle(frame, (x, y), (x + 60, y + 120), (180, 160, 140), -1)
+            cv2.circle(frame, (x + 30, y - 20), 18, (200, 180, 170), -1)
+        frames.append(frame)
+    return frames
+
+
+
+
+def recorded_frames(video_path, width, height, count):
+    """قراءة count إطارًا من ملف فيديو (مع التكرار من البداية) بالدقة المطلوبة"""
+    import cv2
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise RuntimeError(f"تعذر فتح الفيديو: {video_path}")
+    frames = []
+    while len(frames) < count:
+        ret, frame = cap.read()
+        if not ret:
+            if not frames:
+                raise RuntimeError(f"الفيديو فارغ: {video_path}")
+            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            continue
+        frames.append(cv2.resize(frame, (width, height)))
+    cap.release()
+    return frames
+
+
+
+
+def percentile_ms(samples, q):
+    return round(float(np.percentile(samples, q)) * 1000, 3) if samples else 0.0
+
+
+
+
+def run_stream(app, models, frames, stride, metrics, inferred):
+    """محاكاة مراحل مسار البث لبث واحد على قائمة إطارات"""
+    # خطوة ثابتة (بدون الوضع التكيفي) لتبقى الإعدادات قابلة للمقارنة
+    analyzer = app.StridedAnalyzer(stride=stride, adaptive=False, metrics=metrics)
+    gate = app.MotionGate()
+    box_thick, font_scale, font_thick = app.get_dynamic_sizes(frames[0].shape[1])
+
+    for source in frames:
+        t0 = time.perf_counter()
+        frame = source.copy()  # بديل فك الترميز: الإطار جاهز في الذاكرة
+        metrics['decode'].record(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        if app.MOTION_GATING and not gate.update(frame) and analyzer.last is not None:
+            analysis = analyzer.current()
+        else:
+            analysis = analyzer.analyze(models, frame, roi=gate.roi if app.MOTION_GATING else None)
+        metrics['infer'].record(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        app.render_analysis(frame, analysis, box_thick, font_scale, font_thick)
+        app.draw_dashboard(frame, 0.0, analysis['stats'], False)
+        t1 = time.perf_counter()
+        metrics['draw'].record(t1 - t0)
+
+        app.PreviewFrame(frame).encode(app.DEFAULT_PREVIEW_TIER)
+        metrics['encode'].record(time.perf_counter() - t1)
+
+    inferred.append((analyzer.inferred, analyzer.propagated))
+
+
+
+
+def run_config(config):
+    """
+    تشغيل إعداد واحد في هذه العملية وإرجاع قاموس النتائج
+
+    المعلمات:
+        config: قاموس resolution و stride و batch_size و clip و streams و frames
+                و warmup و models و backend و video و motion_gate و yolo_latency و alloc_frames
+    """
+    if config['device'] == 'cpu':
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    import logging
+    import torch
+    import app
+
+    logging.getLogger('surveillance-app').setLevel(logging.WARNING)
+    torch.set_num_threads(config['threads'] or torch.get_num_threads())
+
+    if config['models'] == 'real':
+        app.MASK_DETECTION = config['clip']
+        app.INFERENCE_BACKEND = config['backend']
+        models = app.load_models()
+    else:
+        models = stub_models(app, config['clip'], config['yolo_latency'] / 1000)
+
+    app.MOTION_GATING = config['motion_gate']
+
+    # حجم الدفعة 1 يعني بدون المجدول المشترك
+    app.YOLO_BATCHING = config['batch_size'] > 1
+    if app.YOLO_BATCHING:
+        app.get_inference_scheduler(models['yolo'], models.get('imgsz')).max_batch = config['batch_size']
+
+    width, height = config['resolution']
+    total = config['warmup'] + config['frames']
+    if config['video']:
+        frames = recorded_frames(config['video'], width, height, total)
+    else:
+        frames = synthetic_frames(width, height, total)
+
+    # إحماء (تحميل المكتبات الكسولة وذاكرات OpenCV) بدون قياس
+    warm_metrics = {name: app.StageMetrics() for name in BENCH_STAGES}
+    run_stream(app, models, frames[:config['warmup']] or frames[:1], config['stride'], warm_metrics, [])
+
+    metrics = [{name: RecordingMetrics() for name in BENCH_STAGES} for _ in range(config['streams'])]
+    inferred = []
+    timed = frames[config['warmup']:]
+    threads = [
+        Thread(target=run_stream, args=(app, models, timed, config['stride'], metrics[i], inferred))
+        for i in range(config['streams'])
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    stages = {}
+    for name in BENCH_STAGES:
+        samples = [s for stream_metrics in metrics for s in stream_metrics[name].samples]
+        if samples:
+            stages[name] = {
+                'count': len(samples),
+                'mean_ms': round(float(np.mean(samples)) * 1000, 3),
+                'p50_ms': percentile_ms(samples, 50),
+                'p99_ms': percentile_ms(samples, 99)
+            }
+
+    # تخصيصات الذاكرة لكل إطار في تمريرة منفصلة (tracemalloc يبطئ التنفيذ)
+    alloc = []
+    if config['alloc_frames']:
+        alloc_metrics = {name: app.StageMetrics() for name in BENCH_STAGES}
+        tracemalloc.start()
+        for frame in timed[:config['alloc_frames']]:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            run_stream(app, models, [frame], config['stride'], alloc_metrics, [])
+            alloc.append(tracemalloc.get_traced_memory()[1] - before)
+        tracemalloc.stop()
+
+    frames_done = config['frames'] * config['streams']
+    return {
+        'config': {key: config[key] for key in CONFIG_KEYS},
+        'frames': frames_done,
+        'wall_s': round(wall, 3),
+        'fps': round(frames_done / wall, 2) if wall > 0 else 0.0,
+        'stages': stages,
+        'inferred_frames': sum(i for i, _ in inferred),
+        'propagated_frames': sum(p for _, p in inferred),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'alloc_peak_bytes_per_frame': {
+            'p50': int(np.percentile(alloc, 50)) if alloc else 0,
+            'max': int(max(alloc)) if alloc else 0
+        }
+    }
+
+
+
+
+def parse_list(value, cast):
+    return [cast(item) for item in value.split(',') if item]
+
+
+def parse_resolution(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def parse_clip(value):
+    return {'on': [True], 'off': [False], 'both': [False, True]}[value]
+
+
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="قياس أداء خط الكشف")
+    parser.add_argument('--frames', type=int, default=120, help="إطارات مقاسة لكل بث")
+    parser.add_argument('--warmup', type=int, default=10, help="إطارات إحماء غير مقاسة")
+    parser.add_argument('--resolutions', default='640x360,1280x720')
+    parser.add_argument('--strides', default='1,3')
+    parser.add_argument('--batch-sizes', default='1,4')
+    parser.add_argument('--clip', choices=('on', 'off', 'both'), default='both')
+    parser.add_argument('--streams', type=int, default=1, help="بثوث متزامنة (لتأثير حجم الدفعة)")
+    parser.add_argument('--models', choices=('stub', 'real'), default='stub')
+    parser.add_argument('--backends', default='torch',
+                        help="خلفيات الاستدلال للنماذج الحقيقية (مثل torch,onnx,openvino)")
+    parser.add_argument('--video', default=None, help="مقطع مسجل بدلاً من المقطع الاصطناعي")
+    parser.add_argument('--motion-gate', choices=('on', 'off'), default='off',
+                        help="بوابة الحركة (إيقافها يقيس الاستدلال على كل إطار حسب الخطوة)")
+    parser.add_argument('--yolo-latency', type=float, default=15.0, help="زمن YOLO البديل لكل دفعة (مللي ثانية)")
+    parser.add_argument('--alloc-frames', type=int, default=10, help="إطارات تمريرة قياس التخصيصات (0 لتعطيلها)")
+    parser.add_argument('--device', choices=('cpu', 'auto'), default='cpu')
+    parser.add_argument('--threads', type=int, default=0, help="عدد مؤشرات ترابط torch (0 للافتراضي)")
+    parser.add_argument('--no-isolate', action='store_true', help="تشغيل كل الإعدادات في هذه العملية")
+    parser.add_argument('--output', default=None, help="ملف JSON للنتائج (الافتراضي: stdout)")
+    args = parser.parse_args(argv)
+
+    backend_names = parse_list(args.backends, str) if args.models == 'real' else ['torch']
+    grid = itertools.product(
+        parse_list(args.resolutions, parse_resolution),
+        parse_list(args.strides, int),
+        parse_list(args.batch_sizes, int),
+        parse_clip(args.clip),
+        backend_names
+    )
+    configs = [{
+        'resolution': resolution,
+        'stride': stride,
+        'batch_size': batch_size,
+        'clip': clip_on,
+        'backend': backend,
+        'streams': args.streams,
+        'frames': args.frames,
+        'warmup': args.warmup,
+        'models': args.models,
+        'video': args.video,
+        'motion_gate': args.motion_gate == 'on',
+        'yolo_latency': args.yolo_latency,
+        'alloc_frames': args.alloc_frames,
+        'device': args.device,
+        'threads': args.threads
+    } for resolution, stride, batch_size, clip_on, backend in grid]
+
+    results = []
+    for config in configs:
+        label = (f"{config['resolution'][0]}x{config['resolution'][1]} stride={config['stride']} "
+                 f"batch={config['batch_size']} clip={'on' if config['clip'] else 'off'} "
+                 f"backend={config['backend']}")
+        print(f"⏳ {label}", file=sys.stderr)
+        if args.no_isolate:
+            result = run_config(config)
+        else:
+            # عملية جديدة لكل إعداد: ذروة RSS وذاكرات النماذج لا تتسرب بين الإعدادات
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                result = pool.submit(run_config, config).result()
+        print(f"✅ {label}: {result['fps']} إطار/ث", file=sys.stderr)
+        results.append(result)
+
+    report = {
+        'meta': {
+            'git': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'args': vars(args)
+        },
+        'results': results
+    }
+    text = json.dumps(report, indent=2, sort_keys=True, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+
+
+if __name__ == '__main__':
+    main()
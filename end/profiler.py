@@ -0,0 +1,279 @@
+"""
+تتبع الأداء عند الطلب لبث أو مهمة واحدة لمدة محدودة
+
+الجلسة تجمع نوعين من البيانات:
+- فترات المراحل (decode، yolo، haar، clip، encode، emit...) من StageMetrics
+  لكل إطار، تُصدَّر كجدول زمني بصيغة Chrome trace (chrome://tracing أو Perfetto)
+- عينات مكدس دورية لمؤشرات الترابط التي تعمل على الهدف (في وضع 'sampling')،
+  تُصدَّر كمكدسات مطوية (flamegraph.pl أو speedscope)
+
+بدون جلسة نشطة لا يوجد أي عمل إضافي: StageMetrics تفحص مرجعًا فارغًا فقط.
+كل عملية تحفظ نتيجتها في ملف مستقل داخل مجلد الجلسة، وتُدمج الملفات عند القراءة.
+"""
+import json
+import os
+import sys
+import time
+from collections import Counter
+from threading import Event, Lock, Thread, current_thread, get_ident
+
+
+
+
+TRACE_MODES = ('stages', 'sampling')
+
+# مراحل تمتد عبر عدة مؤشرات ترابط (من الالتقاط حتى الإرسال)، تُعرض كأحداث غير متزامنة
+ASYNC_STAGES = ('end_to_end',)
+
+# حد أعلى لعدد أحداث الجلسة الواحدة لحماية الذاكرة
+MAX_TRACE_EVENTS = 200000
+
+
+
+
+def collapse_stack(frame, thread_name):
+    """تحويل مكدس إطار Python إلى سطر مطوي: thread;module:function;..."""
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        parts.append(f"{module}:{code.co_name}")
+        frame = frame.f_back
+    parts.append(thread_name)
+    return ';'.join(reversed(parts))
+
+
+
+
+class TraceSession:
+    """
+    جلسة تتبع واحدة داخل عملية واحدة
+
+    المعلمات:
+        trace_id: معرف الجلسة (مشترك بين العمليات لنفس الطلب)
+        target: وصف الهدف مثل 'stream:<id>' أو 'task:<id>'
+        deadline: وقت انتهاء الجلسة (ثوانٍ منذ epoch)
+        mode: 'stages' لفترات المراحل فقط، أو 'sampling' لإضافة عينات المكدس
+        sample_interval: الفاصل بين عينات المكدس بالثواني
+        label: اسم جزء الجلسة في هذه العملية (مثل 'stream' أو 'part-2')
+    """
+
+    def __init__(self, trace_id, target, deadline, mode='stages', sample_interval=0.005, label='main'):
+        if mode not in TRACE_MODES:
+            raise ValueError(f"وضع تتبع غير مدعوم: {mode}")
+
+        self.trace_id = trace_id
+        self.target = target
+        self.deadline = deadline
+        self.mode = mode
+        self.sample_interval = sample_interval
+        self.label = label
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.ended = None
+
+        self.lock = Lock()
+        self.events = []
+        self.threads = {}  # معرف المؤشر ← اسمه (المؤشرات التي سجلت مراحل للهدف)
+        self.stacks = Counter()
+        self.samples = 0
+        self.dropped = 0
+        self.async_id = 0
+        self.stop_event = Event()
+
+        self.sampler = None
+        if mode == 'sampling':
+            self.sampler = Thread(target=self._sample, daemon=True, name=f"trace-{trace_id}")
+            self.sampler.start()
+
+    def active(self):
+        return not self.stop_event.is_set() and time.time() < self.deadline
+
+    def stage(self, name):
+        """دالة تسجيل لمرحلة واحدة تُربط بـ StageMetrics.tracer"""
+        def record(seconds):
+            self.span(name, seconds)
+        return record
+
+    def span(self, name, seconds):
+        """تسجيل فترة مرحلة انتهت الآن واستغرقت seconds"""
+        if not self.active():
+            return
+
+        end = time.time()
+        tid = get_ident()
+        start_us = (end - seconds) * 1e6
+        dur_us = seconds * 1e6
+
+        with self.lock:
+            if len(self.events) >= MAX_TRACE_EVENTS:
+                self.dropped += 1
+                return
+            if tid not in self.threads:
+                self.threads[tid] = current_thread().name
+
+            if name in ASYNC_STAGES:
+                self.async_id += 1
+                common = {'name': name, 'cat': 'frame', 'id': self.async_id, 'pid': self.pid, 'tid': tid}
+                self.events.append(dict(common, ph='b', ts=start_us))
+                self.events.append(dict(common, ph='e', ts=start_us + dur_us))
+            else:
+                self.events.append({
+                    'name': name, 'cat': 'stage', 'ph': 'X',
+                    'ts': start_us, 'dur': dur_us, 'pid': self.pid, 'tid': tid
+                })
+
+    def _sample(self):
+        """أخذ عينات مكدس المؤشرات التي تعمل على الهدف حتى انتهاء الجلسة"""
+        while self.active():
+            with self.lock:
+                threads = dict(self.threads)
+            frames = sys._current_frames()
+            stacks = [collapse_stack(frames[tid], name) for tid, name in threads.items() if tid in frames]
+            del frames
+            with self.lock:
+                self.stacks.update(stacks)
+                self.samples += 1
+            self.stop_event.wait(self.sample_interval)
+
+    def stop(self):
+        if self.ended is None:
+            self.ended = time.time()
+        self.stop_event.set()
+        # انتظار آخر عينة قبل قراءة النتيجة (إلا إذا استُدعيت من مؤشر العينات نفسه)
+        if self.sampler is not None and self.sampler is not current_thread():
+            self.sampler.join(timeout=1.0)
+
+    def result(self):
+        """نتيجة الجلسة القابلة للحفظ كـ JSON"""
+        with self.lock:
+            thread_events = [
+                {'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': name}}
+                for tid, name in self.threads.items()
+            ]
+            return {
+                'trace_id': self.trace_id,
+                'target': self.target,
+                'label': self.label,
+                'pid': self.pid,
+                'mode': self.mode,
+                'started': self.started,
+                'ended': self.ended,
+                'deadline': self.deadline,
+                'samples': self.samples,
+                'dropped': self.dropped,
+                'events': [{
+                    'name': 'process_name', 'ph': 'M', 'pid': self.pid,
+                    'args': {'name': f"{self.target} ({self.label})"}
+                }] + thread_events + list(self.events),
+                'stacks': dict(self.stacks)
+            }
+
+    def save(self, folder):
+        """حفظ النتيجة في مجلد الجلسة وإرجاع مسار الملف"""
+        directory = os.path.join(folder, self.trace_id)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.pid}-{self.label}.json")
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.result(), f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+        return path
+
+    def snapshot(self):
+        with self.lock:
+            events = len(self.events)
+            threads = sorted(self.threads.values())
+        return {
+            'trace_id': self.trace_id,
+            'target': self.target,
+            'label': self.label,
+            'mode': self.mode,
+            'active': self.active(),
+            'remaining_s': round(max(0.0, self.deadline - time.time()), 1),
+            'events': events,
+            'samples': self.samples,
+            'threads': threads
+        }
+
+
+
+
+def attach_tracer(metrics, session):
+    """ربط جلسة بقاموس StageMetrics (فك الربط بتمرير None)"""
+    for name, stage_metrics in metrics.items():
+        stage_metrics.tracer = session.stage(name) if session is not None else None
+
+
+
+
+def load_trace(folder, trace_id):
+    """
+    قراءة ودمج ملفات جلسة من كل العمليات
+
+    الإرجاع:
+        قائمة نتائج الأجزاء (فارغة إذا لم يُحفظ شيء بعد)
+    """
+    directory = os.path.join(folder, os.path.basename(trace_id))
+    if not os.path.isdir(directory):
+        return []
+
+    parts = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.json'):
+            with open(os.path.join(directory, filename), encoding='utf-8') as f:
+                parts.append(json.load(f))
+    return parts
+
+
+
+
+def chrome_trace(parts):
+    """دمج الأجزاء في ملف Chrome trace واحد"""
+    return {
+        'traceEvents': [event for part in parts for event in part['events']],
+        'displayTimeUnit': 'ms'
+    }
+
+
+
+
+def folded_stacks(parts):
+    """دمج عينات المكدس من كل الأجزاء بصيغة flamegraph المطوية"""
+    stacks = Counter()
+    for part in parts:
+        stacks.update(part['stacks'])
+    return ''.join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+
+
+
+
+def summarize_trace(parts):
+    """ملخص المراحل (العدد والمتوسط والأقصى بالمللي ثانية) والمكدسات الأكثر تكرارًا"""
+    stages = {}
+    for part in parts:
+        events = part['events']
+        for event in events:
+            if event['ph'] == 'X':
+                stages.setdefault(event['name'], []).append(event['dur'] / 1000)
+        begins = {event['id']: event['ts'] for event in events if event['ph'] == 'b'}
+        for event in events:
+            if event['ph'] == 'e' and event['id'] in begins:
+                stages.setdefault(event['name'], []).append((event['ts'] - begins[event['id']]) / 1000)
+
+    stacks = Counter()
+    for part in parts:
+        stacks.update(part['stacks'])
+
+    return {
+        'parts': [{key: part[key] for key in ('label', 'pid', 'started', 'ended', 'samples', 'dropped')}
+                  for part in parts],
+        'stages': {
+            name: {
+                'count': len(values),
+                'avg_ms': round(sum(values) / len(values), 3),
+                'max_ms': round(max(values), 3)
+            }
+            for name, values in stages.items()
+        },
+        'top_stacks': [{'stack': stack, 'samples': count} for stack, count in stacks.most_common(10)]
+    }
@@ -0,0 +1,378 @@
+"""
+إنشاء نسخ INT8 من YOLO ومُرمّز صور CLIP واعتمادها ببوابة دقة
+
+التكميم يتم على نموذج ONNX المُصدّر (انظر backends.py) عبر ONNX Runtime:
+- static: معايرة مدى التنشيطات على إطارات من مقاطعنا (الفيديوهات المرفوعة
+  ومقاطع التنبيهات افتراضيًا)، ثم أوزان وتنشيطات INT8
+- dynamic: أوزان INT8 وتنشيطات تُكمم أثناء التشغيل (بدون معايرة)
+
+كل نسخة تُقارن مع نموذج FP32 على مجموعة مرجعية محلية: تطابق الكشوفات لـ YOLO،
+وتطابق أحكام القناع على وجوه الأشخاص المكتشفين لـ CLIP. النتيجة تُسجل في سجل
+النسخ (variants.json)، والتطبيق لا يستخدم إلا النسخ التي اجتازت البوابة.
+
+أمثلة:
+    python quantize.py yolo --method static --calibration ../static/uploads --reference ../static/captures
+    python quantize.py clip --method dynamic --reference ../static/captures
+    python quantize.py list
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+
+
+
+# حدود بوابة الدقة الافتراضية
+GATE_MIN_RECALL = 0.9          # نسبة كشوفات FP32 التي تجدها النسخة المكممة
+GATE_MIN_PRECISION = 0.9       # نسبة كشوفات النسخة المكممة الموجودة في FP32
+GATE_MIN_MASK_AGREEMENT = 0.95 # نسبة أحكام القناع المتطابقة
+
+DEFAULT_METHODS = {'yolo': 'static', 'clip': 'dynamic'}  # عند عدم تحديد --method
+
+MEDIA_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.mp4', '.avi', '.mov', '.mkv')
+
+
+
+
+def load_variants(path):
+    """قراءة سجل النسخ: الاسم ← المعلومات"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+
+
+def register_variant(path, name, entry):
+    """إضافة نسخة أو تحديثها في السجل (كتابة ذرية)"""
+    variants = load_variants(path)
+    variants[name] = entry
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(variants, f, indent=2, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+
+
+
+
+def approved_variant(path, name, kind):
+    """
+    معلومات نسخة معتمدة من نوع kind ('yolo' أو 'clip')
+
+    الإرجاع:
+        المعلومات، أو None إذا لم تُسجل أو لم تجتز البوابة أو حُذف ملفها
+    """
+    entry = load_variants(path).get(name)
+    if (entry is None or entry.get('kind') != kind
+            or not entry.get('gate', {}).get('passed')
+            or not os.path.exists(entry.get('artifact', ''))):
+        return None
+    return entry
+
+
+
+
+def media_paths(folders):
+    """ملفات الصور والفيديو داخل المجلدات (الأحدث أولًا)"""
+    paths = []
+    for folder in folders:
+        if os.path.isfile(folder):
+            paths.append(folder)
+            continue
+        if not os.path.isdir(folder):
+            continue
+        for name in os.listdir(folder):
+            if name.lower().endswith(MEDIA_EXTENSIONS):
+                paths.append(os.path.join(folder, name))
+    return sorted(paths, key=os.path.getmtime, reverse=True)
+
+
+
+
+def sample_frames(paths, count):
+    """
+    عينة إطارات BGR موزعة على الملفات: الصور كما هي، والفيديو بإطارات متباعدة
+
+    المعلمات:
+        paths: ملفات صور أو فيديو
+        count: العدد المطلوب من الإطارات
+    """
+    import cv2
+
+    images = [path for path in paths if not path.lower().endswith(('.mp4', '.avi', '.mov', '.mkv'))]
+    videos = [path for path in paths if path not in images]
+
+    frames = []
+    for path in images[:count]:
+        image = cv2.imread(path)
+        if image is not None:
+            frames.append(image)
+
+    per_video = max(1, (count - len(frames)) // max(1, len(videos)))
+    for path in videos:
+        if len(frames) >= count:
+            break
+        cap = cv2.VideoCapture(path)
+        total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) or per_video
+        for index in np.linspace(0, total - 1, per_video).astype(int):
+            cap.set(cv2.CAP_PROP_POS_FRAMES, int(index))
+            ret, frame = cap.read()
+            if ret:
+                frames.append(frame)
+        cap.release()
+
+    return frames[:count]
+
+
+
+
+def copy_metadata(source, target):
+    """نسخ بيانات ultralytics الوصفية (الفئات، الخطوة، حجم الإدخال) إلى النموذج المكمم"""
+    import onnx
+
+    src = onnx.load(source, load_external_data=False)
+    dst = onnx.load(target)
+    existing = {prop.key for prop in dst.metadata_props}
+    for prop in src.metadata_props:
+        if prop.key not in existing:
+            dst.metadata_props.add(key=prop.key, value=prop.value)
+    onnx.save(dst, target)
+
+
+
+
+def yolo_calibration_reader(model_path, frames, imgsz):
+    """قارئ معايرة يحضّر الإطارات كما يحضّرها ultralytics (letterbox، RGB، 0-1)"""
+    import onnxruntime as ort
+    from onnxruntime.quantization import CalibrationDataReader
+    from ultralytics.data.augment import LetterBox
+
+    input_name = ort.InferenceSession(model_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+    letterbox = LetterBox(new_shape=(imgsz, imgsz), auto=False)
+
+    class FrameReader(CalibrationDataReader):
+        def __init__(self):
+            self.frames = iter(frames)
+
+        def get_next(self):
+            frame = next(self.frames, None)
+            if frame is None:
+                return None
+            image = letterbox(image=frame)[:, :, ::-1].transpose(2, 0, 1)
+            return {input_name: np.ascontiguousarray(image, dtype=np.float32)[None] / 255}
+
+    return FrameReader()
+
+
+
+
+def quantize_onnx(source, target, method, reader=None, exclude=()):
+    """
+    تكميم نموذج ONNX إلى INT8
+
+    المعلمات:
+        source / target: مسارا النموذج الأصلي والمكمم
+        method: 'static' (يتطلب reader) أو 'dynamic'
+        reader: قارئ بيانات المعايرة
+        exclude: بادئات أسماء العقد التي تبقى بدقة كاملة
+    """
+    from onnx import load as load_onnx
+    from onnxruntime.quantization import (CalibrationMethod, QuantFormat, QuantType,
+                                          quantize_dynamic, quantize_static)
+
+    nodes = [node.name for node in load_onnx(source, load_external_data=False).graph.node
+             if any(node.name.startswith(prefix) for prefix in exclude)]
+
+    if method == 'static':
+        quantize_static(
+            source, target, reader,
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            calibrate_method=CalibrationMethod.MinMax,
+            nodes_to_exclude=nodes
+        )
+    else:
+        quantize_dynamic(source, target, weight_type=QuantType.QUInt8, nodes_to_exclude=nodes)
+
+
+
+
+def yolo_gate(reference, candidate, images, conf, iou, min_recall, min_precision):
+    """مقارنة الكشوفات مع FP32 على المجموعة المرجعية مع الأزمنة"""
+    import backends
+
+    report = backends.yolo_parity(reference, candidate, images, conf, iou, min_match=0.0)
+    report['passed'] = bool(images) and report['recall'] >= min_recall and report['precision'] >= min_precision
+    report['thresholds'] = {'recall': min_recall, 'precision': min_precision}
+    if images:
+        image = images[0]
+        report['reference_ms'] = round(backends.time_callable(
+            lambda: reference(image, conf=conf, iou=iou, verbose=False)), 2)
+        report['candidate_ms'] = round(backends.time_callable(
+            lambda: candidate(image, conf=conf, iou=iou, verbose=False)), 2)
+    return report
+
+
+
+
+def mask_gate(app, models, candidate, images, min_agreement):
+    """
+    مقارنة أحكام القناع مع FP32 على وجوه الأشخاص المكتشفين بنفس خط المعالجة
+
+    الإرجاع:
+        تقرير {faces, agreement, max_conf_diff, passed}
+    """
+    crops = []
+    for image in images:
+        detections = app.parse_detections(models['yolo'](image, conf=app.YOLO_CONF, iou=app.YOLO_IOU, verbose=False))
+        persons = [det['box'] for det in detections if det['kind'] == 'person']
+        crops.extend(app.extract_face_crops(models['face_cascade'], image, persons)[1])
+
+    reference = app.classify_masks(models, crops)
+    quantized = app.classify_masks(dict(models, clip_model=candidate), crops)
+    agree = [ref[0] == cand[0] for ref, cand in zip(reference, quantized)]
+    conf_diffs = [abs(ref[1] - cand[1]) for ref, cand in zip(reference, quantized)]
+
+    agreement = sum(agree) / len(agree) if agree else 0.0
+    return {
+        'faces': len(crops),
+        'agreement': round(agreement, 4),
+        'max_conf_diff': round(max(conf_diffs), 4) if conf_diffs else None,
+        'thresholds': {'agreement': min_agreement},
+        'passed': bool(crops) and agreement >= min_agreement
+    }
+
+
+
+
+def quantize_yolo(app, args, reference_frames):
+    import backends
+    from ultralytics import YOLO
+
+    weights = args.weights or os.path.join(app.parent_dir, "yolov8x.pt")
+    if not os.path.exists(weights):
+        weights = os.path.join(app.MODEL_CACHE_DIR, "yolov8n.pt")
+    reference = YOLO(weights)
+
+    source, _ = backends.export_yolo(weights, 'onnx', app.BACKENDS_CACHE_DIR, args.imgsz)
+    stem = os.path.splitext(os.path.basename(weights))[0]
+    target = os.path.join(app.BACKENDS_CACHE_DIR, f"{stem}-{args.imgsz}-int8-{args.method}.onnx")
+
+    reader = None
+    if args.method == 'static':
+        frames = sample_frames(media_paths(args.calibration), args.calibration_frames)
+        if not frames:
+            raise SystemExit("❌ لا توجد إطارات معايرة (--calibration)")
+        print(f"⏳ معايرة على {len(frames)} إطارًا...", file=sys.stderr)
+        reader = yolo_calibration_reader(source, frames, args.imgsz)
+
+    # رأس الكشف (آخر طبقة) يبقى بدقة كاملة: تكميم فك ترميز المربعات يفسد الإحداثيات
+    exclude = () if args.quantize_head else (f"/model.{len(reference.model.model) - 1}/",)
+    quantize_onnx(source, target, args.method, reader, exclude)
+    copy_metadata(source, target)
+
+    candidate = YOLO(target, task='detect')
+    gate = yolo_gate(reference, candidate, reference_frames, app.YOLO_CONF, app.YOLO_IOU,
+                     args.min_recall, args.min_precision)
+    return {'kind': 'yolo', 'base': weights, 'artifact': target, 'imgsz': args.imgsz}, gate
+
+
+
+
+def quantize_clip(app, args, reference_frames):
+    import backends
+
+    if args.method == 'static':
+        raise SystemExit("❌ CLIP يدعم التكميم الديناميكي فقط (--method dynamic)")
+
+    app.MASK_DETECTION = True
+    app.INFERENCE_BACKEND = 'torch'
+    models = app.load_models()
+    if models['clip_model'] is None or models['use_openai_clip']:
+        raise SystemExit("❌ يتطلب CLIP من transformers")
+
+    clip_name = models['clip_name']
+    source = os.path.join(app.BACKENDS_CACHE_DIR, f"{clip_name.replace('/', '--')}-vision.onnx")
+    if not os.path.exists(source):
+        os.makedirs(app.BACKENDS_CACHE_DIR, exist_ok=True)
+        backends.export_clip(models['clip_model'], 'onnx', source,
+                             models['clip_model'].config.vision_config.image_size)
+    target = source.replace('-vision.onnx', '-vision-int8-dynamic.onnx')
+    quantize_onnx(source, target, 'dynamic')
+
+    candidate = backends.ExportedCLIP(
+        models['clip_model'], backends.clip_runner('onnx', target, app.backend_threads()), 'onnx-int8'
+    )
+    gate = mask_gate(app, models, candidate, reference_frames, args.min_mask_agreement)
+    return {'kind': 'clip', 'base': clip_name, 'artifact': target}, gate
+
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="تكميم النماذج INT8 مع بوابة دقة")
+    parser.add_argument('kind', choices=('yolo', 'clip', 'list'))
+    parser.add_argument('--method', choices=('static', 'dynamic'), default=None,
+                        help="الافتراضي: static لـ YOLO و dynamic لـ CLIP")
+    parser.add_argument('--name', default=None, help="اسم النسخة في السجل (افتراضيًا: kind-int8-method)")
+    parser.add_argument('--weights', default=None, help="أوزان YOLO (الافتراضي: yolov8x.pt أو yolov8n.pt)")
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--calibration', nargs='*', default=None, help="مجلدات أو ملفات المعايرة")
+    parser.add_argument('--calibration-frames', type=int, default=200)
+    parser.add_argument('--reference', nargs='*', default=None, help="مجلدات أو ملفات المجموعة المرجعية")
+    parser.add_argument('--reference-frames', type=int, default=100)
+    parser.add_argument('--quantize-head', action='store_true', help="تكميم رأس كشف YOLO أيضًا")
+    parser.add_argument('--min-recall', type=float, default=GATE_MIN_RECALL)
+    parser.add_argument('--min-precision', type=float, default=GATE_MIN_PRECISION)
+    parser.add_argument('--min-mask-agreement', type=float, default=GATE_MIN_MASK_AGREEMENT)
+    args = parser.parse_args(argv)
+
+    import logging
+    import app
+
+    logging.getLogger('surveillance-app').setLevel(logging.WARNING)
+
+    if args.kind == 'list':
+        print(json.dumps(load_variants(app.VARIANTS_PATH), indent=2, ensure_ascii=False))
+        return
+
+    args.method = args.method or DEFAULT_METHODS[args.kind]
+
+    # افتراضيًا: مقاطعنا للمعايرة، والالتقاطات ومقاطع التنبيهات كمرجع
+    args.calibration = args.calibration or [app.UPLOADS_FOLDER, app.CLIPS_FOLDER]
+    args.reference = args.reference or [app.CAPTURES_FOLDER, app.CLIPS_FOLDER]
+    reference_frames = sample_frames(media_paths(args.reference), args.reference_frames)
+    if not reference_frames:
+        raise SystemExit("❌ لا توجد صور مرجعية لبوابة الدقة (--reference)")
+
+    started = time.time()
+    quantizer = quantize_yolo if args.kind == 'yolo' else quantize_clip
+    entry, gate = quantizer(app, args, reference_frames)
+
+    name = args.name or f"{args.kind}-int8-{args.method}"
+    entry.update({
+        'method': args.method,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'seconds': round(time.time() - started, 1),
+        'reference_frames': len(reference_frames),
+        'gate': gate
+    })
+    register_variant(app.VARIANTS_PATH, name, entry)
+
+    print(json.dumps({name: entry}, indent=2, ensure_ascii=False))
+    status = "✅ اجتازت" if gate['passed'] else "❌ لم تجتز"
+    print(f"{status} النسخة {name} بوابة الدقة", file=sys.stderr)
+    sys.exit(0 if gate['passed'] else 1)
+
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+"""
+مخزن دائم (SQLite) للمهام والبثوث والتنبيهات
+
+الكتابة تتم عبر مؤشر ترابط واحد يجمع السجلات في دفعات داخل معاملة واحدة، فلا
+تنتظر مؤشرات الكشف القرص أبدًا. تحديثات المهمة أو البث نفسه داخل الدفعة تُدمج
+في آخر حالة. القراءة تستخدم اتصالًا مستقلًا لكل مؤشر ترابط (وضع WAL يسمح
+بالقراءة أثناء الكتابة).
+"""
+import json
+import logging
+import sqlite3
+import time
+from collections import deque
+from threading import Condition, Thread, local
+
+
+logger = logging.getLogger('surveillance-app')
+
+
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id TEXT PRIMARY KEY,
+    filename TEXT,
+    status TEXT,
+    created REAL,
+    updated REAL,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_created ON tasks (created);
+CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (status, created);
+
+CREATE TABLE IF NOT EXISTS streams (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    type TEXT,
+    status TEXT,
+    created REAL,
+    updated REAL,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_streams_created ON streams (created);
+
+CREATE TABLE IF NOT EXISTS alerts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    type TEXT,
+    camera TEXT,
+    stream_id TEXT,
+    task_id TEXT,
+    path TEXT,
+    confidence REAL,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_alerts_ts ON alerts (ts);
+CREATE INDEX IF NOT EXISTS idx_alerts_camera ON alerts (camera, ts);
+CREATE INDEX IF NOT EXISTS idx_alerts_type ON alerts (type, ts);
+CREATE INDEX IF NOT EXISTS idx_alerts_task ON alerts (task_id, ts);
+"""
+
+
+
+
+def _dumps(data):
+    return json.dumps(data, ensure_ascii=False, default=str)
+
+
+
+
+class EventStore:
+    """
+    مخزن SQLite بكتابة مجمعة في الخلفية
+
+    المعلمات:
+        path: مسار ملف قاعدة البيانات
+        batch_size: أقصى عدد سجلات في المعاملة الواحدة
+        flush_interval: أقصى مدة (ثوانٍ) يبقى فيها سجل بانتظار الكتابة
+    """
+
+    def __init__(self, path, batch_size=200, flush_interval=0.5):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.cond = Condition()
+        self.alerts = deque()
+        self.cleared = []  # (مسار، منذ) لتنبيهات أُسقط التقاطها قبل كتابته
+        self.tasks = {}  # id ← آخر حالة (تُدمج التحديثات المتكررة)
+        self.streams = {}
+        self.written = 0
+        self.batches = 0
+        self.local = local()
+
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        # البثوث التي كانت تعمل عند توقف الخادم السابق لم تُغلق بشكل سليم
+        conn.execute(
+            "UPDATE streams SET status = 'interrupted', data = json_set(data, '$.status', 'interrupted') "
+            "WHERE status IN ('starting', 'streaming', 'stopping')"
+        )
+        conn.commit()
+
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _reader(self):
+        """اتصال قراءة خاص بمؤشر الترابط الحالي"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self.local.conn = conn
+        return conn
+
+    def _pending(self):
+        return len(self.alerts) + len(self.tasks) + len(self.streams) + len(self.cleared)
+
+    def save_task(self, task):
+        """حفظ آخر حالة لمهمة"""
+        with self.cond:
+            self.tasks[task['id']] = (_dumps(task), time.time())
+            self.cond.notify()
+
+    def save_stream(self, stream):
+        """حفظ آخر حالة لبث"""
+        with self.cond:
+            self.streams[stream['id']] = (_dumps(stream), time.time())
+            self.cond.notify()
+
+    def add_alert(self, alert, ts=None):
+        """
+        إضافة تنبيه
+
+        المعلمات:
+            alert: قاموس التنبيه كما يُرسل للعملاء (type, path, confidence,
+                   camera_id, stream_id, task_id)
+            ts: وقت التنبيه (الوقت الحالي افتراضيًا)
+        """
+        with self.cond:
+            self.alerts.append((ts or time.time(), alert))
+            if len(self.alerts) >= self.batch_size:
+                self.cond.notify()
+
+    def clear_alert_path(self, path, since):
+        """
+        إزالة مسار صورة التقاط لم تُكتب من تنبيهها (المنتظر أو المحفوظ)
+
+        المعلمات:
+            path: مسار الالتقاط كما أُرسل في التنبيه
+            since: وقت الالتقاط (يحصر البحث في التنبيهات اللاحقة له)
+        """
+        with self.cond:
+            for _, alert in self.alerts:
+                if alert.get('path') == path:
+                    alert['path'] = None
+                    return
+            self.cleared.append((path, since))
+            self.cond.notify()
+
+    def run(self):
+        conn = self._connect()
+        while True:
+            with self.cond:
+                deadline = time.time() + self.flush_interval
+                while self._pending() < self.batch_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+
+                alerts = [self.alerts.popleft() for _ in range(min(len(self.alerts), self.batch_size))]
+                tasks, self.tasks = self.tasks, {}
+                streams, self.streams = self.streams, {}
+                cleared, self.cleared = self.cleared, []
+
+            if not (alerts or tasks or streams or cleared):
+                continue
+
+            try:
+                self._write(conn, alerts, tasks, streams, cleared)
+                self.written += len(alerts) + len(tasks) + len(streams)
+                self.batches += 1
+            except Exception as e:
+                logger.error(f"خطأ في الكتابة إلى قاعدة البيانات: {str(e)}")
+
+    def _write(self, conn, alerts, tasks, streams, cleared=()):
+        with conn:
+            if tasks:
+                rows = []
+                for task_id, (data, updated) in tasks.items():
+                    task = json.loads(data)
+                    rows.append((task_id, task.get('filename'), task.get('status'),
+                                 updated, updated, data))
+                conn.executemany(
+                    "INSERT INTO tasks (id, filename, status, created, updated, data) "
+                    "VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET filename = excluded.filename, "
+                    "status = excluded.status, updated = excluded.updated, data = excluded.data",
+                    rows
+                )
+
+            if streams:
+                rows = []
+                for stream_id, (data, updated) in streams.items():
+                    stream = json.loads(data)
+                    rows.append((stream_id, stream.get('name'), stream.get('type'),
+                                 stream.get('status'), updated, updated, data))
+                conn.executemany(
+                    "INSERT INTO streams (id, name, type, status, created, updated, data) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET name = excluded.name, type = excluded.type, "
+                    "status = excluded.status, updated = excluded.updated, data = excluded.data",
+                    rows
+                )
+
+            if alerts:
+                conn.executemany(
+                    "INSERT INTO alerts (ts, type, camera, stream_id, task_id, path, confidence, data) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(ts, alert.get('type'), alert.get('camera_id'), alert.get('stream_id'),
+                      alert.get('task_id'), alert.get('path'), alert.get('confidence'), _dumps(alert))
+                     for ts, alert in alerts]
+                )
+
+            if cleared:
+                conn.executemany(
+                    "UPDATE alerts SET path = NULL, data = json_set(data, '$.path', NULL) "
+                    "WHERE ts >= ? AND path = ?",
+                    [(since, path) for path, since in cleared]
+                )
+
+    def _page(self, table, columns, filters, page, per_page, order='created DESC'):
+        where = []
+        params = []
+        for clause, value in filters:
+            if value is not None:
+                where.append(clause)
+                params.append(value)
+        where_sql = f" WHERE {' AND '.join(where)}" if where else ""
+
+        conn = self._reader()
+        total = conn.execute(f"SELECT COUNT(*) FROM {table}{where_sql}", params).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT {columns} FROM {table}{where_sql} ORDER BY {order} LIMIT ? OFFSET ?",
+            params + [per_page, (page - 1) * per_page]
+        ).fetchall()
+
+        return {
+            'items': rows,
+            'page': page,
+            'per_page': per_page,
+            'total': total
+        }
+
+    def query_alerts(self, page=1, per_page=50, camera=None, alert_type=None,
+                     task_id=None, stream_id=None, since=None, until=None):
+        """
+        استعلام التنبيهات مع التصفية والترقيم (الأحدث أولًا)
+
+        الإرجاع:
+            قاموس items و page و per_page و total
+        """
+        result = self._page('alerts', 'id, ts, data', [
+            ('camera = ?', camera),
+            ('type = ?', alert_type),
+            ('task_id = ?', task_id),
+            ('stream_id = ?', stream_id),
+            ('ts >= ?', since),
+            ('ts < ?', until),
+        ], page, per_page, order='ts DESC')
+        result['items'] = [dict(json.loads(row['data']), id=row['id'], ts=row['ts'])
+                           for row in result['items']]
+        return result
+
+    def query_tasks(self, page=1, per_page=50, status=None):
+        """استعلام المهام مع الترقيم (الأحدث أولًا)"""
+        result = self._page('tasks', 'data', [('status = ?', status)], page, per_page)
+        result['items'] = [json.loads(row['data']) for row in result['items']]
+        return result
+
+    def query_streams(self, page=1, per_page=50, status=None):
+        """استعلام البثوث مع الترقيم (الأحدث أولًا)"""
+        result = self._page('streams', 'data', [('status = ?', status)], page, per_page)
+        result['items'] = [json.loads(row['data']) for row in result['items']]
+        return result
+
+    def get_task(self, task_id):
+        """الحصول على مهمة محفوظة أو None"""
+        row = self._reader().execute("SELECT data FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        return json.loads(row['data']) if row else None
+
+    def alert_counts(self, since=None, until=None, group_by='type'):
+        """
+        عدد التنبيهات مجمعة حسب النوع أو الكاميرا
+
+        المعلمات:
+            group_by: 'type' أو 'camera' (تنبيهات مهام الرفع بدون كاميرا تُجمع تحت '')
+        """
+        if group_by not in ('type', 'camera'):
+            raise ValueError(f"تجميع غير مدعوم: {group_by}")
+
+        where = []
+        params = []
+        if since is not None:
+            where.append('ts >= ?')
+            params.append(since)
+        if until is not None:
+            where.append('ts < ?')
+            params.append(until)
+        where_sql = f" WHERE {' AND '.join(where)}" if where else ""
+
+        rows = self._reader().execute(
+            f"SELECT COALESCE({group_by}, '') AS key, COUNT(*) AS count FROM alerts{where_sql} GROUP BY key",
+            params
+        ).fetchall()
+        return {row['key']: row['count'] for row in rows}
+
+    def snapshot(self):
+        with self.cond:
+            pending = self._pending()
+        return {
+            'path': self.path,
+            'pending': pending,
+            'written': self.written,
+            'batches': self.batches
+        }
@@ -0,0 +1,90 @@
+"""
+اختبارات قياس الأداء: تشغيل إعداد صغير من benchmark.py بالنماذج البديلة
+والتحقق من شكل النتيجة، وقياس اختياري بإضافة pytest-benchmark إن كانت مثبتة
+
+    python -m pytest -q test_benchmark.py
+    python -m pytest -q test_benchmark.py --benchmark-only
+"""
+import importlib.util
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('cv2')
+pytest.importorskip('torch')
+pytest.importorskip('flask_socketio')
+
+import benchmark as bench
+
+
+
+
+HAS_PYTEST_BENCHMARK = importlib.util.find_spec('pytest_benchmark') is not None
+
+
+
+
+def small_config(**overrides):
+    """إعداد بنفس مفاتيح main في benchmark.py بعدد إطارات صغير"""
+    config = {
+        'resolution': (320, 180),
+        'stride': 2,
+        'batch_size': 1,
+        'clip': False,
+        'backend': 'torch',
+        'streams': 1,
+        'frames': 6,
+        'warmup': 1,
+        'models': 'stub',
+        'video': None,
+        'motion_gate': False,
+        'yolo_latency': 0.0,
+        'alloc_frames': 2,
+        'device': 'cpu',
+        'threads': 1
+    }
+    config.update(overrides)
+    return config
+
+
+
+
+@pytest.mark.parametrize('clip_on', [False, True])
+def test_run_config_result_structure(clip_on):
+    config = small_config(clip=clip_on)
+    result = bench.run_config(config)
+
+    assert result['config'] == {key: config[key] for key in bench.CONFIG_KEYS}
+    assert result['frames'] == config['frames'] * config['streams']
+    assert result['wall_s'] > 0
+    assert result['fps'] > 0
+    assert result['peak_rss_mb'] > 0
+    assert result['inferred_frames'] + result['propagated_frames'] == config['frames']
+    assert set(result['alloc_peak_bytes_per_frame']) == {'p50', 'max'}
+
+    for stage in ('decode', 'infer', 'draw', 'encode'):
+        assert stage in result['stages']
+    for stage, values in result['stages'].items():
+        assert stage in bench.BENCH_STAGES
+        assert set(values) == {'count', 'mean_ms', 'p50_ms', 'p99_ms'}
+        assert 0 <= values['p50_ms'] <= values['p99_ms']
+
+
+
+
+def test_run_config_batched_streams():
+    """عدة بثوث عبر المجدول المشترك تعطي نفس شكل النتيجة"""
+    config = small_config(batch_size=2, streams=2)
+    result = bench.run_config(config)
+
+    assert result['frames'] == config['frames'] * 2
+    assert result['stages']['infer']['count'] == config['frames'] * 2
+
+
+
+
+@pytest.mark.skipif(not HAS_PYTEST_BENCHMARK, reason="pytest-benchmark غير مثبتة")
+def test_run_config_benchmark(benchmark):
+    """زمن إعداد كامل بإضافة pytest-benchmark"""
+    result = benchmark.pedantic(bench.run_config, args=(small_config(),), rounds=3, iterations=1)
+    assert result['fps'] > 0
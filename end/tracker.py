@@ -0,0 +1,249 @@
+"""
+متتبع أجسام متعدد (بأسلوب SORT/ByteTrack) لإعطاء معرفات ثابتة لكشوفات YOLO
+
+كل العمليات مُتجهة عبر NumPy: مرشح كالمان بسرعة ثابتة لجميع المسارات دفعة
+واحدة، ومصفوفة IoU واحدة بين المسارات والكشوفات، ومطابقة جشعة على مرحلتين
+(الكشوفات عالية الثقة أولًا ثم المنخفضة كما في ByteTrack).
+"""
+import numpy as np
+
+
+
+
+# نموذج الحالة: [cx, cy, s, r, vcx, vcy, vs] حيث s المساحة و r نسبة العرض للارتفاع
+_F = np.eye(7, dtype=np.float64)
+_F[0, 4] = _F[1, 5] = _F[2, 6] = 1.0
+
+_R = np.diag([1.0, 1.0, 10.0, 10.0])
+_Q = np.diag([1.0, 1.0, 1.0, 1.0, 0.01, 0.01, 0.0001])
+_P0 = np.diag([10.0, 10.0, 10.0, 10.0, 10000.0, 10000.0, 10000.0])
+
+
+
+
+def iou_matrix(a, b):
+    """
+    مصفوفة IoU بين مجموعتي مربعات
+
+    المعلمات:
+        a: مصفوفة (N, 4) بصيغة x1, y1, x2, y2
+        b: مصفوفة (M, 4) بصيغة x1, y1, x2, y2
+
+    الإرجاع:
+        مصفوفة (N, M)
+    """
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros((len(a), len(b)), dtype=np.float64)
+
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-6)
+
+
+
+
+def greedy_match(scores, threshold):
+    """
+    مطابقة جشعة بين الصفوف والأعمدة: أعلى درجة أولًا
+
+    الإرجاع:
+        قائمة (صف، عمود)
+    """
+    if scores.size == 0:
+        return []
+
+    rows, cols = np.nonzero(scores >= threshold)
+    order = np.argsort(-scores[rows, cols], kind='stable')
+
+    used_rows = set()
+    used_cols = set()
+    matches = []
+    for k in order:
+        r, c = int(rows[k]), int(cols[k])
+        if r in used_rows or c in used_cols:
+            continue
+        used_rows.add(r)
+        used_cols.add(c)
+        matches.append((r, c))
+    return matches
+
+
+
+
+def boxes_to_z(boxes):
+    """تحويل المربعات (N, 4) إلى قياسات كالمان [cx, cy, s, r]"""
+    w = np.maximum(boxes[:, 2] - boxes[:, 0], 1e-3)
+    h = np.maximum(boxes[:, 3] - boxes[:, 1], 1e-3)
+    return np.stack([
+        boxes[:, 0] + w / 2,
+        boxes[:, 1] + h / 2,
+        w * h,
+        w / h
+    ], axis=1)
+
+
+
+
+def x_to_boxes(x):
+    """تحويل حالات كالمان (N, 7) إلى مربعات (N, 4)"""
+    s = np.maximum(x[:, 2], 1e-3)
+    r = np.maximum(x[:, 3], 1e-3)
+    w = np.sqrt(s * r)
+    h = s / w
+    return np.stack([
+        x[:, 0] - w / 2,
+        x[:, 1] - h / 2,
+        x[:, 0] + w / 2,
+        x[:, 1] + h / 2
+    ], axis=1)
+
+
+
+
+class MultiObjectTracker:
+    """
+    متتبع IoU + كالمان لكشوفات إطار واحد في كل استدعاء update
+
+    المسار يصبح مؤكدًا بعد min_hits مطابقات، ويُحذف بعد max_age تحديثات
+    بدون مطابقة. المسارات غير المؤكدة تُحذف فور أول إخفاق.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_age=30, min_hits=3, high_conf=0.5):
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.min_hits = min_hits
+        self.high_conf = high_conf
+
+        self.x = np.zeros((0, 7), dtype=np.float64)
+        self.P = np.zeros((0, 7, 7), dtype=np.float64)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.cls = np.zeros(0, dtype=np.int64)
+        self.hits = np.zeros(0, dtype=np.int64)
+        self.misses = np.zeros(0, dtype=np.int64)
+
+        self.next_id = 1
+
+    def __len__(self):
+        return len(self.ids)
+
+    def predict(self):
+        """التنبؤ بمواقع جميع المسارات للإطار التالي"""
+        if not len(self.ids):
+            return
+
+        # منع المساحة السالبة
+        shrinking = self.x[:, 2] + self.x[:, 6] <= 0
+        self.x[shrinking, 6] = 0.0
+
+        self.x = self.x @ _F.T
+        self.P = _F @ self.P @ _F.T + _Q
+        self.misses += 1
+
+    def _correct(self, t_idx, z):
+        """تحديث كالمان لمجموعة من المسارات دفعة واحدة"""
+        P = self.P[t_idx]
+        S = P[:, :4, :4] + _R
+        K = P[:, :, :4] @ np.linalg.inv(S)
+        y = z - self.x[t_idx, :4]
+        self.x[t_idx] += (K @ y[:, :, None])[:, :, 0]
+        self.P[t_idx] = P - K @ P[:, :4, :]
+
+    def update(self, detections, roi=None):
+        """
+        مطابقة كشوفات إطار مع المسارات وتعيين det['track_id']
+
+        المعلمات:
+            detections: قائمة قواميس تحتوي box و cls و conf
+            roi: منطقة (x1, y1, x2, y2) اختيارية كان الكشف محصورًا فيها؛
+                 المسارات خارجها لا تُحتسب كإخفاق
+
+        الإرجاع:
+            قائمة الكشوفات نفسها مع track_id (None للمسارات غير المؤكدة بعد)
+            و tentative_id (معرف المسار حتى قبل تأكيده، None بدون مسار)
+        """
+        self.predict()
+
+        det_boxes = np.array([det['box'] for det in detections], dtype=np.float64).reshape(-1, 4)
+        det_cls = np.array([det['cls'] for det in detections], dtype=np.int64)
+        det_conf = np.array([det['conf'] for det in detections], dtype=np.float64)
+        high = det_conf >= self.high_conf
+
+        scores = iou_matrix(x_to_boxes(self.x), det_boxes)
+        if scores.size:
+            scores[self.cls[:, None] != det_cls[None, :]] = 0.0
+
+        # المرحلة الأولى: الكشوفات عالية الثقة
+        first = scores.copy()
+        first[:, ~high] = 0.0
+        matches = greedy_match(first, self.iou_threshold)
+
+        # المرحلة الثانية: المسارات المتبقية مع الكشوفات منخفضة الثقة
+        second = scores.copy()
+        second[:, high] = 0.0
+        if matches:
+            second[[t for t, _ in matches], :] = 0.0
+        matches += greedy_match(second, self.iou_threshold)
+
+        if matches:
+            t_idx = np.array([t for t, _ in matches], dtype=np.int64)
+            d_idx = np.array([d for _, d in matches], dtype=np.int64)
+            self._correct(t_idx, boxes_to_z(det_boxes[d_idx]))
+            self.hits[t_idx] += 1
+            self.misses[t_idx] = 0
+
+        # المسارات خارج منطقة الكشف لم تُفحص، فلا تُحتسب عليها
+        if roi is not None and len(self.ids):
+            x1, y1, x2, y2 = roi
+            cx, cy = self.x[:, 0], self.x[:, 1]
+            outside = ~((cx >= x1) & (cx < x2) & (cy >= y1) & (cy < y2))
+            self.misses[outside & (self.misses > 0)] -= 1
+
+        # تعيين المعرفات للمسارات المؤكدة
+        for det in detections:
+            det['track_id'] = None
+            det['tentative_id'] = None
+        for t, d in matches:
+            detections[d]['tentative_id'] = int(self.ids[t])
+            if self.hits[t] >= self.min_hits:
+                detections[d]['track_id'] = int(self.ids[t])
+
+        # مسارات جديدة للكشوفات عالية الثقة غير المطابقة
+        matched = {d for _, d in matches}
+        new = [d for d in range(len(detections)) if d not in matched and high[d]]
+        if new:
+            new = np.array(new, dtype=np.int64)
+            x = np.zeros((len(new), 7), dtype=np.float64)
+            x[:, :4] = boxes_to_z(det_boxes[new])
+            ids = np.arange(self.next_id, self.next_id + len(new), dtype=np.int64)
+            self.next_id += len(new)
+
+            self.x = np.concatenate([self.x, x])
+            self.P = np.concatenate([self.P, np.repeat(_P0[None], len(new), axis=0)])
+            self.ids = np.concatenate([self.ids, ids])
+            self.cls = np.concatenate([self.cls, det_cls[new]])
+            self.hits = np.concatenate([self.hits, np.ones(len(new), dtype=np.int64)])
+            self.misses = np.concatenate([self.misses, np.zeros(len(new), dtype=np.int64)])
+
+            for d, track_id in zip(new, ids):
+                detections[d]['tentative_id'] = int(track_id)
+            if self.min_hits <= 1:
+                for d, track_id in zip(new, ids):
+                    detections[d]['track_id'] = int(track_id)
+
+        # حذف المسارات المنتهية وغير المؤكدة التي أخفقت
+        keep = (self.misses <= self.max_age) & ((self.hits >= self.min_hits) | (self.misses == 0))
+        if not keep.all():
+            self.x = self.x[keep]
+            self.P = self.P[keep]
+            self.ids = self.ids[keep]
+            self.cls = self.cls[keep]
+            self.hits = self.hits[keep]
+            self.misses = self.misses[keep]
+
+        return detections